@@ -1,16 +1,37 @@
 # api/main_api.py
-import os, uuid, shutil
+import time
+_import_start = time.perf_counter()
+import os, uuid, shutil, hashlib, json, contextlib
 from fastapi import FastAPI, UploadFile, File, Form
-from fastapi.responses import JSONResponse, StreamingResponse
+from fastapi.responses import JSONResponse, StreamingResponse, PlainTextResponse
 from fastapi.middleware.cors import CORSMiddleware
 from graph.graph_builder import build_graph
 from graph.memory_manager import init_session, append_session, save_feedback_memory
+from graph.ingest_manager import ingest_manager
+from graph.intent_manager import intent_manager
+from graph.index_manager import upload_path, remember_upload
+from graph.run_coordinator import run_coordinator
+from graph.batch_ask import ask_batch
+from config import (upload_chunk_size, upload_max_file_bytes, upload_session_quota_bytes, intent_wait_timeout,
+                    batch_max_questions, warmup_components)
 import aiofiles
-from utils.agent_utils import log_queue_manager
+from utils.progress_bus import progress_bus
+from utils.metrics import registry
+from utils.startup import Lazy, warmup, timings
+from utils.agent_utils import logger, ensure_log_listener
 
-from .param_schema import FeedbackRequest
+from .param_schema import FeedbackRequest, AskBatchRequest
 
-app = FastAPI(title="InsightAI API")
+@contextlib.asynccontextmanager
+async def lifespan(app: FastAPI):
+    """启动时预热配置中的组件, 未预热的在首次使用时初始化; 启动耗时写入日志并通过 /metrics 导出"""
+    ensure_log_listener()
+    components = await warmup(warmup_components)
+    logger.info("startup: import %.3fs, warmup %.3fs %s", timings.get("import", 0.0), timings["warmup"], components)
+    yield
+
+
+app = FastAPI(title="InsightAI API", lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -19,56 +40,195 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-GRAPH = build_graph()
+# 图在首次请求(或启动预热)时才编译
+get_graph = Lazy("graph", build_graph)
 
 @app.post("/upload")
 async def upload_files(session_id: str = Form(None), files: list[UploadFile] = File(...)):
     """
     支持上传多个文件, 且支持增量上传, 以session_id为key
+    文件按固定大小分块写盘, 边写边计算sha256, 并限制单文件大小和session总容量
     """
+    filenames = [os.path.basename(f.filename or "") for f in files]
+    if any(fn in ("", ".", "..") for fn in filenames):
+        return JSONResponse({"ok": False, "error": "文件名不能为空"}, status_code=400)
     if session_id is None:
         session_id = str(uuid.uuid4())[:8]
-    dest_dir = os.path.join("data/uploaded_files", session_id)
+    dest_dir = upload_path(session_id)
     os.makedirs(dest_dir, exist_ok=True)
-    for f in files:
-        file_path = os.path.join(dest_dir, f.filename)
-        async with aiofiles.open(file_path, "wb") as out:
-            content = await f.read()
-            await out.write(content)
+    existing = {e.name: e.stat().st_size for e in os.scandir(dest_dir) if e.is_file()}
+
+    uploaded, error = [], None
+    for f, filename in zip(files, filenames):
+        file_path = os.path.join(dest_dir, filename)
+        # 临时文件名每个请求唯一, 同名文件的并发上传各写各的, 最后一个完成的 rename 生效
+        tmp_path = f"{file_path}.{uuid.uuid4().hex}.part"
+        used = sum(size for name, size in existing.items() if name != filename)
+        digest, size = hashlib.sha256(), 0
+        async with aiofiles.open(tmp_path, "wb") as out:
+            while chunk := await f.read(upload_chunk_size):
+                size += len(chunk)
+                if size > upload_max_file_bytes:
+                    error = f"{filename} 超过单文件大小上限 {upload_max_file_bytes} 字节"
+                    break
+                if used + size > upload_session_quota_bytes:
+                    error = f"{filename} 超出 session 容量上限 {upload_session_quota_bytes} 字节"
+                    break
+                digest.update(chunk)
+                await out.write(chunk)
+        if error:
+            os.remove(tmp_path)
+            break
+        os.replace(tmp_path, file_path)
+        existing[filename] = size
+        remember_upload(session_id, filename, digest.hexdigest())
+        uploaded.append({"filename": filename, "size": size, "sha256": digest.hexdigest()})
+
     # init memory session
     init_session(session_id)
-    return JSONResponse({"ok": True, "session_id": session_id, "uploaded": [f.filename for f in files]})
+    # 解析/切分/向量化交给后台任务, 不阻塞上传请求
+    if uploaded:
+        job = await ingest_manager.submit(session_id, [u["filename"] for u in uploaded])
+    else:
+        job = ingest_manager.status(session_id)
+    resp = {"ok": error is None, "session_id": session_id, "uploaded": [u["filename"] for u in uploaded],
+            "files": uploaded, "ingest_state": job["state"]}
+    if error:
+        resp["error"] = error
+        return JSONResponse(resp, status_code=413)
+    return JSONResponse(resp)
+
+
+@app.get("/ingest_status")
+async def ingest_status(session_id: str):
+    """
+    查询 session 文档入库进度, 按文件给出 queued/parsing/indexing/done/unchanged/skipped/failed
+    """
+    return JSONResponse(ingest_manager.status(session_id))
 
 @app.post("/ask")
-async def ask_question(session_id: str = Form(...), question: str = Form(...)):
+async def ask_question(session_id: str = Form(...), question: str = Form(...), infer_intent: bool = Form(True),
+                       context_budget: int = Form(None)):
     """
     在session环境下, 提问 获取 回答
+    推测的后续问题在后台生成, 通过 /intents 获取; infer_intent=false 时跳过
+    context_budget: 本次上下文的 token 预算, 不传使用默认值
+    同一 session 的相同问题正在执行时, 直接复用该次执行的结果(coalesced=true)
     """
-    state = {"session_id": session_id, "question": question}
+    state = {"session_id": session_id, "question": question, "skip_intent": not infer_intent,
+             "context_budget": context_budget}
     # langGraph 实现  流程式的问答
-    result = await GRAPH.ainvoke(state)
+    key = ("ask", question.strip(), infer_intent, context_budget)
+    result, coalesced = await run_coordinator.run(session_id, key, lambda: get_graph().ainvoke(state))
     resp = {
         "session_id": session_id,
         "question": question,
         "context": result.get("context",""),
         "answer": result.get("answer",""),
-        "user_intent": result.get("user_intent",""),
+        "context_tokens": result.get("context_tokens"),
+        "coalesced": coalesced,
+        "user_intent": [],
+        "intent_state": intent_manager.status(session_id)["state"],
         "suggestion": result.get("suggestion",""),
     }
     return JSONResponse(resp)
 
 
+@app.get("/intents")
+async def get_intents(session_id: str, wait: bool = True):
+    """
+    获取最近一轮推测的后续问题, wait=true 时等待后台推断完成(有超时)
+    """
+    if wait:
+        return JSONResponse(await intent_manager.wait(session_id, intent_wait_timeout))
+    return JSONResponse(intent_manager.status(session_id))
+
+
+def _sse(event: str, data) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+@app.post("/ask/stream")
+async def ask_question_stream(session_id: str = Form(...), question: str = Form(...),
+                              infer_intent: bool = Form(True), context_budget: int = Form(None)):
+    """
+    流式问答(SSE): 回答 token 生成即推送, 回答完成后推送汇总结果, 后台推断出意图后再推送
+    事件: token / summary / intent / error
+    """
+    state = {"session_id": session_id, "question": question, "skip_intent": not infer_intent,
+             "context_budget": context_budget}
+
+    async def event_stream():
+        result = dict(state)
+        try:
+            # 流式结果无法共享给其他请求, 只与同 session 的其他执行串行
+            async with run_coordinator.session(session_id):
+                async for mode, chunk in get_graph().astream(state, stream_mode=["messages", "updates"]):
+                    if mode == "messages":
+                        message, metadata = chunk
+                        if metadata.get("langgraph_node") == "answer" and message.content:
+                            yield _sse("token", {"text": message.content})
+                        continue
+                    for node, update in chunk.items():
+                        result.update(update or {})
+        except Exception as e:
+            yield _sse("error", {"error": str(e)})
+            return
+        yield _sse("summary", {
+            "session_id": session_id,
+            "question": question,
+            "context": result.get("context", ""),
+            "answer": result.get("answer", ""),
+        })
+        if infer_intent:
+            intents = await intent_manager.wait(session_id, intent_wait_timeout)
+            yield _sse("intent", {"user_intent": intents["user_intent"], "intent_state": intents["state"]})
+
+    return StreamingResponse(event_stream(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+@app.post("/ask_batch")
+async def ask_question_batch(item: AskBatchRequest):
+    """
+    批量问答(SSE): 同一 session 的一组问题共享索引与反馈, 问题一次向量化, LLM 并发调用
+    每个问题完成即推送 result(带原始下标 index, 失败时带 error), 全部完成后推送 done
+    write_memory=true 时问答写入会话记忆, 此时与该 session 的其他请求串行
+    """
+    questions = [q for q in item.questions if q and q.strip()]
+    if not questions:
+        return JSONResponse({"error": "questions 不能为空"}, status_code=400)
+    if len(questions) > batch_max_questions:
+        return JSONResponse({"error": f"单次最多 {batch_max_questions} 个问题"}, status_code=413)
+
+    async def event_stream():
+        done = failed = 0
+        lock = run_coordinator.session(item.session_id) if item.write_memory else contextlib.nullcontext()
+        try:
+            async with lock:
+                async for r in ask_batch(item.session_id, questions, item.context_budget, item.write_memory):
+                    done += 1
+                    failed += "error" in r
+                    yield _sse("result", r)
+        except Exception as e:
+            yield _sse("error", {"error": str(e)})
+            return
+        yield _sse("done", {"session_id": item.session_id, "total": len(questions), "answered": done - failed,
+                            "failed": failed})
+
+    return StreamingResponse(event_stream(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
 @app.get("/get_progress")
-async def get_progress(session_id):
-    # 返回流式日志响应
+async def get_progress(session_id: str, since: int = None):
+    """
+    流式返回节点进度, 每行一条, 本轮结束或长时间无新进度时断开
+    新连接会回放本轮已发生的进度; since 为上次读到的序号时从其后继续
+    """
     async def event_stream():
-        queue = log_queue_manager.get_queue(session_id)
-        while True:
-            log = await queue.get()  # 从队列获取日志
-            if log is None:
-                log_queue_manager.remove_queue(session_id)
-                break
-            yield log + "\n"  # 每次 yield 返回一个新的日志行
+        async for event in progress_bus.subscribe(session_id, since):
+            yield event["message"] + "\n"
 
     return StreamingResponse(event_stream(), media_type="text/plain")
 
@@ -79,16 +239,31 @@ async def user_feedback(item: FeedbackRequest):
     用户提交反馈：
     - satisfied: True / False
     - 如果不满意并提供 new_prompt，将重新生成答案
+    - 重复提交的相同反馈(如重试)共享同一次执行
     """
-    state = {"session_id": item.session_id, "feedback": item.feedback, "satisfied": item.satisfied}
-    regenerated_answer = await GRAPH.ainvoke(state)
+    state = {"session_id": item.session_id, "feedback": item.feedback, "satisfied": item.satisfied,
+             "skip_intent": not item.infer_intent, "context_budget": item.context_budget}
+    key = ("feedback", item.satisfied, item.feedback, item.infer_intent, item.context_budget)
+    regenerated_answer, coalesced = await run_coordinator.run(item.session_id, key,
+                                                              lambda: get_graph().ainvoke(state))
 
     resp = {
         "session_id": item.session_id,
         "question": regenerated_answer.get("question", ""),
         "context": regenerated_answer.get("context",""),
         "answer": regenerated_answer.get("answer",""),
-        "user_intent": regenerated_answer.get("user_intent",[]),
+        "user_intent": [],
+        "intent_state": intent_manager.status(item.session_id)["state"],
+        "coalesced": coalesced,
         # "suggestion": regenerated_answer.get("suggestion",""),
     }
     return JSONResponse(resp)
+
+
+@app.get("/metrics")
+async def metrics():
+    """Prometheus 格式的指标: 节点耗时、token 数、检索规模、缓存命中等"""
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4")
+
+
+timings["import"] = round(time.perf_counter() - _import_start, 4)
@@ -1,3 +1,5 @@
+from typing import List
+
 from pydantic import BaseModel
 
 
@@ -5,3 +7,12 @@ class FeedbackRequest(BaseModel):
     session_id: str
     satisfied: bool
     feedback: str | None = None
+    infer_intent: bool = True
+    context_budget: int | None = None
+
+
+class AskBatchRequest(BaseModel):
+    session_id: str
+    questions: List[str]
+    context_budget: int | None = None
+    write_memory: bool = False
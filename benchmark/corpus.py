@@ -0,0 +1,35 @@
+import random
+from typing import Dict, List, Tuple
+
+_TOPICS = ["财务", "合同", "采购", "人事", "安全", "运维", "市场", "研发", "客服", "物流"]
+_WORDS = ("budget invoice contract vendor policy incident deploy release customer ticket shipment "
+          "warehouse audit risk quarter revenue margin latency backup schedule training").split()
+_CN = ["报告", "流程", "审批", "预算", "指标", "风险", "计划", "变更", "记录", "规范", "负责人", "周期"]
+
+
+def _sentence(rng: random.Random, topic: str, i: int) -> str:
+    words = " ".join(rng.choice(_WORDS) for _ in range(rng.randint(4, 9)))
+    return f"{topic}{rng.choice(_CN)}第{i}条: {words}, {rng.choice(_CN)}需要在{rng.randint(1, 30)}日内完成。"
+
+
+def make_corpus(n_docs: int, doc_chars: int, seed: int = 0) -> Tuple[Dict[str, str], List[str]]:
+    """
+    生成中英混合的合成文档, 返回 ({文件名: 内容}, 问题列表)
+    问题取自文档中的句子片段, 检索时能命中对应文档
+    """
+    rng = random.Random(seed)
+    docs, questions = {}, []
+    for d in range(n_docs):
+        topic = _TOPICS[d % len(_TOPICS)]
+        lines, size, i = [f"# {topic}文档 {d}"], 0, 0
+        while size < doc_chars:
+            s = _sentence(rng, topic, i)
+            lines.append(s)
+            size += len(s)
+            i += 1
+            if rng.random() < 0.05:
+                questions.append(f"{s.split(':')[0]} 的内容是什么?")
+        docs[f"doc_{d:04d}.md"] = "\n".join(lines)
+        questions.append(f"{topic}文档 {d} 中{rng.choice(_CN)}有哪些要求?")
+    rng.shuffle(questions)
+    return docs, questions
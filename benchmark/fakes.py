@@ -0,0 +1,93 @@
+import asyncio, time, hashlib, math
+from typing import List
+
+from langchain_core.embeddings import Embeddings
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+
+from utils.text_search import tokenize
+
+
+class FakeEmbeddings(Embeddings):
+    """
+    确定性的假向量模型: 按词哈希到固定维度的词袋向量再归一化, 相同文本得到相同向量, 词重合越多越相似
+    latency 为每次调用的固定耗时, per_text_latency 为每条文本的额外耗时(秒)
+    """
+
+    def __init__(self, dim: int = 768, latency: float = 0.0, per_text_latency: float = 0.0):
+        self.dim = dim
+        self.latency = latency
+        self.per_text_latency = per_text_latency
+        self.calls = 0
+        self.texts = 0
+
+    def _vector(self, text: str) -> List[float]:
+        v = [0.0] * self.dim
+        for token in tokenize(text) or [text]:
+            h = hashlib.blake2b(token.encode("utf-8"), digest_size=8).digest()
+            v[int.from_bytes(h[:4], "little") % self.dim] += 1.0 if h[4] & 1 else -1.0
+        norm = math.sqrt(sum(x * x for x in v)) or 1.0
+        return [x / norm for x in v]
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        self.calls += 1
+        self.texts += len(texts)
+        time.sleep(self.latency + self.per_text_latency * len(texts))
+        return [self._vector(t) for t in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_documents([text])[0]
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        self.calls += 1
+        self.texts += len(texts)
+        await asyncio.sleep(self.latency + self.per_text_latency * len(texts))
+        return [self._vector(t) for t in texts]
+
+    async def aembed_query(self, text: str) -> List[float]:
+        return (await self.aembed_documents([text]))[0]
+
+
+class FakeChatModel(BaseChatModel):
+    """
+    假的对话模型: 按首 token 延迟 + 每 token 延迟模拟生成耗时, 支持流式输出
+    提示词中要求输出 JSON 意图时返回固定格式的意图
+    """
+
+    first_token_latency: float = 0.0
+    token_latency: float = 0.0
+    answer_tokens: int = 50
+    calls: int = 0
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-benchmark"
+
+    def _tokens(self, messages) -> List[str]:
+        prompt = messages[-1].content
+        if "intents" in prompt:
+            return ['{"intents": ', '["下一步可以问什么?"]}']
+        seed = hashlib.sha256(prompt.encode("utf-8")).hexdigest()
+        return [f"{seed[i % 60:i % 60 + 4]} " for i in range(self.answer_tokens)]
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        self.calls += 1
+        tokens = self._tokens(messages)
+        time.sleep(self.first_token_latency + self.token_latency * len(tokens))
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content="".join(tokens)))])
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        chunks = [c async for c in self._astream(messages, stop, run_manager, **kwargs)]
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content="".join(c.text for c in chunks)))])
+
+    async def _astream(self, messages, stop=None, run_manager=None, **kwargs):
+        self.calls += 1
+        await asyncio.sleep(self.first_token_latency)
+        for token in self._tokens(messages):
+            if self.token_latency:
+                await asyncio.sleep(self.token_latency)
+            chunk = ChatGenerationChunk(message=AIMessageChunk(content=token))
+            if run_manager:
+                await run_manager.on_llm_new_token(token, chunk=chunk)
+            yield chunk
@@ -0,0 +1,225 @@
+"""
+离线基准测试: 用确定性的假对话模型和假向量模型替换 nodes 中的 llm / embeddings,
+在临时目录中生成合成文档, 通过 ASGI 直接驱动 /upload、/ask、/feedback, 不需要任何网络服务
+
+python -m benchmark.run --docs 5,50 --doc-chars 20000 --requests 200 --concurrency 8
+python -m benchmark.run --output bench.json --max-p95-ms 500   # CI 中超过阈值时返回非 0
+"""
+import os, sys, json, time, random, asyncio, argparse, tempfile, logging, contextlib
+from contextvars import ContextVar
+from typing import Dict, List, Optional
+
+import httpx
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.tracers.context import register_configure_hook
+
+from .fakes import FakeEmbeddings, FakeChatModel
+from .corpus import make_corpus
+
+
+class NodeTimer(BaseCallbackHandler):
+    """通过回调统计每个 LangGraph 节点的耗时"""
+
+    run_inline = True
+
+    def __init__(self):
+        self.durations: Dict[str, List[float]] = {}
+        self._starts = {}
+
+    def on_chain_start(self, serialized, inputs, *, run_id, metadata=None, name=None, **kwargs):
+        if name and metadata and metadata.get("langgraph_node") == name and name != "__start__":
+            self._starts[run_id] = (name, time.perf_counter())
+
+    def on_chain_end(self, outputs, *, run_id, **kwargs):
+        item = self._starts.pop(run_id, None)
+        if item:
+            self.durations.setdefault(item[0], []).append(time.perf_counter() - item[1])
+
+    def on_chain_error(self, error, *, run_id, **kwargs):
+        self.on_chain_end(None, run_id=run_id)
+
+
+# 注册后, 在该 context 中创建的所有回调管理器都会带上 NodeTimer, 不需要改动 API 代码
+_node_timer: ContextVar[Optional[NodeTimer]] = ContextVar("benchmark_node_timer", default=None)
+register_configure_hook(_node_timer, inheritable=True)
+
+
+def percentile(values: List[float], p: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, max(0, int(round(p / 100 * len(values))) - 1))]
+
+
+def summarize(values: List[float]) -> Dict:
+    """秒 -> 毫秒的分位数统计"""
+    return {
+        "count": len(values),
+        "mean_ms": round(sum(values) / len(values) * 1000, 2) if values else 0.0,
+        "p50_ms": round(percentile(values, 50) * 1000, 2),
+        "p95_ms": round(percentile(values, 95) * 1000, 2),
+        "p99_ms": round(percentile(values, 99) * 1000, 2),
+        "total_s": round(sum(values), 3),
+    }
+
+
+async def _wait_ingest(client: httpx.AsyncClient, session_id: str, timeout: float) -> Dict:
+    deadline = time.perf_counter() + timeout
+    while True:
+        status = (await client.get("/ingest_status", params={"session_id": session_id})).json()
+        if status["state"] in ("done", "partial", "failed") or time.perf_counter() > deadline:
+            return status
+        await asyncio.sleep(0.05)
+
+
+async def run_scenario(client: httpx.AsyncClient, args, n_docs: int, tag: str) -> Dict:
+    docs, questions = make_corpus(n_docs, args.doc_chars, args.seed)
+    sessions = [f"{tag}-s{i}" for i in range(args.concurrency)]
+    timer = NodeTimer()
+    token = _node_timer.set(timer)
+    latencies: Dict[str, List[float]] = {}
+    errors: Dict[str, int] = {}
+
+    def record(endpoint: str, elapsed: float, ok: bool):
+        latencies.setdefault(endpoint, []).append(elapsed)
+        if not ok:
+            errors[endpoint] = errors.get(endpoint, 0) + 1
+
+    try:
+        # 上传并等待入库完成, 入库时间从提交上传开始计算
+        ingest_times = []
+
+        async def upload(session_id: str):
+            start = time.perf_counter()
+            files = [("files", (fn, text.encode("utf-8"))) for fn, text in docs.items()]
+            r = await client.post("/upload", data={"session_id": session_id}, files=files)
+            record("/upload", time.perf_counter() - start, r.status_code == 200)
+            status = await _wait_ingest(client, session_id, args.ingest_timeout)
+            ingest_times.append(time.perf_counter() - start)
+            if status["state"] != "done":
+                errors["ingest"] = errors.get("ingest", 0) + 1
+
+        await asyncio.gather(*(upload(s) for s in sessions))
+
+        # 每个 session 模拟一个用户, 用户内的请求依次发出, 并发度即 session 数
+        async def user(u: int, session_id: str):
+            user_rng = random.Random(args.seed * 1000 + u)
+            for i in range(u, args.requests, len(sessions)):
+                start = time.perf_counter()
+                if i >= len(sessions) and user_rng.random() < args.feedback_ratio:
+                    satisfied = user_rng.random() < 0.5
+                    body = {"session_id": session_id, "satisfied": satisfied, "infer_intent": args.intent,
+                            "feedback": None if satisfied else "请回答得更详细一些"}
+                    r = await client.post("/feedback", json=body)
+                    record("/feedback", time.perf_counter() - start, r.status_code == 200)
+                else:
+                    data = {"session_id": session_id, "question": user_rng.choice(questions),
+                            "infer_intent": str(args.intent).lower()}
+                    r = await client.post("/ask", data=data)
+                    record("/ask", time.perf_counter() - start, r.status_code == 200)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(user(u, s) for u, s in enumerate(sessions)))
+        elapsed = time.perf_counter() - start
+    finally:
+        _node_timer.reset(token)
+
+    return {
+        "docs": n_docs,
+        "corpus_chars": sum(len(t) for t in docs.values()),
+        "sessions": len(sessions),
+        "ingest": summarize(ingest_times),
+        "endpoints": {ep: {**summarize(v), "errors": errors.get(ep, 0)} for ep, v in latencies.items()},
+        "ingest_errors": errors.get("ingest", 0),
+        "throughput_rps": round(args.requests / elapsed, 2) if elapsed else 0.0,
+        "nodes": {name: summarize(v) for name, v in sorted(timer.durations.items())},
+    }
+
+
+def format_report(results: List[Dict]) -> str:
+    lines = []
+    for r in results:
+        lines.append(f"== docs={r['docs']} chars={r['corpus_chars']} sessions={r['sessions']} "
+                     f"throughput={r['throughput_rps']} req/s ingest_p50={r['ingest']['p50_ms']}ms")
+        lines.append(f"{'name':<26} {'count':>6} {'mean_ms':>9} {'p50_ms':>9} {'p95_ms':>9} {'p99_ms':>9} {'errors':>6}")
+        for ep, s in r["endpoints"].items():
+            lines.append(f"{ep:<26} {s['count']:>6} {s['mean_ms']:>9} {s['p50_ms']:>9} {s['p95_ms']:>9} "
+                         f"{s['p99_ms']:>9} {s['errors']:>6}")
+        for node, s in r["nodes"].items():
+            lines.append(f"  node:{node:<20} {s['count']:>6} {s['mean_ms']:>9} {s['p50_ms']:>9} {s['p95_ms']:>9} "
+                         f"{s['p99_ms']:>9} {'':>6}")
+    return "\n".join(lines)
+
+
+async def main(args) -> List[Dict]:
+    # 所有相对路径(data/...)落在工作目录中, 会话记忆目录同样重定向
+    from graph import nodes, memory_manager
+    from api.main_api import app
+
+    if not args.verbose:
+        logging.getLogger("insightai").setLevel(logging.WARNING)
+    memory_manager.MEM_DIR = os.path.abspath(os.path.join("data", "memory"))
+    os.makedirs(memory_manager.MEM_DIR, exist_ok=True)
+    embeddings = FakeEmbeddings(args.dim, args.embed_latency, args.embed_per_text_latency)
+    nodes.embeddings.embeddings = embeddings
+    # 只替换实际的模型, 调用仍经过 LLM 调度器
+    chat = FakeChatModel(first_token_latency=args.llm_first_token_latency,
+                         token_latency=args.llm_token_latency, answer_tokens=args.answer_tokens)
+    nodes.llm.inner = chat
+
+    results = []
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://benchmark", timeout=None) as client:
+        for n_docs in args.docs:
+            embed_calls, llm_calls = embeddings.calls, chat.calls
+            result = await run_scenario(client, args, n_docs, f"bench{n_docs}-{int(time.time())}")
+            result["embedding_calls"] = embeddings.calls - embed_calls
+            result["llm_calls"] = chat.calls - llm_calls
+            results.append(result)
+    return results
+
+
+def parse_args(argv=None):
+    p = argparse.ArgumentParser(description="InsightAI 离线基准测试")
+    p.add_argument("--docs", default="5,50", help="每个场景的文档数, 逗号分隔")
+    p.add_argument("--doc-chars", type=int, default=20000, help="每篇文档的字符数")
+    p.add_argument("--requests", type=int, default=100, help="每个场景的 /ask + /feedback 请求数")
+    p.add_argument("--concurrency", type=int, default=8, help="并发用户数, 每个用户使用独立的 session")
+    p.add_argument("--feedback-ratio", type=float, default=0.2)
+    p.add_argument("--intent", action="store_true", help="同时执行后台意图推断")
+    p.add_argument("--dim", type=int, default=768)
+    p.add_argument("--embed-latency", type=float, default=0.005, help="每次向量化调用的延迟(秒)")
+    p.add_argument("--embed-per-text-latency", type=float, default=0.0005)
+    p.add_argument("--llm-first-token-latency", type=float, default=0.05)
+    p.add_argument("--llm-token-latency", type=float, default=0.002)
+    p.add_argument("--answer-tokens", type=int, default=50)
+    p.add_argument("--ingest-timeout", type=float, default=600)
+    p.add_argument("--seed", type=int, default=0)
+    p.add_argument("--workdir", default=None, help="数据目录, 默认使用临时目录")
+    p.add_argument("--output", default=None, help="结果写入 JSON 文件")
+    p.add_argument("--max-p95-ms", type=float, default=None, help="/ask 的 p95 超过该值时以非 0 退出")
+    p.add_argument("--verbose", action="store_true", help="保留节点日志")
+    args = p.parse_args(argv)
+    args.docs = [int(x) for x in args.docs.split(",") if x]
+    return args
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.output:
+        args.output = os.path.abspath(args.output)
+    os.chdir(args.workdir or tempfile.mkdtemp(prefix="insight_bench_"))
+    with contextlib.ExitStack() as stack:
+        if not args.verbose:
+            stack.enter_context(contextlib.redirect_stdout(open(os.devnull, "w")))
+        results = asyncio.run(main(args))
+    print(format_report(results))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({"config": {k: v for k, v in vars(args).items()}, "results": results}, f,
+                      ensure_ascii=False, indent=2)
+    if args.max_p95_ms is not None:
+        worst = max(r["endpoints"].get("/ask", {}).get("p95_ms", 0) for r in results)
+        if worst > args.max_p95_ms:
+            print(f"/ask p95 {worst}ms 超过阈值 {args.max_p95_ms}ms", file=sys.stderr)
+            sys.exit(1)
@@ -1,4 +1,120 @@
 
 open_api_key = "Your api key"
 model = "deepseek-chat"
-api_base_url = "https://api.deepseek.com"
\ No newline at end of file
+api_base_url = "https://api.deepseek.com"
+embedding_model = "nomic-embed-text"
+
+# 进程内已加载向量索引缓存的内存预算(字节)
+vectorstore_cache_bytes = 512 * 1024 * 1024
+
+# 后台文档入库的 worker 数量与排队上限; 已结束任务状态的保留时间(秒)与最多保留的 session 数
+ingest_workers = 2
+ingest_queue_size = 100
+ingest_job_ttl = 3600
+ingest_max_jobs = 10000
+
+# 跨 session 的持久化向量缓存
+embedding_cache_path = "data/embedding_cache.sqlite3"
+embedding_cache_bytes = 1024 * 1024 * 1024
+# 问题向量只缓存在进程内(条数), 不写入持久化缓存
+embedding_query_cache_size = 2048
+
+# 分批向量化: 每批 chunk 数, 同时在途的批次数, 失败重试次数与退避基数(秒)
+embed_batch_size = 32
+embed_max_in_flight = 4
+embed_retries = 3
+embed_retry_backoff = 1.0
+
+# 文档解析进程池大小
+parse_workers = 2
+
+# 上传: 分块写盘大小, 单文件上限, 每个 session 的总容量上限(字节)
+upload_chunk_size = 1024 * 1024
+upload_max_file_bytes = 200 * 1024 * 1024
+upload_session_quota_bytes = 1024 * 1024 * 1024
+
+# 混合检索: 最终最多放入上下文的 chunk 数(同时受 token 预算限制), 每路召回数, RRF 常数与两路权重
+retrieve_k = 6
+retrieve_fetch_k = 20
+rrf_k = 60
+rrf_vector_weight = 1.0
+rrf_bm25_weight = 1.0
+
+# 获取后台意图推断结果时的最长等待时间(秒); 已结束的结果保留时间(秒)与最多保留的 session 数
+intent_wait_timeout = 60
+intent_result_ttl = 1800
+intent_max_results = 10000
+
+# 语义回答缓存: 问题向量余弦相似度阈值, 过期时间(秒), 最大条目数
+answer_cache_threshold = 0.95
+answer_cache_ttl = 3600
+answer_cache_max_entries = 2000
+
+# 向量索引类型: auto / flat / ivf / hnsw / ivfpq / sq8(IVF + 8bit 标量量化)
+# auto 时 chunk 数低于 hnsw 阈值用 flat, 低于 ivfpq 阈值用 hnsw, 否则用 ivfpq
+faiss_index_type = "auto"
+faiss_auto_thresholds = {"hnsw": 20000, "ivfpq": 200000}
+# IVF 聚类中心数(0 为按规模自动), PQ 子空间数(0 为自动), HNSW 每点邻居数, 训练抽样数
+faiss_nlist = 0
+faiss_pq_m = 0
+faiss_hnsw_m = 32
+faiss_train_size = 50000
+# 查询参数: IVF 探查的聚类数, HNSW 搜索宽度
+faiss_nprobe = 16
+faiss_ef_search = 128
+# flat / hnsw / ivf 索引中向量的存储精度: float32 / float16 / int8, 精确索引始终保留 float32 用于增量更新
+faiss_vector_dtype = "float32"
+# 增量更新: chunk 数相对上次训练时增减超过该倍数(或 auto 下跨过类型阈值)时重新训练检索索引, 否则在已训练的索引上增删
+faiss_retrain_ratio = 2.0
+
+# 上下文组装: 默认 token 预算(可按请求覆盖), 反馈/记忆占预算的上限比例(其余给文档), MMR 相关度权重
+context_token_budget = 3000
+context_budget_shares = {"feedback": 0.15, "memory": 0.25}
+context_mmr_lambda = 0.7
+# 意图推断时上下文与回答各自的 token 上限
+intent_context_tokens = 800
+intent_answer_tokens = 600
+
+# 节点进度推送: 后端 memory(单进程) / sqlite(同一主机的多个 worker 共享), 每个 session 保留的事件数,
+# 事件过期时间(秒), sqlite 订阅轮询间隔(秒), 订阅方无新事件时的最长等待(秒)
+progress_backend = "memory"
+progress_db_path = "data/progress.sqlite3"
+progress_max_events = 200
+progress_ttl = 600
+progress_poll_interval = 0.1
+progress_idle_timeout = 300
+
+# 日志级别, DEBUG 时输出每个节点进入时的 state keys
+log_level = "INFO"
+
+# 批量问答: 单次请求的最大问题数, 同时进行的 LLM 调用数
+batch_max_questions = 500
+batch_llm_concurrency = 4
+
+# LLM 调度: 全局与单 session 的并发上限, 令牌桶每秒请求数(0 为不限速)与突发容量,
+# 失败重试次数与退避的基数/上限(秒), 共享 HTTP 连接池的连接数上限与请求超时(秒)
+llm_max_concurrency = 8
+llm_session_concurrency = 4
+llm_rate_per_second = 0
+llm_rate_burst = 8
+llm_max_retries = 3
+llm_retry_base_delay = 0.5
+llm_retry_max_delay = 8
+llm_http_max_connections = 16
+llm_http_timeout = 120
+
+# 反馈画像: 保留最近不重复的不满意意见条数, 满意回答的示例条数, 每条示例保留的字符数
+feedback_profile_instructions = 10
+feedback_profile_exemplars = 3
+feedback_exemplar_chars = 200
+
+# 会话记忆压缩: 热日志超过轮数或 token 数时, 较早的轮次折叠进滚动摘要, 原始记录移入冷归档;
+# 热日志保留最近的轮数, 摘要的 token 上限
+memory_compact_turns = 40
+memory_compact_tokens = 12000
+memory_tail_turns = 10
+memory_summary_tokens = 600
+
+# 启动预热: API 启动时提前初始化的组件(graph / llm / embeddings), 其余在首次使用时初始化;
+# 文档解析库(pandas / docx / pypdf2)只在解析子进程中用到, API 进程无需预热
+warmup_components = ["graph", "llm", "embeddings"]
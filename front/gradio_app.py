@@ -1,25 +1,39 @@
 import gradio as gr
 import requests
 import os
+import uuid
+import json
 
 API_URL = "http://localhost:8001"
 
 # 上传文档 
+def _iter_multipart(fields, paths, boundary, chunk_size=1024 * 1024):
+    """逐块生成 multipart 请求体, 文件内容边读边发, 不整体读入内存"""
+    for name, value in fields.items():
+        yield (f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n'
+               f'{value}\r\n').encode("utf-8")
+    for path in paths:
+        filename = os.path.basename(path).replace('"', "_")
+        yield (f'--{boundary}\r\nContent-Disposition: form-data; name="files"; filename="{filename}"\r\n'
+               f'Content-Type: application/octet-stream\r\n\r\n').encode("utf-8")
+        with open(path, "rb") as f:
+            while chunk := f.read(chunk_size):
+                yield chunk
+        yield b"\r\n"
+    yield f"--{boundary}--\r\n".encode("utf-8")
+
+
 def api_upload(files, session_id):
     if not files:
         return {"error": "未选择任何文档"}
 
-    files_payload = []
-    for path in files:
-        filename = os.path.basename(path)
-        with open(path, "rb") as f:
-            files_payload.append(("files", (filename, f.read(), "application/octet-stream")))
-
     data = {}
     if session_id:
         data["session_id"] = session_id
 
-    resp = requests.post(f"{API_URL}/upload", files=files_payload, data=data)
+    boundary = uuid.uuid4().hex
+    resp = requests.post(f"{API_URL}/upload", data=_iter_multipart(data, files, boundary),
+                         headers={"Content-Type": f"multipart/form-data; boundary={boundary}"})
     return resp.json()
 
 
@@ -30,6 +44,24 @@ def api_ask(session_id, question):
     return resp.json()
 
 
+def api_ask_stream(session_id, question):
+    """调用 /ask/stream, 逐个产出 (事件名, 数据)"""
+    data = {"session_id": session_id, "question": question}
+    resp = requests.post(f"{API_URL}/ask/stream", data=data, stream=True)
+    event = None
+    for line in resp.iter_lines(decode_unicode=True):
+        if line.startswith("event:"):
+            event = line[len("event:"):].strip()
+        elif line.startswith("data:"):
+            yield event, json.loads(line[len("data:"):])
+
+
+# 获取后台推测的后续问题
+def api_intents(session_id):
+    resp = requests.get(f"{API_URL}/intents", params={"session_id": session_id})
+    return resp.json()
+
+
 # 发送反馈 
 def api_feedback(session_id, satisfied, new_prompt=None):
     data = {
@@ -84,14 +116,29 @@ with gr.Blocks() as demo:
         # 知识问答
         def do_ask(sess, q):
             if not sess:
-                return "请输入上传文档后返回的 session_id", gr.update(visible=False), gr.update(visible=False)
-            r = api_ask(sess, q)
-            text = f"Answer:\n{r.get('answer','')}\n\nIntent:\n{r.get('user_intent',[])}\n\n"
-            return (
-                q, text, gr.update(visible=True), gr.update(visible=False), 
-                gr.update(choices=r.get('user_intent',[]), value=None, visible=bool(r.get('user_intent',[]))),
-                gr.update(visible=True)
-            )
+                yield (q, "请输入上传文档后返回的 session_id", gr.update(visible=False), gr.update(visible=False),
+                       gr.update(visible=False), gr.update(visible=False))
+                return
+            answer = ""
+            for event, data in api_ask_stream(sess, q):
+                if event == "token":
+                    answer += data.get("text", "")
+                    yield q, f"Answer:\n{answer}", gr.update(), gr.update(), gr.update(), gr.update()
+                elif event == "summary":
+                    # 回答已完成, 先展示并开放反馈, 意图稍后到达
+                    answer = data.get("answer", answer)
+                    yield (q, f"Answer:\n{answer}\n\n", gr.update(visible=True), gr.update(visible=False),
+                           gr.update(), gr.update())
+                elif event == "intent":
+                    intents = data.get("user_intent", [])
+                    yield (
+                        q, f"Answer:\n{answer}\n\nIntent:\n{intents}\n\n", gr.update(visible=True),
+                        gr.update(visible=False), gr.update(choices=intents, value=None, visible=bool(intents)),
+                        gr.update(visible=bool(intents))
+                    )
+                elif event == "error":
+                    yield q, f"Answer:\n{answer}\n\n[error] {data.get('error')}", gr.update(), gr.update(), \
+                        gr.update(), gr.update()
         
         def get_progress(sess):
             resp = requests.get(f"{API_URL}/get_progress?session_id={sess}", stream=True)
@@ -121,8 +168,10 @@ with gr.Blocks() as demo:
         # 提交反馈
         def send_feedback(sess, newp):
             r = api_feedback(sess, False, newp)
-            text = f"Answer:\n{r.get('answer','')}\n\nIntent:\n{r.get('user_intent',[])}\n\n"
-            return text
+            text = f"Answer:\n{r.get('answer','')}\n\n"
+            yield text
+            intents = api_intents(sess)
+            yield text + f"Intent:\n{intents.get('user_intent',[])}\n\n"
         satisfied_btn.click(on_satisfied, inputs=[session_box, ],
                             outputs=[feedback_form, feedback_result])
         unsatisfied_btn.click(on_unsatisfied, outputs=[feedback_form, feedback_result])
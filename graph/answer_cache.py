@@ -0,0 +1,79 @@
+import time, threading, itertools
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+
+class SemanticAnswerCache:
+    """
+    语义回答缓存: key 为 (文档集版本, 反馈画像hash), 在同一 key 下按问题向量的余弦相似度匹配
+    文档或不满意反馈变化后 key 随之改变, 旧条目不会再被命中, 由 TTL 和 LRU 淘汰
+    """
+
+    def __init__(self, max_entries: int, ttl: float, threshold: float):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.threshold = threshold
+        self.entries: "OrderedDict[int, Dict]" = OrderedDict()
+        self.buckets: Dict[str, List[int]] = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._ids = itertools.count()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def normalize(vector: List[float]) -> np.ndarray:
+        v = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(v)
+        return v / norm if norm else v
+
+    def lookup(self, key: str, vector: List[float]) -> Optional[Tuple[Dict, float]]:
+        """返回 (缓存条目, 相似度), 未命中返回 None"""
+        v = self.normalize(vector)
+        now = time.time()
+        best, best_score = None, self.threshold
+        with self._lock:
+            for entry_id in list(self.buckets.get(key, [])):
+                entry = self.entries[entry_id]
+                if now - entry["ts"] > self.ttl:
+                    self._remove(entry_id)
+                    continue
+                score = float(np.dot(v, entry["vector"]))
+                if score >= best_score:
+                    best, best_score = entry_id, score
+            if best is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(best)
+            self.hits += 1
+            return self.entries[best], best_score
+
+    def store(self, key: str, vector: List[float], answer: str, context: str):
+        with self._lock:
+            entry_id = next(self._ids)
+            self.entries[entry_id] = {"key": key, "vector": self.normalize(vector), "answer": answer,
+                                      "context": context, "ts": time.time()}
+            self.buckets.setdefault(key, []).append(entry_id)
+            while len(self.entries) > self.max_entries:
+                self._remove(next(iter(self.entries)))
+                self.evictions += 1
+
+    def _remove(self, entry_id: int):
+        entry = self.entries.pop(entry_id)
+        bucket = self.buckets.get(entry["key"], [])
+        bucket.remove(entry_id)
+        if not bucket:
+            self.buckets.pop(entry["key"], None)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / total, 4) if total else 0.0,
+                "evictions": self.evictions,
+                "entries": len(self.entries),
+            }
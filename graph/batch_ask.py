@@ -0,0 +1,86 @@
+import asyncio
+from typing import AsyncIterator, Dict, List
+
+from langchain.messages import HumanMessage
+
+from . import nodes
+from .memory_manager import init_session, append_session, query_session_keywords, get_session_summary
+from .memory_compactor import memory_compactor
+from .index_manager import get_session_index
+from .ingest_manager import ingest_manager
+from config import batch_llm_concurrency
+from utils.agent_utils import make_prompt
+from utils.metrics import cache_requests
+
+
+async def ask_batch(session_id: str, questions: List[str], context_budget: int = None,
+                    write_memory: bool = False, max_concurrency: int = batch_llm_concurrency
+                    ) -> AsyncIterator[Dict]:
+    """
+    同一 session 的批量问答, 按完成顺序产出每个问题的结果
+    索引、反馈、缓存分区只读取一次, 所有问题一次向量化, LLM 调用通过 abatch 并发(上限 max_concurrency)
+    重复的问题只生成一次; 不推断意图, write_memory=false 时不写入会话记忆
+    """
+    init_session(session_id)
+    await ingest_manager.ensure_indexed(session_id)
+    feedbacks, feedback_style = await asyncio.to_thread(nodes.collect_feedbacks, session_id)
+    index = await asyncio.to_thread(get_session_index, session_id)
+    memory_summary = get_session_summary(session_id)["summary"]
+    # 用到会话记忆的问题使用本 session 私有的缓存分区
+    shared_key = await asyncio.to_thread(nodes.answer_cache_key, session_id, feedbacks, feedback_style)
+    private_key = await asyncio.to_thread(nodes.answer_cache_key, session_id, feedbacks, feedback_style, True)
+
+    # 相同问题合并, 结果按原顺序的下标分别返回
+    positions: Dict[str, List[int]] = {}
+    for i, q in enumerate(questions):
+        positions.setdefault(q.strip(), []).append(i)
+    unique = list(positions)
+    vectors = await nodes.embeddings.aembed_queries(unique)
+    memory_hits = await asyncio.gather(*(asyncio.to_thread(query_session_keywords, session_id, q, 3) for q in unique))
+
+    def result(q: str, **fields) -> List[Dict]:
+        return [{"index": i, "question": questions[i], **fields} for i in positions[q]]
+
+    async def prepare(q: str, vector: List[float], hits: List[Dict], cache_key: str) -> Dict:
+        candidates = []
+        if index is not None:
+            candidates = await nodes.hybrid_candidates(index[0], index[1], q, vector)
+        built = nodes.assemble_context(candidates, hits, feedbacks, context_budget, memory_summary, feedback_style)
+        return {"question": q, "context": built["context"], "feedbacks": built["feedbacks"],
+                "feedback_style": built["feedback_style"], "context_tokens": built["tokens"], "vector": vector,
+                "cache_key": cache_key}
+
+    pending = []
+    for q, vector, hits in zip(unique, vectors, memory_hits):
+        cache_key = private_key if hits or memory_summary else shared_key
+        hit = nodes.lookup_cached_answer(shared_key, private_key, q, vector, hits, memory_summary)
+        cache_requests.inc(cache="answer", result="miss" if hit is None else "hit")
+        if hit is None:
+            pending.append(prepare(q, vector, hits, cache_key))
+            continue
+        entry, _ = hit
+        if write_memory:
+            await asyncio.to_thread(append_session, session_id, "user", q)
+            await asyncio.to_thread(append_session, session_id, "assistant", entry["answer"])
+        for r in result(q, answer=entry["answer"], context=entry["context"], context_tokens=None, cached=True):
+            yield r
+
+    prepared = await asyncio.gather(*pending)
+    inputs = [[HumanMessage(content=make_prompt(p))] for p in prepared]
+    config = {"max_concurrency": max_concurrency, "metadata": {"llm_priority": "batch", "session_id": session_id}}
+    async for i, resp in nodes.llm.abatch_as_completed(inputs, config=config, return_exceptions=True):
+        p = prepared[i]
+        if isinstance(resp, Exception):
+            for r in result(p["question"], error=str(resp)):
+                yield r
+            continue
+        answer = resp.content
+        nodes.answer_cache.store(p["cache_key"], p["vector"], answer, p["context"])
+        if write_memory:
+            await asyncio.to_thread(append_session, session_id, "user", p["question"])
+            await asyncio.to_thread(append_session, session_id, "assistant", answer)
+        for r in result(p["question"], answer=answer, context=p["context"], context_tokens=p["context_tokens"],
+                        cached=False):
+            yield r
+    if write_memory:
+        memory_compactor.schedule(session_id, nodes.summarize_history)
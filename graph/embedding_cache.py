@@ -0,0 +1,203 @@
+import os, time, sqlite3, hashlib, threading, asyncio
+from array import array
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional, Union
+
+from langchain_core.embeddings import Embeddings
+
+_LOOKUP_BATCH = 500
+
+
+def _text_key(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class CachedEmbeddings(Embeddings):
+    """
+    跨 session 持久化的向量缓存, 以 (embedding 模型, 文本hash) 为 key 存于 SQLite
+    相同的 chunk 在整个部署内只向量化一次, 超出容量时按最近使用时间淘汰
+    问题(query)向量只进入进程内的 LRU, 不写入 SQLite, 以免一次性的问题挤掉 chunk 向量
+    """
+
+    def __init__(self, embeddings: Union[Embeddings, Callable[[], Embeddings]], model_name: str, db_path: str,
+                 max_bytes: int, query_cache_size: int = 0):
+        self._embeddings = embeddings  # 也可以是工厂函数, 首次向量化时才构造实际模型
+        self.model_name = model_name
+        self.db_path = db_path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._conn: Optional[sqlite3.Connection] = None
+        self._total_bytes = 0
+        self.query_cache_size = query_cache_size
+        self._queries: "OrderedDict[str, List[float]]" = OrderedDict()
+        self.query_hits = 0
+        self.query_misses = 0
+
+    @property
+    def embeddings(self) -> Embeddings:
+        if not isinstance(self._embeddings, Embeddings):
+            self._embeddings = self._embeddings()
+        return self._embeddings
+
+    @embeddings.setter
+    def embeddings(self, value: Embeddings):
+        self._embeddings = value
+
+    def _db(self) -> sqlite3.Connection:
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.db_path) or ".", exist_ok=True)
+            conn = sqlite3.connect(self.db_path, check_same_thread=False, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS embeddings (
+                    model TEXT NOT NULL,
+                    key TEXT NOT NULL,
+                    vec BLOB NOT NULL,
+                    last_used REAL NOT NULL,
+                    PRIMARY KEY (model, key)
+                )""")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_embeddings_last_used ON embeddings(last_used)")
+            self._total_bytes = conn.execute("SELECT COALESCE(SUM(LENGTH(vec)), 0) FROM embeddings").fetchone()[0]
+            self._conn = conn
+        return self._conn
+
+    def _lookup(self, keys: List[str]) -> Dict[str, List[float]]:
+        found = {}
+        now = time.time()
+        with self._lock:
+            db = self._db()
+            for i in range(0, len(keys), _LOOKUP_BATCH):
+                batch = keys[i:i + _LOOKUP_BATCH]
+                rows = db.execute(
+                    f"SELECT key, vec FROM embeddings WHERE model=? AND key IN ({','.join('?' * len(batch))})",
+                    [self.model_name, *batch]).fetchall()
+                for key, blob in rows:
+                    vec = array("f")
+                    vec.frombytes(blob)
+                    found[key] = vec.tolist()
+            if found:
+                db.executemany("UPDATE embeddings SET last_used=? WHERE model=? AND key=?",
+                               [(now, self.model_name, k) for k in found])
+                db.commit()
+        return found
+
+    def _store(self, items: Dict[str, List[float]]):
+        now = time.time()
+        rows = [(self.model_name, k, array("f", v).tobytes(), now) for k, v in items.items()]
+        with self._lock:
+            db = self._db()
+            db.executemany("INSERT OR REPLACE INTO embeddings(model, key, vec, last_used) VALUES (?, ?, ?, ?)", rows)
+            self._total_bytes += sum(len(r[2]) for r in rows)
+            if self._total_bytes > self.max_bytes:
+                self._evict(db)
+            db.commit()
+
+    def _evict(self, db: sqlite3.Connection):
+        """淘汰到容量的 90%, 避免每次写入都触发淘汰"""
+        target = int(self.max_bytes * 0.9)
+        while self._total_bytes > target:
+            rows = db.execute(
+                "SELECT rowid, LENGTH(vec) FROM embeddings ORDER BY last_used LIMIT ?", (_LOOKUP_BATCH,)).fetchall()
+            if not rows:
+                self._total_bytes = 0
+                break
+            freed = 0
+            for rowid, size in rows:
+                if self._total_bytes - freed <= target:
+                    break
+                db.execute("DELETE FROM embeddings WHERE rowid=?", (rowid,))
+                freed += size
+                self.evictions += 1
+            self._total_bytes -= freed
+
+    def _split(self, texts: List[str]):
+        keys = [_text_key(t) for t in texts]
+        cached = self._lookup(list(set(keys)))
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in cached:
+                missing.setdefault(key, text)
+        self.hits += len(texts) - sum(1 for k in keys if k in missing)
+        self.misses += sum(1 for k in keys if k in missing)
+        return keys, cached, missing
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        keys, cached, missing = self._split(texts)
+        if missing:
+            vectors = self.embeddings.embed_documents(list(missing.values()))
+            new = dict(zip(missing.keys(), vectors))
+            self._store(new)
+            cached.update(new)
+        return [cached[k] for k in keys]
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        keys, cached, missing = await asyncio.to_thread(self._split, texts)
+        if missing:
+            vectors = await self.embeddings.aembed_documents(list(missing.values()))
+            new = dict(zip(missing.keys(), vectors))
+            await asyncio.to_thread(self._store, new)
+            cached.update(new)
+        return [cached[k] for k in keys]
+
+    def _remember_queries(self, items: Dict[str, List[float]]):
+        with self._lock:
+            for key, vec in items.items():
+                self._queries[key] = vec
+                self._queries.move_to_end(key)
+            while len(self._queries) > self.query_cache_size:
+                self._queries.popitem(last=False)
+
+    def _split_queries(self, texts: List[str]):
+        keys = [_text_key(t) for t in texts]
+        cached, missing = {}, {}
+        with self._lock:
+            for key, text in zip(keys, texts):
+                if key in self._queries:
+                    self._queries.move_to_end(key)
+                    cached[key] = self._queries[key]
+                else:
+                    missing.setdefault(key, text)
+        self.query_hits += len(texts) - sum(1 for k in keys if k in missing)
+        self.query_misses += sum(1 for k in keys if k in missing)
+        return keys, cached, missing
+
+    def embed_queries(self, texts: List[str]) -> List[List[float]]:
+        keys, cached, missing = self._split_queries(texts)
+        if missing:
+            new = dict(zip(missing.keys(), self.embeddings.embed_documents(list(missing.values()))))
+            self._remember_queries(new)
+            cached.update(new)
+        return [cached[k] for k in keys]
+
+    async def aembed_queries(self, texts: List[str]) -> List[List[float]]:
+        """批量向量化问题: 只查询/写入进程内 LRU"""
+        keys, cached, missing = self._split_queries(texts)
+        if missing:
+            new = dict(zip(missing.keys(), await self.embeddings.aembed_documents(list(missing.values()))))
+            self._remember_queries(new)
+            cached.update(new)
+        return [cached[k] for k in keys]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_queries([text])[0]
+
+    async def aembed_query(self, text: str) -> List[float]:
+        return (await self.aembed_queries([text]))[0]
+
+    def stats(self) -> Dict:
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 4) if total else 0.0,
+            "evictions": self.evictions,
+            "bytes": self._total_bytes,
+            "max_bytes": self.max_bytes,
+            "query_hits": self.query_hits,
+            "query_misses": self.query_misses,
+            "query_entries": len(self._queries),
+        }
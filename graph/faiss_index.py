@@ -0,0 +1,230 @@
+import sys, time, math
+from typing import Callable, Dict, List, Optional, Tuple
+
+import faiss
+import numpy as np
+
+from config import (
+    faiss_index_type, faiss_auto_thresholds, faiss_nlist, faiss_pq_m, faiss_hnsw_m, faiss_train_size,
+    faiss_nprobe, faiss_ef_search, faiss_vector_dtype, faiss_retrain_ratio)
+
+INDEX_TYPES = ("flat", "ivf", "hnsw", "ivfpq", "sq8")
+# flat / hnsw / ivf 存储向量时的量化方式
+_VECTOR_CODECS = {"float32": "Flat", "float16": "SQfp16", "int8": "SQ8"}
+
+
+def choose_index_type(n: int, index_type: str = faiss_index_type) -> str:
+    """index_type 为 auto 时按 chunk 数选择: 小库精确检索, 中等规模用 HNSW, 大库用 IVF-PQ 压缩内存"""
+    if index_type != "auto":
+        if index_type not in INDEX_TYPES:
+            raise ValueError(f"不支持的索引类型: {index_type}")
+        return index_type
+    if n < faiss_auto_thresholds["hnsw"]:
+        return "flat"
+    if n < faiss_auto_thresholds["ivfpq"]:
+        return "hnsw"
+    return "ivfpq"
+
+
+def _nlist(n: int) -> int:
+    """聚类中心数: 默认约 4·√n, 且保证每个中心至少有 39 个训练样本"""
+    nlist = faiss_nlist or int(4 * math.sqrt(n))
+    return max(1, min(nlist, n // 39))
+
+
+def _pq_m(d: int) -> int:
+    """PQ 子空间数必须整除维度, 默认取不超过 d/8 的最大约数"""
+    if faiss_pq_m and d % faiss_pq_m == 0:
+        return faiss_pq_m
+    return max(m for m in range(1, max(1, d // 8) + 1) if d % m == 0)
+
+
+def factory_string(index_type: str, n: int, d: int, vector_dtype: Optional[str] = None) -> str:
+    codec = _VECTOR_CODECS[vector_dtype or faiss_vector_dtype]
+    if index_type == "flat":
+        return codec
+    if index_type == "hnsw":
+        return f"HNSW{faiss_hnsw_m}" + ("" if codec == "Flat" else f",{codec}")
+    nlist = _nlist(n)
+    if index_type == "ivf":
+        return f"IVF{nlist},{codec}"
+    if index_type == "ivfpq":
+        return f"IVF{nlist},PQ{_pq_m(d)}"
+    return f"IVF{nlist},SQ8"
+
+
+def set_search_params(index, nprobe: int = faiss_nprobe, ef_search: int = faiss_ef_search):
+    """设置查询参数, 索引不支持的参数直接忽略"""
+    params = faiss.ParameterSpace()
+    for name, value in (("nprobe", nprobe), ("efSearch", ef_search)):
+        try:
+            params.set_index_parameter(index, name, value)
+        except Exception:
+            pass
+    return index
+
+
+def resolve_index_type(n: int, index_type: Optional[str] = None) -> str:
+    """n 个向量时实际构建的类型: 在 choose_index_type 的基础上, 样本不足以训练时退回更简单的类型"""
+    index_type = choose_index_type(n, index_type or faiss_index_type)
+    # 样本太少无法训练聚类时退回精确检索
+    if index_type in ("ivf", "ivfpq", "sq8") and n < 39 * 2:
+        index_type = "flat"
+    # PQ 每个子空间 256 个中心, 至少需要 39*256 个训练样本
+    if index_type == "ivfpq" and n < 39 * 256:
+        index_type = "sq8"
+    return index_type
+
+
+def needs_retrain(index_type: str, trained_on: int, n: int, ratio: float = faiss_retrain_ratio) -> bool:
+    """规模相对上次训练变化超过 ratio 倍, 或按当前规模应当使用另一种类型时需要重新构建"""
+    if resolve_index_type(n) != index_type:
+        return True
+    return n > trained_on * ratio or n * ratio < trained_on
+
+
+def update_index(index, new_vectors: np.ndarray, removed: Optional[np.ndarray] = None,
+                 remaining: Optional[Callable[[], np.ndarray]] = None):
+    """
+    在已训练的索引上增量更新(调用方传入副本), 更新后向量位置仍与 chunk 下标一一对应:
+    - 删除: flat 编码用 remove_ids 压缩位置; IVF 清空后沿用聚类中心重新加入剩余向量;
+      HNSW 不支持删除, 用剩余向量重建图
+    - 新增: 追加到末尾
+    removed: 要删除的位置; remaining: 返回删除后剩余的全部向量, 只在需要时调用
+    """
+    if removed is not None and len(removed):
+        if faiss.try_extract_index_ivf(index) is not None:
+            index.reset()
+            index.add(remaining())
+        elif getattr(faiss.downcast_index(index), "hnsw", None) is not None:
+            index, _ = build_index(remaining(), "hnsw")
+        else:
+            index.remove_ids(np.asarray(removed, dtype=np.int64))
+    if len(new_vectors):
+        index.add(np.ascontiguousarray(new_vectors, dtype=np.float32))
+    return set_search_params(index)
+
+
+def build_index(vectors: np.ndarray, index_type: Optional[str] = None,
+                train_size: int = faiss_train_size) -> Tuple[object, str]:
+    """
+    按类型构建索引, 返回 (索引, 实际类型); 向量顺序即索引内的位置(与 docstore 的映射保持一致)
+    需要训练的类型只用随机抽样的一部分向量训练
+    """
+    vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+    n, d = vectors.shape
+    index_type = resolve_index_type(n, index_type)
+    index = faiss.index_factory(d, factory_string(index_type, n, d), faiss.METRIC_L2)
+    if not index.is_trained:
+        sample = vectors
+        if n > train_size:
+            rng = np.random.default_rng(0)
+            sample = vectors[rng.choice(n, train_size, replace=False)]
+        index.train(sample)
+    index.add(vectors)
+    return set_search_params(index), index_type
+
+
+def flat_codes(index):
+    """按编码顺序存放向量的部分(IndexFlatCodes: flat / SQ 本身, 或 HNSW 的向量存储), 没有时返回 None"""
+    index = faiss.downcast_index(index)
+    storage = getattr(index, "storage", None)
+    if storage is not None:
+        index = faiss.downcast_index(storage)
+    return index if isinstance(index, faiss.IndexFlatCodes) else None
+
+
+def index_bytes(index) -> int:
+    """估算索引常驻内存: 按编码长度计算, IVF 额外计入聚类中心和 id, HNSW 额外计入图的邻接表"""
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None:
+        return ivf.ntotal * (ivf.code_size + 8) + ivf.nlist * ivf.d * 4
+    codes = flat_codes(index)
+    code_bytes = index.ntotal * (codes.code_size if codes is not None else index.d * 4)
+    hnsw = getattr(faiss.downcast_index(index), "hnsw", None)
+    if hnsw is not None:
+        return code_bytes + index.ntotal * hnsw.nb_neighbors(0) * 4 * 2
+    return code_bytes
+
+
+def flat_vectors(index) -> np.ndarray:
+    """从精确索引中取出全部原始向量"""
+    if index.ntotal == 0:
+        return np.zeros((0, index.d), dtype=np.float32)
+    return index.reconstruct_n(0, index.ntotal)
+
+
+def benchmark(vectors: np.ndarray, queries: np.ndarray, k: int = 10,
+              configs: Optional[List[Dict]] = None) -> List[Dict]:
+    """
+    召回率-延迟对比: 以精确检索结果为基准, 统计各配置的 recall@k、单次查询延迟与索引大小
+    configs: [{"type": ..., "nprobe": ..., "ef_search": ...}], 默认覆盖全部类型和几档查询参数
+    """
+    vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+    queries = np.ascontiguousarray(queries, dtype=np.float32)
+    exact = faiss.IndexFlatL2(vectors.shape[1])
+    exact.add(vectors)
+    _, truth = exact.search(queries, k)
+
+    if configs is None:
+        configs = [{"type": "flat"}]
+        configs += [{"type": "hnsw", "ef_search": ef} for ef in (16, 64, 256)]
+        for t in ("ivf", "sq8", "ivfpq"):
+            configs += [{"type": t, "nprobe": p} for p in (1, 8, 32)]
+
+    built: Dict[str, tuple] = {}
+    report = []
+    for cfg in configs:
+        t = cfg["type"]
+        if t not in built:
+            start = time.perf_counter()
+            index, actual = build_index(vectors, t)
+            built[t] = (index, actual, time.perf_counter() - start, len(faiss.serialize_index(index)))
+        index, actual, build_s, size = built[t]
+        set_search_params(index, cfg.get("nprobe", faiss_nprobe), cfg.get("ef_search", faiss_ef_search))
+        latencies = []
+        found = 0
+        for i in range(len(queries)):
+            start = time.perf_counter()
+            _, ids = index.search(queries[i:i + 1], k)
+            latencies.append(time.perf_counter() - start)
+            found += len(set(ids[0]) & set(truth[i]))
+        latencies.sort()
+        report.append({
+            **cfg,
+            "built_as": actual,  # 数据量不足以训练时会退回更简单的类型
+            "recall": round(found / (len(queries) * k), 4),
+            "p50_ms": round(latencies[len(latencies) // 2] * 1000, 3),
+            "p95_ms": round(latencies[int(len(latencies) * 0.95) - 1] * 1000, 3),
+            "build_s": round(build_s, 3),
+            "bytes": size,
+        })
+    return report
+
+
+def format_report(report: List[Dict]) -> str:
+    lines = [f"{'type':<6} {'built':<6} {'nprobe':>6} {'efSearch':>8} {'recall':>7} {'p50_ms':>8} {'p95_ms':>8} "
+             f"{'build_s':>8} {'bytes':>12}"]
+    for r in report:
+        lines.append(f"{r['type']:<6} {r['built_as']:<6} {r.get('nprobe', '-'):>6} {r.get('ef_search', '-'):>8} {r['recall']:>7} "
+                     f"{r['p50_ms']:>8} {r['p95_ms']:>8} {r['build_s']:>8} {r['bytes']:>12}")
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    # python -m graph.faiss_index <session_id> [查询数] [k]
+    # 用 session 已入库的向量做对比, 查询向量从库中抽样并加入少量噪声
+    from .index_manager import read_exact_index
+
+    session_id = sys.argv[1]
+    n_queries = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    k = int(sys.argv[3]) if len(sys.argv) > 3 else 10
+    index = read_exact_index(session_id)
+    if index is None or index.ntotal == 0:
+        sys.exit(f"session {session_id} 没有向量索引")
+    vectors = flat_vectors(index)
+    rng = np.random.default_rng(0)
+    queries = vectors[rng.choice(len(vectors), min(n_queries, len(vectors)), replace=False)]
+    queries = queries + rng.normal(0, queries.std() * 0.1, queries.shape).astype(np.float32)
+    print(f"chunks={len(vectors)} dim={vectors.shape[1]} queries={len(queries)} k={k}")
+    print(format_report(benchmark(vectors, queries, k)))
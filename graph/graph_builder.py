@@ -3,10 +3,10 @@ from typing import Dict
 from langgraph.graph import StateGraph, START, END
 from .state_schema import InsightState
 from .nodes import (
-    load_documents, build_vector_index, memory_read,
-    retrieve_context, generate_answer, infer_intent,
+    wait_ingest, memory_read,
+    retrieve_context, generate_answer, dispatch_intent,
     memory_write, record_satisfied, record_unsatisfied,
-    feedback_read, summary_answer
+    feedback_read, summary_answer, lookup_answer_cache, route_after_cache
 )
 
 
@@ -16,18 +16,18 @@ def decide_where_start(state: Dict) -> str:
         return "record_satisfied"
     elif state.get("satisfied") is False:
         return "record_unsatisfied"
-    return "load_docs"
+    return "wait_ingest"
 
 
 def build_graph():
     graph = StateGraph(InsightState)
 
-    graph.add_node("load_docs", load_documents)
-    graph.add_node("build_index", build_vector_index)
+    graph.add_node("wait_ingest", wait_ingest)  # 文档解析和索引由 /upload 触发的后台任务完成
     graph.add_node("mem_read", memory_read)
+    graph.add_node("answer_cache", lookup_answer_cache)  # 语义回答缓存, 命中时跳过检索与生成
     graph.add_node("retrieve", retrieve_context)
     graph.add_node("answer", generate_answer)
-    graph.add_node("infer", infer_intent)
+    graph.add_node("dispatch_intent", dispatch_intent)  # 意图推断在后台执行, 不在回答的关键路径上
     # graph.add_node("suggest", suggest_action)
     graph.add_node("mem_write", memory_write)
     graph.add_node("record_satisfied", record_satisfied)  # 保存反馈意见的节点
@@ -39,19 +39,26 @@ def build_graph():
         START,
         decide_where_start,
         {
-            "load_docs": "load_docs",
+            "wait_ingest": "wait_ingest",
             "record_satisfied": "record_satisfied",
             "record_unsatisfied": "record_unsatisfied"
         }
     )
-    graph.add_edge("load_docs", "build_index")
     graph.add_edge("record_unsatisfied", "feedback_read")  # 不满意需要重新生成
-    graph.add_edge("build_index", "feedback_read")
+    graph.add_edge("wait_ingest", "feedback_read")
     graph.add_edge("feedback_read", "mem_read")  
-    graph.add_edge("mem_read", "retrieve")
+    graph.add_edge("mem_read", "answer_cache")
+    graph.add_conditional_edges(
+        "answer_cache",
+        route_after_cache,
+        {
+            "retrieve": "retrieve",
+            "dispatch_intent": "dispatch_intent"
+        }
+    )
     graph.add_edge("retrieve", "answer")
-    graph.add_edge("answer", "infer")
-    graph.add_edge("infer", "mem_write")
+    graph.add_edge("answer", "dispatch_intent")
+    graph.add_edge("dispatch_intent", "mem_write")
     graph.add_edge("mem_write", "summary_answer")
     graph.add_edge("record_satisfied", "summary_answer")
     graph.add_edge("summary_answer", END)
@@ -0,0 +1,682 @@
+import os, copy, json, time, hashlib, shutil, threading, asyncio, pickle, itertools
+import multiprocessing
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Callable, Dict, List, Optional, Tuple
+
+import faiss
+import numpy as np
+from langchain_text_splitters import RecursiveCharacterTextSplitter
+
+from config import (
+    vectorstore_cache_bytes, embed_batch_size, embed_max_in_flight, embed_retries, embed_retry_backoff,
+    parse_workers, faiss_vector_dtype)
+from utils.agent_utils import parse_file_segments
+from utils.text_search import BM25Index
+from utils.metrics import registry, stats_collector
+from .faiss_index import build_index, flat_vectors, needs_retrain, update_index
+from .index_store import (
+    SessionIndex, KeywordIndex, ChunkStore, DiskBM25, write_chunk_store, write_bm25, read_index,
+    EXACT_INDEX_FILE, SEARCH_INDEX_FILE, BM25_META_FILE)
+
+try:
+    import fcntl
+except ImportError:  # Windows 下只使用进程内的锁
+    fcntl = None
+
+UPLOAD_DIR = "data/uploaded_files"
+VS_DIR = "data/vectorstore"
+PARSED_DIR = "data/parsed_cache"
+SUPPORTED_EXTS = (".txt", ".md", ".pdf", ".docx", ".xlsx", ".xls", ".csv")
+
+_parse_pool: Optional[ProcessPoolExecutor] = None
+_parse_pool_lock = threading.Lock()
+
+# 已解析的清单, 按文件 (inode, mtime, size) 判断是否失效
+_MANIFEST_CACHE_SIZE = 1024
+_manifests: "OrderedDict[str, Tuple[Tuple[int, int, int], Dict]]" = OrderedDict()
+_manifests_lock = threading.Lock()
+
+
+def upload_path(session_id: str) -> str:
+    return os.path.join(UPLOAD_DIR, session_id)
+
+
+def vs_path(session_id: str) -> str:
+    return os.path.join(VS_DIR, f"{session_id}_faiss")
+
+
+def index_dir(session_id: str, version: int) -> str:
+    """每个索引版本写入独立目录, 正在被 mmap 读取的旧版本文件不会被覆盖"""
+    return os.path.join(vs_path(session_id), f"v{version}")
+
+
+def _manifest_path(session_id: str) -> str:
+    return os.path.join(VS_DIR, f"{session_id}_manifest.json")
+
+
+def _upgrade_manifest(manifest: Dict) -> Dict:
+    """旧版清单为每个文件记录全部 chunk id, 转换为 chunk 数(id 可由内容hash推出)"""
+    for e in manifest.get("files", {}).values():
+        if "chunk_ids" in e:
+            e["chunks"] = len(e.pop("chunk_ids"))
+    return manifest
+
+
+def _read_manifest(session_id: str) -> Dict:
+    """文件未变化时直接返回缓存的解析结果, 返回值只读"""
+    path = _manifest_path(session_id)
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return {"version": 0, "files": {}}
+    key = (st.st_ino, st.st_mtime_ns, st.st_size)
+    with _manifests_lock:
+        cached = _manifests.get(session_id)
+        if cached and cached[0] == key:
+            _manifests.move_to_end(session_id)
+            return cached[1]
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            manifest = _upgrade_manifest(json.load(f))
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {"version": 0, "files": {}}
+    with _manifests_lock:
+        _manifests[session_id] = (key, manifest)
+        _manifests.move_to_end(session_id)
+        while len(_manifests) > _MANIFEST_CACHE_SIZE:
+            _manifests.popitem(last=False)
+    return manifest
+
+
+def load_manifest(session_id: str) -> Dict:
+    """
+    读取 session 的索引清单, 返回副本:
+    {"version": int, "files": {文件名: {size, mtime, hash, chunks}}}
+    """
+    return copy.deepcopy(_read_manifest(session_id))
+
+
+def save_manifest(session_id: str, manifest: Dict):
+    """先写临时文件再替换, 避免写一半的清单"""
+    os.makedirs(VS_DIR, exist_ok=True)
+    path = _manifest_path(session_id)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    os.replace(tmp, path)
+
+
+def _uploads_path(session_id: str) -> str:
+    return os.path.join(VS_DIR, f"{session_id}_uploads.json")
+
+
+def remember_upload(session_id: str, fn: str, digest: str):
+    """
+    记录上传时边写边算出的内容hash, 入库时 size/mtime 对得上就不必再读一遍文件
+    与清单分开存放, 避免和入库任务互相覆盖
+    """
+    st = os.stat(os.path.join(upload_path(session_id), fn))
+    uploads = _load_uploads(session_id)
+    uploads[fn] = {"size": st.st_size, "mtime": st.st_mtime, "hash": digest}
+    os.makedirs(VS_DIR, exist_ok=True)
+    path = _uploads_path(session_id)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(uploads, f, ensure_ascii=False)
+    os.replace(tmp, path)
+
+
+def _load_uploads(session_id: str) -> Dict:
+    path = _uploads_path(session_id)
+    if os.path.exists(path):
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except json.JSONDecodeError:
+            pass
+    return {}
+
+
+def corpus_key(session_id: str) -> str:
+    """
+    session 文档集合的版本标识: 由全部文件内容hash决定, 内容相同的不同 session 得到相同的值
+    没有上传文档的 session 各自独立, 不与其他 session 共享
+    """
+    files = _read_manifest(session_id).get("files", {})
+    if not files:
+        return hashlib.sha256(f"session:{session_id}".encode("utf-8")).hexdigest()[:16]
+    hashes = sorted({e["hash"] for e in files.values()})
+    return hashlib.sha256("\n".join(hashes).encode("utf-8")).hexdigest()[:16]
+
+
+def file_sha256(path: str, block_size: int = 1 << 20) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def _get_parse_pool() -> ProcessPoolExecutor:
+    """PyPDF2/pandas 解析是 CPU 密集且持有 GIL 的, 放到独立进程中执行"""
+    global _parse_pool
+    if _parse_pool is None:
+        with _parse_pool_lock:
+            if _parse_pool is None:
+                _parse_pool = ProcessPoolExecutor(max_workers=parse_workers,
+                                                  mp_context=multiprocessing.get_context("spawn"))
+    return _parse_pool
+
+
+def _reset_parse_pool(pool: ProcessPoolExecutor):
+    """子进程崩溃(如被 OOM kill)后进程池不可再用, 丢弃它, 下次使用时重新创建"""
+    global _parse_pool
+    with _parse_pool_lock:
+        if _parse_pool is pool:
+            _parse_pool = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+def _parsed_cache_path(digest: str) -> str:
+    return os.path.join(PARSED_DIR, f"{digest}.json")
+
+
+def _load_parsed(digest: str) -> Optional[List[Dict]]:
+    path = _parsed_cache_path(digest)
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except json.JSONDecodeError:
+        return None
+
+
+def _save_parsed(digest: str, segments: List[Dict]):
+    os.makedirs(PARSED_DIR, exist_ok=True)
+    path = _parsed_cache_path(digest)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(segments, f, ensure_ascii=False)
+    os.replace(tmp, path)
+
+
+async def parse_document(session_id: str, fn: str, digest: str) -> List[Dict]:
+    """
+    解析上传文件为文本片段, 结果按内容hash缓存, 同一内容只解析一次
+    解析子进程崩溃时重建进程池并重试一次, 仍失败则抛出 BrokenProcessPool
+    """
+    segments = await asyncio.to_thread(_load_parsed, digest)
+    if segments is not None:
+        return segments
+    loop = asyncio.get_running_loop()
+    path = os.path.join(upload_path(session_id), fn)
+    pool = _get_parse_pool()
+    try:
+        segments = await loop.run_in_executor(pool, parse_file_segments, path)
+    except BrokenProcessPool:
+        # 同一进程池中并发解析的文件会一起失败, 换掉进程池后在单独的进程中重试一次,
+        # 再次崩溃时可以确定是该文件导致的, 只有它入库失败
+        _reset_parse_pool(pool)
+        single = ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn"))
+        try:
+            segments = await loop.run_in_executor(single, parse_file_segments, path)
+        finally:
+            single.shutdown(wait=False)
+    await asyncio.to_thread(_save_parsed, digest, segments)
+    return segments
+
+
+def _chunk_ids(digest: str, count: int) -> List[str]:
+    """chunk id 由内容hash和序号决定, 相同内容的文件共享同一组向量; 清单中只记录 chunk 数"""
+    return [f"{digest[:16]}-{i}" for i in range(count)]
+
+
+@asynccontextmanager
+async def index_update_lock(session_id: str):
+    """
+    同一 session 的 计划 -> 向量化 -> 写入新版本 跨 uvicorn worker 串行, 用文件锁实现
+    进程内的串行由 IngestManager 的 session 锁保证
+    """
+    os.makedirs(VS_DIR, exist_ok=True)
+    f = open(os.path.join(VS_DIR, f"{session_id}.lock"), "ab")
+    try:
+        if fcntl:
+            await asyncio.to_thread(fcntl.flock, f.fileno(), fcntl.LOCK_EX)
+        yield
+    finally:
+        f.close()  # 关闭文件即释放锁
+
+
+def plan_index_update(session_id: str) -> Dict:
+    """
+    对比上传目录与清单, 得到增量更新计划, 调用方需持有 index_update_lock(旧格式索引在这里迁移):
+    - size/mtime 未变的文件直接跳过, 不读取也不计算hash
+    - 新增/修改的文件只有在内容hash未被索引过时才需要向量化
+    - 已删除或被修改的文件, 其旧hash不再被任何文件引用时删除对应向量
+    """
+    manifest = load_manifest(session_id)
+    if current_index_dir(session_id) is None and _has_legacy_index(session_id):
+        _migrate_legacy_index(session_id, index_dir(session_id, manifest.get("version", 0)))
+    # 清单存在但索引目录丢失时, 按全量重建处理
+    old_files = manifest.get("files", {}) if current_index_dir(session_id) else {}
+    rebuild = not old_files
+
+    uploads = _load_uploads(session_id)
+    files = {}
+    data_dir = upload_path(session_id)
+    if os.path.exists(data_dir):
+        for fn in sorted(os.listdir(data_dir)):
+            if not fn.lower().endswith(SUPPORTED_EXTS):
+                continue
+            st = os.stat(os.path.join(data_dir, fn))
+            prev = old_files.get(fn)
+            if prev and prev["size"] == st.st_size and prev["mtime"] == st.st_mtime:
+                files[fn] = prev
+                continue
+            known = uploads.get(fn)
+            if known and known["size"] == st.st_size and known["mtime"] == st.st_mtime:
+                digest = known["hash"]
+            else:
+                digest = file_sha256(os.path.join(data_dir, fn))
+            files[fn] = {"size": st.st_size, "mtime": st.st_mtime, "hash": digest,
+                         "chunks": prev["chunks"] if prev and prev["hash"] == digest else 0}
+
+    indexed = {}
+    for e in old_files.values():
+        indexed.setdefault(e["hash"], e["chunks"])
+    wanted = {e["hash"] for e in files.values()}
+
+    to_embed = {}
+    for fn, e in files.items():
+        if e["hash"] in indexed:
+            e["chunks"] = indexed[e["hash"]]
+        else:
+            to_embed.setdefault(e["hash"], fn)
+
+    delete_ids = []
+    for digest, count in indexed.items():
+        if digest not in wanted:
+            delete_ids.extend(_chunk_ids(digest, count))
+
+    return {
+        "version": manifest.get("version", 0),
+        "files": files,
+        "to_embed": list(to_embed.values()),
+        "delete_ids": delete_ids,
+        "removed": [fn for fn in old_files if fn not in files],
+        "rebuild": rebuild,
+    }
+
+
+def _has_legacy_index(session_id: str) -> bool:
+    return os.path.exists(os.path.join(vs_path(session_id), "index.pkl"))
+
+
+def _load_legacy_index(session_id: str) -> Tuple[object, List[Dict]]:
+    """
+    读取 LangChain 格式的旧版索引(index.faiss + index.pkl), 返回 (faiss 索引, chunk 记录)
+    pickle 文件由本服务自己写出
+    """
+    base = vs_path(session_id)
+    with open(os.path.join(base, "index.pkl"), "rb") as f:
+        docstore, index_to_docstore_id = pickle.load(f)
+    records = []
+    for pos in range(len(index_to_docstore_id)):
+        doc_id = index_to_docstore_id[pos]
+        doc = docstore.search(doc_id)
+        records.append({"id": doc_id, "text": doc.page_content, "metadata": doc.metadata})
+    return faiss.read_index(os.path.join(base, "index.faiss")), records
+
+
+def _migrate_legacy_index(session_id: str, target: str):
+    """旧版索引转换为 chunk 文件 + 精确索引的格式, 迁移完成后删除旧文件; 调用方需持有 index_update_lock"""
+    index, records = _load_legacy_index(session_id)
+    update = _IndexUpdate()
+    update.add(0, flat_vectors(index))
+    _write_index_files(target, update, records)
+    vectorstore_cache.invalidate(session_id)
+    base = vs_path(session_id)
+    for name in ("index.faiss", "index.pkl", SEARCH_INDEX_FILE):
+        path = os.path.join(base, name)
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def current_index_dir(session_id: str) -> Optional[str]:
+    """当前版本的索引目录, 不存在(包括旧格式索引尚未迁移)时返回 None"""
+    version = _read_manifest(session_id).get("version", 0)
+    directory = index_dir(session_id, version)
+    return directory if os.path.exists(os.path.join(directory, EXACT_INDEX_FILE)) else None
+
+
+class VectorStoreCache:
+    """
+    进程内已打开索引的 LRU 缓存, 每项为 (SessionIndex, BM25 索引)
+    key 为 (session_id, 索引版本), 按估算的常驻内存在字节预算内淘汰
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.entries: "OrderedDict[Tuple[str, int], Tuple[Tuple[SessionIndex, KeywordIndex], int]]" = OrderedDict()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def estimate_bytes(index: SessionIndex, bm25: KeywordIndex) -> int:
+        """
+        chunk 文本、mmap 的向量和写入时保存的倒排表在页缓存中, 只计未映射的索引部分
+        旧版本目录在内存中构建的倒排表按每项约 100 字节估算
+        """
+        postings = sum(len(p) for p in bm25.postings.values()) * 100 if isinstance(bm25, BM25Index) else 0
+        return index.resident_bytes() + postings
+
+    def get(self, session_id: str, version: int) -> Optional[Tuple[SessionIndex, KeywordIndex]]:
+        with self._lock:
+            entry = self.entries.get((session_id, version))
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end((session_id, version))
+            self.hits += 1
+            return entry[0]
+
+    def put(self, session_id: str, version: int, index: SessionIndex) -> Tuple[SessionIndex, KeywordIndex]:
+        entry = (index, index.keyword_index())
+        size = self.estimate_bytes(*entry)
+        with self._lock:
+            self._drop_session(session_id)
+            if size > self.max_bytes:
+                return entry
+            self.entries[(session_id, version)] = (entry, size)
+            self.total_bytes += size
+            while self.total_bytes > self.max_bytes:
+                _, (_, evicted) = self.entries.popitem(last=False)
+                self.total_bytes -= evicted
+                self.evictions += 1
+        return entry
+
+    def invalidate(self, session_id: str):
+        with self._lock:
+            self._drop_session(session_id)
+
+    def _drop_session(self, session_id: str):
+        for key in [k for k in self.entries if k[0] == session_id]:
+            self.total_bytes -= self.entries.pop(key)[1]
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": len(self.entries),
+                "bytes": self.total_bytes,
+                "max_bytes": self.max_bytes,
+            }
+
+
+vectorstore_cache = VectorStoreCache(vectorstore_cache_bytes)
+registry.register_collector(stats_collector("vectorstore_cache", vectorstore_cache.stats))
+
+
+def read_exact_index(session_id: str):
+    """读取 session 的精确索引(float32), 不存在时返回 None"""
+    directory = current_index_dir(session_id)
+    return read_index(os.path.join(directory, EXACT_INDEX_FILE)) if directory else None
+
+
+def get_session_index(session_id: str) -> Optional[Tuple[SessionIndex, KeywordIndex]]:
+    """
+    优先从缓存获取当前版本的 (向量索引, BM25 索引), 未命中时从磁盘以 mmap 方式打开
+    读路径不持有 index_update_lock, 旧格式索引只读加载到内存, 迁移留给下一次入库(plan_index_update)
+    """
+    manifest = _read_manifest(session_id)
+    version = manifest.get("version", 0)
+    entry = vectorstore_cache.get(session_id, version)
+    if entry is not None:
+        return entry
+    directory = current_index_dir(session_id)
+    if directory is None:
+        if not _has_legacy_index(session_id):
+            return None
+        try:
+            index, records = _load_legacy_index(session_id)
+        except FileNotFoundError:  # 其他进程刚好迁移完成
+            return get_session_index(session_id) if current_index_dir(session_id) else None
+        return vectorstore_cache.put(session_id, version, SessionIndex.in_memory(index, records))
+    return vectorstore_cache.put(session_id, version, SessionIndex(directory, manifest.get("index_type") or "flat"))
+
+
+async def embed_in_batches(texts: List[str], embeddings, batch_size: int = embed_batch_size,
+                           max_in_flight: int = embed_max_in_flight, retries: int = embed_retries):
+    """
+    分批并发向量化, 按完成顺序产出 (起始下标, 向量列表)
+    同时最多 max_in_flight 个批次在途, 只有消费方取走结果后才会发起新的批次(背压)
+    失败的批次按指数退避重试, 超过次数后抛出异常并取消其余批次
+    """
+
+    async def run(start: int):
+        batch = texts[start:start + batch_size]
+        for attempt in range(retries + 1):
+            try:
+                return start, await embeddings.aembed_documents(batch)
+            except Exception:
+                if attempt == retries:
+                    raise
+                await asyncio.sleep(embed_retry_backoff * (2 ** attempt))
+
+    starts = iter(range(0, len(texts), batch_size))
+    pending = set()
+    try:
+        while True:
+            for start in starts:
+                pending.add(asyncio.create_task(run(start)))
+                if len(pending) >= max_in_flight:
+                    break
+            if not pending:
+                return
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                yield task.result()
+    finally:
+        for task in pending:
+            task.cancel()
+
+
+def _split_chunks(plan: Dict, parsed: Dict[str, List[Dict]]) -> Tuple[List[str], List[Dict], List[str]]:
+    """按片段(PDF 为页)切分需要向量化的文件, 并把 chunk 数回写到清单中内容相同的文件"""
+    files = plan["files"]
+    splitter = RecursiveCharacterTextSplitter(chunk_size=600, chunk_overlap=100)
+    chunks, metadatas, ids = [], [], []
+    for fn in plan["to_embed"]:
+        digest = files[fn]["hash"]
+        start = len(chunks)
+        for seg in parsed.get(fn, []):
+            meta = {"source": fn, "hash": digest}
+            if "page" in seg:
+                meta["page"] = seg["page"]
+            for piece in splitter.split_text(seg["text"]):
+                chunks.append(piece)
+                metadatas.append(meta)
+        count = len(chunks) - start
+        for e in files.values():
+            if e["hash"] == digest:
+                e["chunks"] = count
+        ids.extend(_chunk_ids(digest, count))
+    return chunks, metadatas, ids
+
+
+def _load_for_update(session_id: str, plan: Dict) -> Optional[Dict]:
+    """
+    打开现有版本作为增量更新的基础, 返回 {"directory", "chunks", "removed": 要删除的位置, "keep": 保留的位置}
+    keep 为 None 表示全部保留; 没有可复用的索引时返回 None, 全量构建
+    """
+    directory = current_index_dir(session_id)
+    if directory is None or plan["rebuild"]:
+        return None
+    chunks = ChunkStore(directory)
+    removed, keep = np.zeros(0, dtype=np.int64), None
+    if plan["delete_ids"]:
+        delete_ids = set(plan["delete_ids"])
+        deleted = np.asarray([i in delete_ids for i in chunks.ids()], dtype=bool)
+        removed, keep = np.flatnonzero(deleted), np.flatnonzero(~deleted)
+    return {"directory": directory, "chunks": chunks, "removed": removed, "keep": keep}
+
+
+def _has_search_file(index_type: str) -> bool:
+    """与 float32 精确索引相同的检索索引不单独保存"""
+    return index_type != "flat" or faiss_vector_dtype != "float32"
+
+
+class _IndexUpdate:
+    """
+    一次索引更新的向量部分: 以上一版本为基础时, 精确索引(及沿用训练结果的检索索引)先删除 base["removed"],
+    之后向量化完成的批次随到随加, 不在内存中另存全部新向量; order 记录按完成顺序加入的新 chunk 下标
+    规模变化超过阈值(needs_retrain)时检索索引在写出时用全部向量重新构建
+    """
+
+    def __init__(self, base: Optional[Dict] = None, total: int = 0, index_type: Optional[str] = None,
+                 trained_on: int = 0):
+        self.base = base
+        self.exact = None
+        self.search = None
+        self.reuse = False
+        self.index_type, self.trained_on = index_type, trained_on
+        self.order: List[int] = []
+        if base is None:
+            return
+        self.exact = read_index(os.path.join(base["directory"], EXACT_INDEX_FILE), mmap_mode=False)
+        if len(base["removed"]):
+            self.exact.remove_ids(base["removed"])
+        self.trained_on = trained_on or len(base["chunks"])
+        search_path = os.path.join(base["directory"], SEARCH_INDEX_FILE)
+        self.reuse = (index_type is not None
+                      and not needs_retrain(index_type, self.trained_on, self.exact.ntotal + total)
+                      and os.path.exists(search_path) == _has_search_file(index_type))
+        if self.reuse and _has_search_file(index_type):
+            self.search = update_index(read_index(search_path, mmap_mode=False), np.zeros((0, self.exact.d)),
+                                       base["removed"], lambda: flat_vectors(self.exact))
+
+    def add(self, start: int, vectors):
+        """加入新 chunk start 起的一批向量"""
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+        if self.exact is None:
+            self.exact = faiss.IndexFlatL2(vectors.shape[1])
+        self.exact.add(vectors)
+        if self.search is not None:
+            self.search.add(vectors)
+        self.order.extend(range(start, start + len(vectors)))
+
+    def __len__(self):
+        return self.exact.ntotal if self.exact is not None else 0
+
+
+def _has_search_file(index_type: str) -> bool:
+    """与 float32 精确索引相同的检索索引不单独保存"""
+    return index_type != "flat" or faiss_vector_dtype != "float32"
+
+
+def _write_index_files(directory: str, update: _IndexUpdate, records: List[Dict]) -> Tuple[str, int]:
+    """
+    写出一个版本的索引目录, 返回 (检索索引类型, 训练时的 chunk 数):
+    - index.faiss: float32 精确索引, 用于增量更新与评测
+    - search.faiss: 按配置类型/精度构建的检索索引, 与精确索引相同时不单独保存
+    - chunks.bin + chunks.offsets.npy + chunks.ids.json: chunk 文本、元数据与 id
+    - bm25.*: chunk 的 BM25 倒排表、文档长度与平均长度
+    records 为新 chunk, 按 update.order 排列后追加在保留的旧 chunk 之后, 与向量位置一致
+    """
+    tmp = f"{directory}.{os.getpid()}.tmp"
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.makedirs(tmp)
+    faiss.write_index(update.exact, os.path.join(tmp, EXACT_INDEX_FILE))
+    index_type, trained_on = update.index_type, update.trained_on
+    if update.reuse:
+        if update.search is not None:
+            faiss.write_index(update.search, os.path.join(tmp, SEARCH_INDEX_FILE))
+    else:
+        search, index_type = build_index(flat_vectors(update.exact))
+        trained_on = update.exact.ntotal
+        if _has_search_file(index_type):
+            faiss.write_index(search, os.path.join(tmp, SEARCH_INDEX_FILE))
+
+    records = [records[i] for i in update.order]
+    texts = (r["text"] for r in records)
+    base = update.base
+    if base is None:
+        write_chunk_store(tmp, records)
+        write_bm25(tmp, texts)
+    else:
+        chunks, keep = base["chunks"], base["keep"]
+        write_chunk_store(tmp, records, chunks, keep)
+        if os.path.exists(os.path.join(base["directory"], BM25_META_FILE)):
+            write_bm25(tmp, texts, DiskBM25(base["directory"]), keep)
+        else:
+            # 旧版本目录没有倒排表, 对保留的旧 chunk 一并分词
+            kept = range(len(chunks)) if keep is None else keep
+            write_bm25(tmp, itertools.chain((chunks.text(int(i)) for i in kept), texts))
+    shutil.rmtree(directory, ignore_errors=True)
+    os.replace(tmp, directory)
+    return index_type, trained_on
+
+
+def _write_index(session_id: str, plan: Dict, update: _IndexUpdate, records: List[Dict]):
+    version = plan["version"] + 1
+    index_type, trained_on = None, 0
+    if not len(update):
+        shutil.rmtree(vs_path(session_id), ignore_errors=True)
+        vectorstore_cache.invalidate(session_id)
+    else:
+        directory = index_dir(session_id, version)
+        index_type, trained_on = _write_index_files(directory, update, records)
+        # 新版本写盘后直接放入缓存, 旧版本随之失效
+        vectorstore_cache.put(session_id, version, SessionIndex(directory, index_type))
+
+    save_manifest(session_id, {"version": version, "files": plan["files"], "index_type": index_type,
+                               "trained_on": trained_on, "updated_at": time.time()})
+    # 清单切换到新版本后再删除旧版本目录, 已打开的 mmap 不受影响
+    if os.path.exists(vs_path(session_id)):
+        for name in os.listdir(vs_path(session_id)):
+            if name != f"v{version}":
+                shutil.rmtree(os.path.join(vs_path(session_id), name), ignore_errors=True)
+
+
+async def update_vector_index(session_id: str, plan: Dict, parsed: Dict[str, List[Dict]], embeddings,
+                              on_progress: Optional[Callable[[int, int], None]] = None) -> str:
+    """
+    按计划增量更新向量索引并写回清单, 返回索引目录; 计划到写入期间调用方需持有 index_update_lock
+    parsed: {文件名: 文本片段列表}, 只包含需要向量化的文件
+    on_progress: 每写入一批向量后回调 (已完成 chunk 数, 总 chunk 数)
+    """
+    vs_dir = vs_path(session_id)
+    files = plan["files"]
+    if not plan["to_embed"] and not plan["delete_ids"] and not (plan["rebuild"] and os.path.exists(vs_dir)):
+        manifest = _read_manifest(session_id)
+        if files != manifest.get("files"):
+            save_manifest(session_id, {**manifest, "version": plan["version"], "files": files,
+                                       "updated_at": time.time()})
+        return vs_dir
+
+    base = await asyncio.to_thread(_load_for_update, session_id, plan)
+    chunks, metadatas, ids = await asyncio.to_thread(_split_chunks, plan, parsed)
+    manifest = _read_manifest(session_id)
+    update = await asyncio.to_thread(_IndexUpdate, base, len(chunks), manifest.get("index_type"),
+                                     manifest.get("trained_on", 0))
+
+    # 每个完成的批次直接加入索引
+    done = 0
+    async for start, batch in embed_in_batches(chunks, embeddings):
+        await asyncio.to_thread(update.add, start, batch)
+        done += len(batch)
+        if on_progress:
+            on_progress(done, len(chunks))
+
+    records = [{"id": i, "text": t, "metadata": m} for i, t, m in zip(ids, chunks, metadatas)]
+    await asyncio.to_thread(_write_index, session_id, plan, update, records)
+    return vs_dir
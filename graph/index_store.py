@@ -0,0 +1,307 @@
+import os, json, math, mmap
+from collections import Counter
+from typing import Dict, Iterable, List, Optional, Tuple, Union
+
+import faiss
+import numpy as np
+
+from utils.text_search import BM25Index, tokenize
+from .faiss_index import set_search_params, index_bytes, flat_codes
+
+CHUNKS_FILE = "chunks.bin"
+OFFSETS_FILE = "chunks.offsets.npy"
+CHUNK_IDS_FILE = "chunks.ids.json"  # 按位置排列的 chunk id, 增量更新时定位要删除的 chunk
+EXACT_INDEX_FILE = "index.faiss"
+SEARCH_INDEX_FILE = "search.faiss"
+# BM25 倒排表: 词按 UTF-8 字节序排列, offsets 每行为 (词在 terms.bin 中的起点, 倒排表在 postings 中的起点)
+BM25_TERMS_FILE = "bm25.terms.bin"
+BM25_OFFSETS_FILE = "bm25.offsets.npy"
+BM25_POSTINGS_FILE = "bm25.postings.npy"  # 每行 (chunk 下标, 词频)
+BM25_DOC_LEN_FILE = "bm25.doc_len.npy"
+BM25_META_FILE = "bm25.meta.json"
+
+# 新版本 faiss 的 IO_FLAG_MMAP_IFC 可零拷贝映射向量, 旧版本退回普通读取
+_MMAP_FLAG = getattr(faiss, "IO_FLAG_MMAP_IFC", 0)
+
+
+class ChunkStore:
+    """
+    只读的 chunk 存储: chunks.bin 顺序存放每个 chunk 的 JSON 记录, offsets 记录各条的起止位置
+    两个文件都以 mmap 方式打开, 打开耗时与 chunk 数无关, 多个进程共享同一份页缓存
+    """
+
+    def __init__(self, directory: str):
+        self.offsets = np.load(os.path.join(directory, OFFSETS_FILE), mmap_mode="r")
+        self._path = os.path.join(directory, CHUNKS_FILE)
+        with open(self._path, "rb") as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def record(self, i: int) -> Dict:
+        return json.loads(self._mm[int(self.offsets[i]):int(self.offsets[i + 1])])
+
+    def text(self, i: int) -> str:
+        return self.record(i)["text"]
+
+    def __iter__(self):
+        return (self.record(i) for i in range(len(self)))
+
+    def ids(self) -> List[str]:
+        """按位置排列的 chunk id; 旧版本目录没有 id 文件时逐条解析记录"""
+        path = os.path.join(os.path.dirname(self._path), CHUNK_IDS_FILE)
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        return [r["id"] for r in self]
+
+
+class MemoryChunkStore:
+    """内存中的 chunk 记录, 接口与 ChunkStore 一致, 用于只读打开尚未迁移的旧格式索引"""
+
+    def __init__(self, records: List[Dict]):
+        self.records = records
+        self.nbytes = sum(len(r["text"].encode("utf-8")) for r in records)
+
+    def __len__(self):
+        return len(self.records)
+
+    def record(self, i: int) -> Dict:
+        return self.records[i]
+
+    def text(self, i: int) -> str:
+        return self.records[i]["text"]
+
+    def __iter__(self):
+        return iter(self.records)
+
+    def ids(self) -> List[str]:
+        return [r["id"] for r in self.records]
+
+
+def write_chunk_store(directory: str, records: Iterable[Dict], base: Optional[ChunkStore] = None,
+                      keep: Optional[np.ndarray] = None):
+    """
+    records: [{"id", "text", "metadata"}], 顺序与向量在索引中的位置一致
+    base: 增量更新时的上一版本, 其中 keep 指定的记录(默认全部)按原字节复制在前, records 追加在后
+    """
+    offsets, ids = [np.zeros(1, dtype=np.int64)], []
+    with open(os.path.join(directory, CHUNKS_FILE), "wb") as f:
+        if base is not None:
+            old_ids = base.ids()
+            if keep is None:
+                f.write(base._mm[:int(base.offsets[-1])])
+                offsets.append(np.asarray(base.offsets[1:], dtype=np.int64))
+                ids = old_ids
+            else:
+                starts, ends = base.offsets[:-1][keep], base.offsets[1:][keep]
+                for start, end in zip(starts, ends):
+                    f.write(base._mm[int(start):int(end)])
+                offsets.append(np.cumsum(ends - starts, dtype=np.int64))
+                ids = [old_ids[i] for i in keep]
+        size = int(offsets[-1][-1]) if len(offsets[-1]) else 0
+        new_offsets = []
+        for r in records:
+            data = json.dumps(r, ensure_ascii=False).encode("utf-8")
+            f.write(data)
+            size += len(data)
+            new_offsets.append(size)
+            ids.append(r["id"])
+    offsets.append(np.asarray(new_offsets, dtype=np.int64))
+    np.save(os.path.join(directory, OFFSETS_FILE), np.concatenate(offsets))
+    with open(os.path.join(directory, CHUNK_IDS_FILE), "w", encoding="utf-8") as f:
+        json.dump(ids, f)
+
+
+def write_bm25(directory: str, texts: Iterable[str], base: Optional["DiskBM25"] = None,
+               keep: Optional[np.ndarray] = None, k1: float = 1.5, b: float = 0.75):
+    """
+    按 chunk 顺序分词并写出 BM25 倒排表, 打开索引时不再需要解析和分词全部 chunk
+    base: 增量更新时的上一版本, 只对新增的 texts 分词; keep 指定保留的旧 chunk(默认全部), 下标按保留顺序重排
+    """
+    old_terms, old_ranks, old_rows, old_len = [], np.zeros(0, dtype=np.int64), np.zeros((0, 2), np.int64), []
+    if base is not None:
+        old_terms = base.terms()
+        old_ranks = np.repeat(np.arange(len(old_terms)), np.diff(base.offsets[:, 1]))
+        old_rows = np.asarray(base.postings, dtype=np.int64)
+        old_len = np.asarray(base.doc_len)
+        if keep is not None:
+            remap = np.full(len(base), -1, dtype=np.int64)
+            remap[keep] = np.arange(len(keep))
+            docs = remap[old_rows[:, 0]]
+            alive = docs >= 0
+            old_rows = np.column_stack([docs, old_rows[:, 1]])[alive]
+            old_ranks = old_ranks[alive]
+            old_len = old_len[keep]
+
+    postings: Dict[str, List[Tuple[int, int]]] = {}
+    doc_len = list(old_len)
+    for i, text in enumerate(texts, len(old_len)):
+        counts = Counter(tokenize(text))
+        for term, tf in counts.items():
+            postings.setdefault(term, []).append((i, tf))
+        doc_len.append(sum(counts.values()))
+
+    # 新旧词表合并后重新编号, 倒排表按 (词, chunk 下标) 排序
+    terms = sorted(set(old_terms) | set(postings))  # 按码位排序, 与 UTF-8 字节序一致
+    rank = {term: t for t, term in enumerate(terms)}
+    new_rows = [row for term in postings for row in postings[term]]
+    ranks = np.concatenate([
+        np.asarray([rank[term] for term in old_terms], dtype=np.int64)[old_ranks],
+        np.asarray([rank[term] for term in postings for _ in postings[term]], dtype=np.int64)])
+    rows = np.concatenate([old_rows, np.asarray(new_rows, dtype=np.int64).reshape(-1, 2)])
+    order = np.lexsort((rows[:, 0], ranks))
+    rows, ranks = rows[order], ranks[order]
+    # 删除 chunk 后不再出现的词不写入词表
+    counts = np.bincount(ranks, minlength=len(terms))
+    present = np.flatnonzero(counts)
+
+    offsets = np.zeros((len(present) + 1, 2), dtype=np.int64)
+    offsets[1:, 1] = np.cumsum(counts[present])
+    with open(os.path.join(directory, BM25_TERMS_FILE), "wb") as f:
+        for t, r in enumerate(present):
+            data = terms[r].encode("utf-8")
+            f.write(data)
+            offsets[t + 1, 0] = offsets[t, 0] + len(data)
+    np.save(os.path.join(directory, BM25_POSTINGS_FILE), rows.astype(np.int32))
+    np.save(os.path.join(directory, BM25_OFFSETS_FILE), offsets)
+    np.save(os.path.join(directory, BM25_DOC_LEN_FILE), np.asarray(doc_len, dtype=np.int32))
+    total = int(sum(doc_len))
+    with open(os.path.join(directory, BM25_META_FILE), "w", encoding="utf-8") as f:
+        json.dump({"k1": k1, "b": b, "docs": len(doc_len), "avgdl": total / len(doc_len) if doc_len else 0}, f)
+
+
+class DiskBM25:
+    """
+    以 mmap 方式打开的只读 BM25 倒排表, 打分与 utils.text_search.BM25Index 一致
+    查询词在有序词表上二分查找, 只读取命中词的倒排表
+    """
+
+    def __init__(self, directory: str):
+        with open(os.path.join(directory, BM25_META_FILE), "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        self.k1, self.b = meta["k1"], meta["b"]
+        self.avgdl = meta["avgdl"] or 1
+        self.offsets = np.load(os.path.join(directory, BM25_OFFSETS_FILE), mmap_mode="r")
+        self.postings = np.load(os.path.join(directory, BM25_POSTINGS_FILE), mmap_mode="r")
+        self.doc_len = np.load(os.path.join(directory, BM25_DOC_LEN_FILE), mmap_mode="r")
+        self._terms = None
+        if len(self.offsets) > 1 and self.offsets[-1, 0]:
+            with open(os.path.join(directory, BM25_TERMS_FILE), "rb") as f:
+                self._terms = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __len__(self):
+        return len(self.doc_len)
+
+    def _term(self, t: int) -> bytes:
+        return self._terms[int(self.offsets[t, 0]):int(self.offsets[t + 1, 0])]
+
+    def terms(self) -> List[str]:
+        if self._terms is None:
+            return []
+        return [self._term(t).decode("utf-8") for t in range(len(self.offsets) - 1)]
+
+    def _find(self, term: str) -> Optional[int]:
+        if self._terms is None:
+            return None
+        key = term.encode("utf-8")
+        lo, hi = 0, len(self.offsets) - 1
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._term(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo if lo < len(self.offsets) - 1 and self._term(lo) == key else None
+
+    def search(self, query: str, top_k: int = 3) -> List[Tuple[int, float]]:
+        n = len(self)
+        if not n:
+            return []
+        scores = np.zeros(n, dtype=np.float64)
+        for term in set(tokenize(query)):
+            t = self._find(term)
+            if t is None:
+                continue
+            rows = self.postings[int(self.offsets[t, 1]):int(self.offsets[t + 1, 1])]
+            docs, tf = rows[:, 0], rows[:, 1].astype(np.float64)
+            idf = math.log(1 + (n - len(rows) + 0.5) / (len(rows) + 0.5))
+            norm = tf + self.k1 * (1 - self.b + self.b * self.doc_len[docs] / self.avgdl)
+            scores[docs] += idf * tf * (self.k1 + 1) / norm
+        hits = np.flatnonzero(scores)
+        if len(hits) > top_k:
+            hits = hits[np.argpartition(-scores[hits], top_k - 1)[:top_k]]
+        return sorted(((int(i), float(scores[i])) for i in hits), key=lambda x: x[1], reverse=True)
+
+
+KeywordIndex = Union[DiskBM25, BM25Index]
+
+
+def read_index(path: str, mmap_mode: bool = True):
+    try:
+        return faiss.read_index(path, _MMAP_FLAG if mmap_mode else 0)
+    except RuntimeError:
+        return faiss.read_index(path)
+
+
+class SessionIndex:
+    """一个 session 的检索索引: 向量位置即 chunk 在 ChunkStore 中的下标"""
+
+    def __init__(self, directory: str, index_type: str):
+        search_path = os.path.join(directory, SEARCH_INDEX_FILE)
+        if not os.path.exists(search_path):
+            search_path = os.path.join(directory, EXACT_INDEX_FILE)
+        self.index = set_search_params(read_index(search_path))
+        self.index_type = index_type
+        self.chunks = ChunkStore(directory)
+        self.mmapped = bool(_MMAP_FLAG)
+        # 旧版本的索引目录没有 BM25 文件, 首次打开时从 chunk 文本构建
+        self.bm25 = DiskBM25(directory) if os.path.exists(os.path.join(directory, BM25_META_FILE)) else None
+
+    @classmethod
+    def in_memory(cls, index, records: List[Dict], index_type: str = "flat") -> "SessionIndex":
+        """由内存中的索引和记录构造, 不对应磁盘目录"""
+        self = cls.__new__(cls)
+        self.index = set_search_params(index)
+        self.index_type = index_type
+        self.chunks = MemoryChunkStore(records)
+        self.mmapped = False
+        self.bm25 = None
+        return self
+
+    def __len__(self):
+        return len(self.chunks)
+
+    def search(self, vector: List[float], k: int) -> List[Tuple[int, float]]:
+        """返回 [(chunk 下标, L2 距离)], 距离越小越相似"""
+        if not len(self):
+            return []
+        query = np.asarray([vector], dtype=np.float32)
+        distances, positions = self.index.search(query, min(k, len(self)))
+        return [(int(p), float(d)) for p, d in zip(positions[0], distances[0]) if p >= 0]
+
+    def text(self, i: int) -> str:
+        return self.chunks.text(i)
+
+    def keyword_index(self) -> KeywordIndex:
+        """BM25 索引: 优先使用写入时保存的倒排表, 没有时从 chunk 文本构建"""
+        if self.bm25 is None:
+            bm25 = BM25Index()
+            for i, record in enumerate(self.chunks):
+                bm25.add(i, record["text"])
+            self.bm25 = bm25
+        return self.bm25
+
+    def resident_bytes(self) -> int:
+        """
+        常驻内存估算, mmap 的部分由页缓存承担, 不计入
+        只有 flat 编码(flat / SQ 及 HNSW 的向量存储)会被映射, HNSW 的图和 IVF 的倒排表仍在堆上
+        """
+        total = index_bytes(self.index)
+        if isinstance(self.chunks, MemoryChunkStore):
+            total += self.chunks.nbytes
+        codes = flat_codes(self.index)
+        if self.mmapped and codes is not None:
+            total -= codes.ntotal * codes.code_size
+        return max(0, total)
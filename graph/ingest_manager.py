@@ -0,0 +1,189 @@
+import asyncio, time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from typing import Dict, Iterable, Tuple
+
+from config import ingest_workers, ingest_queue_size, ingest_job_ttl, ingest_max_jobs
+from utils.metrics import registry, ingest_duration
+from .index_manager import plan_index_update, update_vector_index, parse_document, index_update_lock
+
+
+class IngestManager:
+    """
+    后台文档入库: /upload 只负责落盘并提交任务, 解析/切分/向量化由有界的 worker 池完成
+    同一 session 排队中的任务会合并, 同一 session 的任务串行执行
+    已结束的任务状态超过 TTL 或总数超过上限时清理; 清理后再次 ensure_indexed 会补提交, 未变化的文件不会被重新处理
+    """
+
+    def __init__(self, workers: int, max_pending: int, ttl: float = ingest_job_ttl, max_jobs: int = ingest_max_jobs):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.ttl = ttl
+        self.max_jobs = max_jobs
+        self.jobs: "OrderedDict[str, Dict]" = OrderedDict()  # {session_id: 最近一次任务的状态}
+        self._waiters: Dict[str, asyncio.Future] = {}  # 只保存排队中/执行中的
+        self._locks: Dict[str, Tuple[asyncio.Lock, int]] = {}  # {session_id: (锁, 使用中的任务数)}
+        self._queue = None
+        self._tasks = []
+        self._last_sweep = time.time()
+
+    def _ensure_workers(self):
+        if self._queue is None:
+            self._queue = asyncio.Queue(maxsize=self.max_pending)
+            self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def submit(self, session_id: str, filenames: Iterable[str] = ()) -> Dict:
+        """提交入库任务, 队列满时等待(背压)"""
+        self._ensure_workers()
+        job = self.jobs.get(session_id)
+        if job and job["state"] == "queued":
+            for fn in filenames:
+                job["files"][fn] = {"state": "queued"}
+            return job
+
+        job = {
+            "session_id": session_id,
+            "state": "queued",
+            "files": {fn: {"state": "queued"} for fn in filenames},
+            "error": None,
+            "submitted_at": time.time(),
+            "finished_at": None,
+        }
+        self._put(session_id, job)
+        self._waiters[session_id] = asyncio.get_running_loop().create_future()
+        await self._queue.put(session_id)
+        return job
+
+    def _put(self, session_id: str, job: Dict):
+        self.jobs[session_id] = job
+        self.jobs.move_to_end(session_id)
+        now = time.time()
+        over = len(self.jobs) - self.max_jobs
+        if over <= 0 and now - self._last_sweep < min(self.ttl, 30):
+            return
+        self._last_sweep = now
+        for sid, j in list(self.jobs.items()):
+            if j["finished_at"] is None or j["state"] in ("queued", "running"):
+                continue
+            if over > 0 or now - j["finished_at"] > self.ttl:
+                del self.jobs[sid]
+                over -= 1
+
+    @asynccontextmanager
+    async def _session_lock(self, session_id: str):
+        """同一 session 的任务串行执行, 没有任务使用时删除锁"""
+        lock, users = self._locks.get(session_id, (None, 0))
+        lock = lock or asyncio.Lock()
+        self._locks[session_id] = (lock, users + 1)
+        try:
+            async with lock:
+                yield
+        finally:
+            lock, users = self._locks[session_id]
+            if users == 1:
+                del self._locks[session_id]
+            else:
+                self._locks[session_id] = (lock, users - 1)
+
+    async def ensure_indexed(self, session_id: str) -> Dict:
+        """
+        等待 session 的索引就绪
+        本进程内没有任务记录时(如服务重启后)补提交一次, 未变化的文件不会被重新处理
+        """
+        if session_id not in self.jobs:
+            await self.submit(session_id)
+        job = self.jobs[session_id]
+        if job["state"] in ("queued", "running"):
+            await asyncio.shield(self._waiters[session_id])
+        return self.jobs[session_id]
+
+    def status(self, session_id: str) -> Dict:
+        job = self.jobs.get(session_id)
+        if job is None:
+            return {"session_id": session_id, "state": "unknown", "files": {}}
+        files = job["files"]
+        finished = sum(1 for f in files.values() if f["state"] not in ("queued", "parsing", "indexing"))
+        return {**job, "files": {fn: dict(f) for fn, f in files.items()},
+                "progress": f"{finished}/{len(files)}"}
+
+    async def _worker(self):
+        while True:
+            session_id = await self._queue.get()
+            job = self.jobs[session_id]
+            waiter = self._waiters[session_id]
+            job["state"] = "running"
+            try:
+                job["state"] = await self._run(job)
+            except Exception as e:
+                job["state"] = "failed"
+                job["error"] = str(e)
+                for f in job["files"].values():
+                    if f["state"] in ("queued", "parsing", "indexing"):
+                        f["state"] = "failed"
+            finally:
+                job["finished_at"] = time.time()
+                ingest_duration.observe(job["finished_at"] - job["submitted_at"], state=job["state"])
+                if not waiter.done():
+                    waiter.set_result(job)
+                if self._waiters.get(session_id) is waiter:
+                    del self._waiters[session_id]
+                self._queue.task_done()
+
+    async def _run(self, job: Dict) -> str:
+        """
+        执行一次入库, 返回任务状态: done / partial(部分文件失败) / failed(需要处理的文件全部失败)
+        """
+        from .nodes import embeddings
+
+        session_id = job["session_id"]
+        files = job["files"]
+        async with self._session_lock(session_id), index_update_lock(session_id):
+            plan = await asyncio.to_thread(plan_index_update, session_id)
+            for fn in plan["files"]:
+                if fn not in plan["to_embed"]:
+                    files[fn] = {"state": "unchanged"}
+            for fn in plan["removed"]:
+                files[fn] = {"state": "removed"}
+
+            async def parse(fn: str):
+                files[fn] = {"state": "parsing"}
+                try:
+                    segments = await parse_document(session_id, fn, plan["files"][fn]["hash"])
+                except Exception as e:
+                    # 单个文件解析失败不影响其他文件入库
+                    files[fn] = {"state": "failed", "error": str(e)}
+                    return fn, []
+                files[fn]["state"] = "indexing"
+                return fn, segments
+
+            parsed = dict(await asyncio.gather(*(parse(fn) for fn in plan["to_embed"])))
+            # 解析失败的文件不记入清单, 下次入库时重试; 内容相同的其他文件也一样
+            for fn in [fn for fn in plan["to_embed"] if files[fn]["state"] == "failed"]:
+                plan["to_embed"].remove(fn)
+                digest = plan["files"][fn]["hash"]
+                for same in [other for other, e in plan["files"].items() if e["hash"] == digest]:
+                    plan["files"].pop(same)
+                    files[same] = dict(files[fn])
+
+            def on_progress(done: int, total: int):
+                job["chunks_embedded"] = f"{done}/{total}"
+
+            await update_vector_index(session_id, plan, parsed, embeddings, on_progress)
+
+            for fn in plan["to_embed"]:
+                if files[fn]["state"] == "indexing":
+                    files[fn] = {"state": "done", "chunks": plan["files"][fn]["chunks"]}
+            for fn, f in files.items():
+                if f["state"] == "queued":
+                    f["state"] = "skipped"
+
+        failed = sum(1 for f in files.values() if f["state"] == "failed")
+        if not failed:
+            return "done"
+        processed = sum(1 for f in files.values() if f["state"] in ("done", "failed"))
+        return "failed" if failed == processed else "partial"
+
+
+ingest_manager = IngestManager(ingest_workers, ingest_queue_size)
+registry.register_collector(lambda: [("insight_ingest_queue_depth", "排队中的入库任务数", {
+    (): ingest_manager._queue.qsize() if ingest_manager._queue is not None else 0})])
@@ -0,0 +1,87 @@
+import asyncio, time, contextvars
+from collections import OrderedDict
+from typing import Awaitable, Dict
+
+from config import intent_result_ttl, intent_max_results
+
+
+class IntentManager:
+    """
+    意图推断的后台任务: 回答生成后立即返回, 推测的后续问题稍后通过 /intents 获取
+    每个 session 只保留最近一轮的结果; 已结束的结果超过 TTL 或总数超过上限时清理, 进行中的不清理
+    """
+
+    def __init__(self, ttl: float, max_results: int):
+        self.ttl = ttl
+        self.max_results = max_results
+        self.results: "OrderedDict[str, Dict]" = OrderedDict()  # {session_id: 最近一轮的意图推断结果}
+        self._futures: Dict[str, asyncio.Future] = {}  # 只保存进行中的
+        self._tasks = set()
+        self._last_sweep = time.time()
+
+    def _put(self, session_id: str, result: Dict):
+        self.results[session_id] = result
+        self.results.move_to_end(session_id)
+        now = time.time()
+        over = len(self.results) - self.max_results
+        if over <= 0 and now - self._last_sweep < min(self.ttl, 30):
+            return
+        self._last_sweep = now
+        for sid, r in list(self.results.items()):
+            if r["state"] == "pending":
+                continue
+            if over > 0 or now - r["finished_at"] > self.ttl:
+                del self.results[sid]
+                over -= 1
+
+    def schedule(self, session_id: str, question: str, coro: Awaitable[Dict]) -> Dict:
+        result = {"session_id": session_id, "question": question, "state": "pending",
+                  "user_intent": [], "error": None, "submitted_at": time.time(), "finished_at": None}
+        self._put(session_id, result)
+        future = asyncio.get_running_loop().create_future()
+        self._futures[session_id] = future
+
+        async def run():
+            try:
+                resp = await coro
+                result["user_intent"] = resp.get("user_intent") or []
+                result["state"] = "done"
+            except Exception as e:
+                result["state"] = "failed"
+                result["error"] = str(e)
+            finally:
+                result["finished_at"] = time.time()
+                if not future.done():
+                    future.set_result(result)
+                if self._futures.get(session_id) is future:
+                    del self._futures[session_id]
+
+        # 使用空的 context, 避免后台任务继承图的回调(否则 /ask/stream 会收到意图推断的 token)
+        task = asyncio.create_task(run(), context=contextvars.Context())
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return result
+
+    def skip(self, session_id: str, question: str) -> Dict:
+        now = time.time()
+        result = {"session_id": session_id, "question": question, "state": "skipped",
+                  "user_intent": [], "error": None, "submitted_at": now, "finished_at": now}
+        self._put(session_id, result)
+        self._futures.pop(session_id, None)
+        return result
+
+    def status(self, session_id: str) -> Dict:
+        return self.results.get(session_id) or {"session_id": session_id, "state": "unknown", "user_intent": []}
+
+    async def wait(self, session_id: str, timeout: float) -> Dict:
+        """等待最近一轮的意图推断完成, 超时则返回当前状态"""
+        future = self._futures.get(session_id)
+        if future is not None and not future.done():
+            try:
+                await asyncio.wait_for(asyncio.shield(future), timeout)
+            except asyncio.TimeoutError:
+                pass
+        return self.status(session_id)
+
+
+intent_manager = IntentManager(intent_result_ttl, intent_max_results)
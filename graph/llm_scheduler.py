@@ -0,0 +1,259 @@
+import time, heapq, random, asyncio, itertools, contextvars
+from collections import defaultdict
+from contextlib import asynccontextmanager, suppress
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional
+
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.outputs import ChatGenerationChunk, ChatResult
+from langchain_core.runnables.config import ensure_config
+
+from config import (
+    llm_max_concurrency, llm_session_concurrency, llm_rate_per_second, llm_rate_burst,
+    llm_max_retries, llm_retry_base_delay, llm_retry_max_delay)
+from utils.metrics import registry, stats_collector
+
+# 优先级从高到低: 交互式回答, 不满意后的重新生成, 后台意图推断, 批量问答, 会话记忆压缩
+PRIORITIES = {"interactive": 0, "feedback": 1, "intent": 2, "batch": 3, "summary": 4}
+
+llm_wait = registry.histogram("insight_llm_wait_seconds", "LLM 调用排队等待时间", ["priority"],
+                              (0.001, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30))
+llm_retries = registry.counter("insight_llm_retries_total", "LLM 调用重试次数", ["priority"])
+
+# 可重试的错误: 限流、超时、连接失败、服务端错误
+_RETRYABLE_STATUS = {408, 409, 429}
+_RETRYABLE_NAMES = {"RateLimitError", "APITimeoutError", "APIConnectionError", "InternalServerError",
+                    "TimeoutException", "TransportError", "ConnectError", "ReadTimeout"}
+
+
+def is_retryable(e: Exception) -> bool:
+    status = getattr(e, "status_code", None)
+    if isinstance(status, int):
+        return status in _RETRYABLE_STATUS or status >= 500
+    if isinstance(e, (asyncio.TimeoutError, ConnectionError)):
+        return True
+    return any(cls.__name__ in _RETRYABLE_NAMES for cls in type(e).__mro__)
+
+
+class TokenBucket:
+    """每秒补充 rate 个令牌, 最多积攒 burst 个; rate <= 0 时不限速"""
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.capacity = max(1, burst)
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+        self.throttled = 0
+
+    async def take(self):
+        if self.rate <= 0:
+            return
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                self.throttled += 1
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class LLMScheduler:
+    """
+    所有对话模型调用的调度:
+    - 全局并发上限和单 session 并发上限, 空出的名额按优先级分配, 同优先级先到先得
+    - 令牌桶限制请求速率
+    - 限流/超时/5xx 按指数退避加随机抖动重试, 退避期间不占用并发名额
+    """
+
+    def __init__(self, max_concurrency: int, session_concurrency: int, rate: float, burst: int,
+                 max_retries: int, retry_base_delay: float, retry_max_delay: float):
+        self.max_concurrency = max_concurrency
+        self.session_concurrency = session_concurrency
+        self.bucket = TokenBucket(rate, burst)
+        self.max_retries = max_retries
+        self.retry_base_delay = retry_base_delay
+        self.retry_max_delay = retry_max_delay
+        self.active = 0
+        self._session_active: Dict[Optional[str], int] = defaultdict(int)
+        self._waiters: List = []  # 堆: (优先级, 序号, session, future)
+        self._seq = itertools.count()
+        self.completed = 0
+        self.retries = 0
+
+    def _fits(self, session_id: Optional[str]) -> bool:
+        return session_id is None or self._session_active[session_id] < self.session_concurrency
+
+    def _grant(self, session_id: Optional[str]):
+        self.active += 1
+        if session_id is not None:
+            self._session_active[session_id] += 1
+
+    def _dispatch(self):
+        """按优先级唤醒等待者; session 已满的等待者跳过, 不阻塞其他 session"""
+        skipped = []
+        while self._waiters and self.active < self.max_concurrency:
+            item = heapq.heappop(self._waiters)
+            fut, session_id = item[3], item[2]
+            if fut.done():
+                continue
+            if not self._fits(session_id):
+                skipped.append(item)
+                continue
+            self._grant(session_id)
+            fut.set_result(None)
+        for item in skipped:
+            heapq.heappush(self._waiters, item)
+
+    def _release(self, session_id: Optional[str]):
+        self.active -= 1
+        if session_id is not None:
+            self._session_active[session_id] -= 1
+            if not self._session_active[session_id]:
+                del self._session_active[session_id]
+        self._dispatch()
+
+    @asynccontextmanager
+    async def slot(self, priority: str = "interactive", session_id: Optional[str] = None):
+        """占用一个并发名额并通过限速后执行"""
+        start = time.perf_counter()
+        fut = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (PRIORITIES.get(priority, len(PRIORITIES)), next(self._seq), session_id, fut))
+        self._dispatch()
+        try:
+            await fut
+        except asyncio.CancelledError:
+            if fut.done() and not fut.cancelled():
+                self._release(session_id)
+            raise
+        try:
+            await self.bucket.take()
+            llm_wait.observe(time.perf_counter() - start, priority=priority)
+            yield
+        finally:
+            self.completed += 1
+            self._release(session_id)
+
+    async def _backoff(self, attempt: int, priority: str):
+        self.retries += 1
+        llm_retries.inc(priority=priority)
+        delay = min(self.retry_max_delay, self.retry_base_delay * 2 ** attempt)
+        await asyncio.sleep(random.uniform(delay / 2, delay))
+
+    async def call(self, factory: Callable[[], Awaitable[Any]], priority: str = "interactive",
+                   session_id: Optional[str] = None) -> Any:
+        attempt = 0
+        while True:
+            async with self.slot(priority, session_id):
+                try:
+                    return await factory()
+                except Exception as e:
+                    if attempt >= self.max_retries or not is_retryable(e):
+                        raise
+            await self._backoff(attempt, priority)
+            attempt += 1
+
+    async def stream(self, factory: Callable[[], AsyncIterator], priority: str = "interactive",
+                     session_id: Optional[str] = None) -> AsyncIterator:
+        """流式调用只在还没有输出任何内容时重试"""
+        attempt = 0
+        while True:
+            started = False
+            async with self.slot(priority, session_id):
+                try:
+                    async for chunk in factory():
+                        started = True
+                        yield chunk
+                    return
+                except Exception as e:
+                    if started or attempt >= self.max_retries or not is_retryable(e):
+                        raise
+            await self._backoff(attempt, priority)
+            attempt += 1
+
+    def stats(self) -> Dict:
+        queued = defaultdict(int)
+        for prio, _, _, fut in self._waiters:
+            if not fut.done():
+                queued[prio] += 1
+        stats = {"active": self.active, "queued": sum(queued.values()), "completed": self.completed,
+                 "retries": self.retries, "throttled": self.bucket.throttled}
+        for name, prio in PRIORITIES.items():
+            stats[f"queued_{name}"] = queued.get(prio, 0)
+        return stats
+
+
+# 流式路径(astream 及 astream_events 触发的隐式流式)调用 _astream 时不传 run_manager,
+# 由 ainvoke/astream 把本次调用的 metadata 放进 contextvar
+_call_metadata: contextvars.ContextVar[Dict] = contextvars.ContextVar("llm_call_metadata", default={})
+
+
+def _call_options(run_manager) -> Dict:
+    """调用方通过 config 的 metadata 传入 llm_priority / session_id"""
+    metadata = getattr(run_manager, "metadata", None) or _call_metadata.get() or ensure_config().get("metadata", {})
+    return {"priority": metadata.get("llm_priority", "interactive"), "session_id": metadata.get("session_id")}
+
+
+class ScheduledChatModel(BaseChatModel):
+    """
+    包装实际的对话模型, 异步调用都经过调度器; 回调只由外层触发一次
+    优先级: llm.ainvoke(messages, config={"metadata": {"llm_priority": "intent", "session_id": sid}})
+    inner 为空时由 factory(如 utils.startup.Lazy) 在首次调用时构造实际模型
+    """
+
+    inner: Optional[BaseChatModel] = None
+    factory: Optional[Callable[[], BaseChatModel]] = None
+    scheduler: Any = None
+
+    def _model(self) -> BaseChatModel:
+        return self.inner if self.inner is not None else self.factory()
+
+    @property
+    def _llm_type(self) -> str:
+        return f"scheduled-{self._model()._llm_type}"
+
+    @property
+    def _identifying_params(self) -> Dict[str, Any]:
+        return self._model()._identifying_params
+
+    def _scheduler(self) -> LLMScheduler:
+        return self.scheduler or llm_scheduler
+
+    async def ainvoke(self, input, config=None, **kwargs):
+        token = _call_metadata.set(ensure_config(config).get("metadata") or {})
+        try:
+            return await super().ainvoke(input, config, **kwargs)
+        finally:
+            _call_metadata.reset(token)
+
+    async def astream(self, input, config=None, **kwargs):
+        token = _call_metadata.set(ensure_config(config).get("metadata") or {})
+        try:
+            async for chunk in super().astream(input, config, **kwargs):
+                yield chunk
+        finally:
+            # 生成器可能在别的 context 中被关闭, 此时无法 reset
+            with suppress(ValueError):
+                _call_metadata.reset(token)
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        return self._model()._generate(messages, stop=stop, run_manager=run_manager, **kwargs)
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        return await self._scheduler().call(
+            lambda: self._model()._agenerate(messages, stop=stop, run_manager=run_manager, **kwargs),
+            **_call_options(run_manager))
+
+    async def _astream(self, messages, stop=None, run_manager=None, **kwargs) -> AsyncIterator[ChatGenerationChunk]:
+        def factory():
+            return self._model()._astream(messages, stop=stop, run_manager=run_manager, **kwargs)
+
+        async for chunk in self._scheduler().stream(factory, **_call_options(run_manager)):
+            yield chunk
+
+
+llm_scheduler = LLMScheduler(llm_max_concurrency, llm_session_concurrency, llm_rate_per_second, llm_rate_burst,
+                             llm_max_retries, llm_retry_base_delay, llm_retry_max_delay)
+registry.register_collector(stats_collector("llm_scheduler", llm_scheduler.stats))
@@ -0,0 +1,61 @@
+import asyncio, logging, contextvars
+from typing import Awaitable, Callable, Dict, List
+
+from .memory_manager import compaction_plan, apply_compaction, get_session_summary
+from config import memory_compact_turns, memory_compact_tokens, memory_tail_turns
+from utils.metrics import registry, stats_collector
+
+logger = logging.getLogger("insightai")
+
+# summarize(旧摘要, 要折叠的记录) -> 新摘要
+Summarizer = Callable[[str, List[Dict]], Awaitable[str]]
+
+
+class MemoryCompactor:
+    """
+    会话记忆的滚动压缩: 热日志超过轮数或 token 阈值后, 较早的轮次折叠进摘要, 原始记录移入冷归档
+    压缩在后台执行, 不阻塞回答; 同一 session 同时只有一个压缩任务
+    """
+
+    def __init__(self):
+        self._running: Dict[str, asyncio.Task] = {}
+        self.compactions = 0
+        self.folded_turns = 0
+        self.failures = 0
+
+    def schedule(self, session_id: str, summarize: Summarizer):
+        if session_id in self._running:
+            return
+        # 使用空的 context, 避免后台任务继承图的回调
+        task = asyncio.create_task(self._run(session_id, summarize), context=contextvars.Context())
+        self._running[session_id] = task
+        task.add_done_callback(lambda t: self._running.pop(session_id, None))
+
+    async def _run(self, session_id: str, summarize: Summarizer):
+        try:
+            await self.compact(session_id, summarize)
+        except Exception:
+            self.failures += 1
+            logger.exception("compact session %s failed", session_id)
+
+    async def compact(self, session_id: str, summarize: Summarizer) -> bool:
+        plan = await asyncio.to_thread(compaction_plan, session_id, memory_compact_turns, memory_compact_tokens,
+                                       memory_tail_turns)
+        if plan is None:
+            return False
+        previous = get_session_summary(session_id)["summary"]
+        summary = await summarize(previous, plan["records"])
+        if not await asyncio.to_thread(apply_compaction, session_id, plan, summary):
+            return False
+        self.compactions += 1
+        self.folded_turns += plan["turns"]
+        logger.info("compacted session %s: %d turns folded into summary", session_id, plan["turns"])
+        return True
+
+    def stats(self) -> Dict:
+        return {"running": len(self._running), "compactions": self.compactions,
+                "folded_turns": self.folded_turns, "failures": self.failures}
+
+
+memory_compactor = MemoryCompactor()
+registry.register_collector(stats_collector("memory_compactor", memory_compactor.stats))
@@ -1,7 +1,18 @@
 
-import os, json, time
+import os, gzip, json, copy, time, threading
+from collections import OrderedDict, deque
+from contextlib import contextmanager
 from typing import Dict, List, Tuple, Optional, Any
 
+from utils.text_search import BM25Index
+from utils.context_builder import count_tokens
+from config import feedback_profile_instructions, feedback_profile_exemplars, feedback_exemplar_chars
+
+try:
+    import fcntl
+except ImportError:  # Windows 下只使用进程内的锁
+    fcntl = None
+
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))  # 当前文件所在目录
 PROJECT_ROOT = os.path.dirname(BASE_DIR)  # 项目根目录
 MEM_DIR = os.path.join(PROJECT_ROOT, "data", "memory")
@@ -9,42 +20,318 @@ os.makedirs(MEM_DIR, exist_ok=True)
 FEEDBACK_DIR = "data/feedback_memory"
 os.makedirs(FEEDBACK_DIR, exist_ok=True)
 
+_TAIL_SIZE = 50  # 内存中缓存每个 session 最近的记录数
+# 以下缓存各自最多保留的 session 数, 按最近使用淘汰, 被淘汰的 session 下次使用时从文件重建
+_SESSION_CACHE_SIZE = 1024
+# 缓存都带上文件的 inode: 压缩会用新文件替换热日志, inode 变化即缓存失效
+_tails: "OrderedDict[str, Tuple[int, int, deque]]" = OrderedDict()  # {session_id: (inode, 文件大小, 最近记录)}
+_mem_indexes: "OrderedDict[str, Tuple[int, int, BM25Index]]" = OrderedDict()  # {session_id: (inode, 已索引到的字节位置, 倒排索引)}, doc_id 为记录所在行的偏移
+_summaries: "OrderedDict[str, Tuple[Tuple[int, int], Dict]]" = OrderedDict()  # {session_id: ((mtime, 大小), 滚动摘要)}
+_profiles: "OrderedDict[str, Dict]" = OrderedDict()  # {session_id: 反馈画像}, 画像中的 size 即已计入的日志字节数
+_cache_lock = threading.Lock()
+_locks: Dict[str, Tuple[threading.Lock, int]] = {}  # {key: (锁, 使用中的线程数)}, 没有线程使用时删除
+_locks_guard = threading.Lock()
+
+
 def _mem_path(session_id: str) -> str:
+    return os.path.join(MEM_DIR, f"session_{session_id}.jsonl")
+
+
+def _legacy_mem_path(session_id: str) -> str:
     return os.path.join(MEM_DIR, f"session_{session_id}.json")
 
+
+def _summary_path(session_id: str) -> str:
+    return os.path.join(MEM_DIR, f"session_{session_id}.summary.json")
+
+
+def _archive_path(session_id: str) -> str:
+    return os.path.join(MEM_DIR, f"session_{session_id}.archive.jsonl.gz")
+
+
+def _cache_get(cache: OrderedDict, session_id: str):
+    with _cache_lock:
+        value = cache.get(session_id)
+        if value is not None:
+            cache.move_to_end(session_id)
+        return value
+
+
+def _cache_put(cache: OrderedDict, session_id: str, value):
+    with _cache_lock:
+        cache[session_id] = value
+        cache.move_to_end(session_id)
+        while len(cache) > _SESSION_CACHE_SIZE:
+            cache.popitem(last=False)
+
+
+def _cache_pop(cache: OrderedDict, session_id: str):
+    with _cache_lock:
+        cache.pop(session_id, None)
+
+
+@contextmanager
+def _lock(key: str):
+    """进程内按 key 互斥的线程锁, 按引用计数创建和删除"""
+    with _locks_guard:
+        lock, users = _locks.get(key, (None, 0))
+        lock = lock or threading.Lock()
+        _locks[key] = (lock, users + 1)
+    try:
+        with lock:
+            yield
+    finally:
+        with _locks_guard:
+            lock, users = _locks[key]
+            if users == 1:
+                del _locks[key]
+            else:
+                _locks[key] = (lock, users - 1)
+
+
+@contextmanager
+def _session_lock(session_id: str, f):
+    """进程内用线程锁, 跨 uvicorn worker 用文件锁"""
+    with _lock(session_id):
+        if fcntl:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+def _parse_lines(lines) -> List[Dict]:
+    records = []
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            records.append(json.loads(line))
+        except json.JSONDecodeError:
+            # 进程崩溃可能留下写了一半的最后一行, 跳过
+            continue
+    return records
+
+
+def _migrate_legacy(session_id: str):
+    """把旧版整文件 JSON 的历史转换为 JSONL, 旧文件改名保留"""
+    legacy = _legacy_mem_path(session_id)
+    with open(legacy, "r", encoding="utf-8") as f:
+        try:
+            history = json.load(f).get("history", [])
+        except json.JSONDecodeError:
+            history = []
+    tmp = f"{_mem_path(session_id)}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        for rec in history:
+            f.write(json.dumps(rec, ensure_ascii=False) + "\n")
+    os.replace(tmp, _mem_path(session_id))
+    os.replace(legacy, f"{legacy}.migrated")
+
+
 def init_session(session_id: str):
     path = _mem_path(session_id)
     if not os.path.exists(path):
-        with open(path, "w", encoding="utf-8") as f:
-            json.dump({"history": []}, f, ensure_ascii=False, indent=2)
+        with _lock(session_id):
+            if os.path.exists(path):
+                return
+            if os.path.exists(_legacy_mem_path(session_id)):
+                _migrate_legacy(session_id)
+            else:
+                open(path, "a", encoding="utf-8").close()
 
 def load_session(session_id: str) -> Dict:
+    """滚动摘要 + 热日志中的近期记录; 已折叠的原始记录在冷归档中, 见 load_archived_history"""
     init_session(session_id)
     with open(_mem_path(session_id), "r", encoding="utf-8") as f:
-        return json.load(f)
+        return {"summary": get_session_summary(session_id)["summary"], "history": _parse_lines(f)}
+
+def load_archived_history(session_id: str) -> List[Dict]:
+    """读取冷归档中已被折叠进摘要的原始记录"""
+    path = _archive_path(session_id)
+    if not os.path.exists(path):
+        return []
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        return _parse_lines(f)
 
 def append_session(session_id: str, role: str, text: str):
-    s = load_session(session_id)
-    s["history"].append({"role": role, "text": text, "ts": time.time()})
-    with open(_mem_path(session_id), "w", encoding="utf-8") as f:
-        json.dump(s, f, ensure_ascii=False, indent=2)
+    """追加一条记录, 只写一行, 与历史长度无关"""
+    init_session(session_id)
+    rec = {"role": role, "text": text, "ts": time.time()}
+    line = (json.dumps(rec, ensure_ascii=False) + "\n").encode("utf-8")
+    path = _mem_path(session_id)
+    while True:
+        with open(path, "ab") as f:
+            with _session_lock(session_id, f):
+                ino = os.fstat(f.fileno()).st_ino
+                if ino != os.stat(path).st_ino:
+                    continue  # 等锁期间热日志被压缩替换, 重新打开新文件
+                offset = f.seek(0, os.SEEK_END)
+                f.write(line)
+                f.flush()
+                size = f.tell()
+                cached = _cache_get(_tails, session_id)
+                if cached and cached[:2] == (ino, offset):
+                    cached[2].append(rec)
+                    _cache_put(_tails, session_id, (ino, size, cached[2]))
+                indexed = _cache_get(_mem_indexes, session_id)
+                if indexed and indexed[:2] == (ino, offset):
+                    indexed[2].add(offset, text)
+                    _cache_put(_mem_indexes, session_id, (ino, size, indexed[2]))
+                return
+
+def _read_tail(session_id: str, n: int = _TAIL_SIZE, block: int = 64 * 1024) -> List[Dict]:
+    """从文件末尾向前读, 只解析最后 n 条"""
+    with open(_mem_path(session_id), "rb") as f:
+        f.seek(0, os.SEEK_END)
+        pos = f.tell()
+        data = b""
+        while pos > 0 and data.count(b"\n") <= n:
+            step = min(block, pos)
+            pos -= step
+            f.seek(pos)
+            data = f.read(step) + data
+    lines = data.decode("utf-8", errors="ignore").splitlines()
+    if pos > 0:
+        lines = lines[1:]  # 第一行可能不完整
+    return _parse_lines(lines[-n:])
+
+def get_recent_history(session_id: str) -> List[Dict]:
+    """
+    获取最近的记录, 优先使用内存缓存
+    文件大小与缓存不一致(如其他 worker 写入)时重新从文件末尾读取
+    """
+    init_session(session_id)
+    st = os.stat(_mem_path(session_id))
+    cached = _cache_get(_tails, session_id)
+    if cached and cached[:2] == (st.st_ino, st.st_size):
+        return list(cached[2])
+    tail = deque(_read_tail(session_id), maxlen=_TAIL_SIZE)
+    _cache_put(_tails, session_id, (st.st_ino, st.st_size, tail))
+    return list(tail)
+
+def _sync_memory_index(session_id: str, f) -> BM25Index:
+    """
+    获取 session 热日志的倒排索引, f 为以二进制打开的热日志; 调用方需持有 _lock(session_id)
+    首次使用时从文件构建, 之后由 append_session 增量更新; 其他 worker 追加的记录从上次位置补读
+    """
+    st = os.fstat(f.fileno())
+    ino, upto, index = _cache_get(_mem_indexes, session_id) or (None, 0, None)
+    if index is None or ino != st.st_ino:
+        upto, index = 0, BM25Index()
+    if st.st_size > upto:
+        f.seek(upto)
+        for line in f:
+            if not line.endswith(b"\n"):
+                break  # 其他进程正在写的行, 下次再读
+            for rec in _parse_lines([line.decode("utf-8", errors="ignore")]):
+                index.add(upto, rec.get("text", ""))
+            upto += len(line)
+    _cache_put(_mem_indexes, session_id, (st.st_ino, upto, index))
+    return index
+
+def _read_records(f, offsets: List[int]) -> List[Dict]:
+    records = []
+    for offset in offsets:
+        f.seek(offset)
+        records.extend(_parse_lines([f.readline().decode("utf-8", errors="ignore")]))
+    return records
 
 def query_session_keywords(session_id: str, query: str, top_k: int=3) -> List[Dict]:
-    s = load_session(session_id)
-    q_tokens = set([t.lower() for t in query.split() if len(t)>1])
-    scored = []
-    for rec in s["history"]:
-        text = rec.get("text","").lower()
-        score = sum(text.count(t) for t in q_tokens)
-        scored.append((score, rec))
-    scored.sort(key=lambda x: x[0], reverse=True)
-    return [rec for score, rec in scored[:top_k] if score>0]
+    """BM25 检索热日志中的历史记录, 只读取命中的行; 索引和读取使用同一个文件, 不受压缩替换影响"""
+    init_session(session_id)
+    with open(_mem_path(session_id), "rb") as f:
+        # append_session 会在同一把锁下修改倒排表, 检索也需持锁
+        with _lock(session_id):
+            hits = _sync_memory_index(session_id, f).search(query, top_k)
+        return _read_records(f, [offset for offset, score in hits])
+
+
+def get_session_summary(session_id: str) -> Dict:
+    """滚动摘要 {"summary", "turns": 已折叠的轮数, "updated"}, 文件未变化时使用缓存"""
+    try:
+        st = os.stat(_summary_path(session_id))
+    except FileNotFoundError:
+        return {"summary": "", "turns": 0, "updated": None}
+    key = (st.st_mtime_ns, st.st_size)
+    cached = _cache_get(_summaries, session_id)
+    if cached and cached[0] == key:
+        return cached[1]
+    try:
+        with open(_summary_path(session_id), "r", encoding="utf-8") as f:
+            summary = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {"summary": "", "turns": 0, "updated": None}
+    _cache_put(_summaries, session_id, (key, summary))
+    return summary
+
+
+def compaction_plan(session_id: str, max_turns: int, max_tokens: int, tail_turns: int) -> Optional[Dict]:
+    """
+    热日志的轮数(user 记录数)或 token 数超过阈值时, 返回要折叠的部分:
+    {"ino": 热日志 inode, "cut": 折叠到的字节位置, "records": 折叠的记录, "turns": 折叠的轮数}
+    最近 tail_turns 轮保留在热日志中; 折叠的部分不足 tail_turns 轮且不足 max_tokens 的一半时不压缩,
+    避免近期几轮本身已超过 token 阈值时每来一轮就折叠一轮、多一次摘要调用
+    """
+    init_session(session_id)
+    items, tokens, pos = [], 0, 0
+    with open(_mem_path(session_id), "rb") as f:
+        ino = os.fstat(f.fileno()).st_ino
+        for line in f:
+            if not line.endswith(b"\n"):
+                break
+            for rec in _parse_lines([line.decode("utf-8", errors="ignore")]):
+                items.append((pos, rec, count_tokens(rec.get("text", ""))))
+                tokens += items[-1][2]
+            pos += len(line)
+    turns = [offset for offset, rec, _ in items if rec.get("role") == "user"]
+    tail_turns = max(1, tail_turns)
+    if len(turns) <= tail_turns or (len(turns) < max_turns and tokens < max_tokens):
+        return None
+    cut = turns[-tail_turns]
+    folded = [rec for offset, rec, _ in items if offset < cut]
+    folded_turns = sum(1 for rec in folded if rec.get("role") == "user")
+    folded_tokens = sum(n for offset, _, n in items if offset < cut)
+    if folded_turns < tail_turns and folded_tokens < max_tokens / 2:
+        return None
+    return {"ino": ino, "cut": cut, "records": folded, "turns": folded_turns}
+
+
+def apply_compaction(session_id: str, plan: Dict, summary: str) -> bool:
+    """
+    cut 之前的原始记录追加到冷归档(gzip), 保存新摘要, 热日志替换为 cut 之后的部分
+    计划生成后热日志已被其他压缩替换时放弃, 返回 False
+    """
+    path = _mem_path(session_id)
+    with open(path, "rb") as f:
+        with _session_lock(session_id, f):
+            if os.fstat(f.fileno()).st_ino != plan["ino"] or os.stat(path).st_ino != plan["ino"]:
+                return False
+            head = f.read(plan["cut"])
+            rest = f.read()
+            with gzip.open(_archive_path(session_id), "ab") as gz:
+                gz.write(head)
+            previous = get_session_summary(session_id)
+            tmp = f"{_summary_path(session_id)}.{os.getpid()}.tmp"
+            with open(tmp, "w", encoding="utf-8") as out:
+                json.dump({"summary": summary, "turns": previous["turns"] + plan["turns"], "updated": time.time()},
+                          out, ensure_ascii=False)
+            os.replace(tmp, _summary_path(session_id))
+            tmp = f"{path}.{os.getpid()}.tmp"
+            with open(tmp, "wb") as out:
+                out.write(rest)
+            os.replace(tmp, path)
+            _cache_pop(_tails, session_id)
+            _cache_pop(_mem_indexes, session_id)
+    return True
 
 
 def find_last_qa(session_id: str) -> Tuple[Optional[Dict[str, Any]], Optional[Dict[str, Any]]]:
-    s = load_session(session_id)
-    history = s.get("history")
-    if not isinstance(history, list) or not history:
+    history = get_recent_history(session_id)
+    if not history:
         return None, None
 
     latest_user_index = -1
@@ -68,44 +355,155 @@ def find_last_qa(session_id: str) -> Tuple[Optional[Dict[str, Any]], Optional[Di
 
 
 def _get_memory_path(session_id: str) -> str:
-    """根据 session_id 生成对应记忆文件路径"""
+    """根据 session_id 生成对应记忆文件路径(旧版整文件 JSON)"""
     filename = f"feedback_{session_id}.json"
     return os.path.join(FEEDBACK_DIR, filename)
 
 
-def save_feedback_memory(entry: Dict):
-    """
-    将反馈存入指定记忆文件中。
-    """
-    session_id = entry.get("session_id", "default_session")
-    path = _get_memory_path(session_id)
+def _feedback_log_path(session_id: str) -> str:
+    return os.path.join(FEEDBACK_DIR, f"feedback_{session_id}.jsonl")
+
 
-    # 读取原有数据
-    data: List[Dict] = []
-    if os.path.exists(path):
+def _feedback_profile_path(session_id: str) -> str:
+    return os.path.join(FEEDBACK_DIR, f"feedback_{session_id}.profile.json")
+
+
+def _init_feedback_log(session_id: str):
+    """把旧版整文件 JSON 的反馈转换为追加写的 JSONL, 旧文件改名保留"""
+    path = _feedback_log_path(session_id)
+    legacy = _get_memory_path(session_id)
+    if os.path.exists(path) or not os.path.exists(legacy):
+        return
+    with _lock(f"feedback:{session_id}"):
+        if os.path.exists(path) or not os.path.exists(legacy):
+            return
         try:
-            with open(path, "r", encoding="utf-8") as f:
+            with open(legacy, "r", encoding="utf-8") as f:
                 data = json.load(f)
         except json.JSONDecodeError:
             data = []
+        tmp = f"{path}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            for rec in data:
+                f.write(json.dumps(rec, ensure_ascii=False) + "\n")
+        os.replace(tmp, path)
+        os.replace(legacy, f"{legacy}.migrated")
+
+
+def _empty_profile() -> Dict:
+    # size: 已计入画像的日志字节数, instructions: 按时间从旧到新, 不重复
+    return {"size": 0, "count": 0, "instructions": [], "exemplars": []}
+
 
-    # 写入新记录
+def _apply_feedback(profile: Dict, entry: Dict):
+    profile["count"] += 1
+    if entry.get("satisfied"):
+        answer = entry.get("answer") or ""
+        if answer:
+            profile["exemplars"].append({"question": (entry.get("question") or "")[:feedback_exemplar_chars],
+                                         "answer": answer[:feedback_exemplar_chars], "ts": entry.get("ts")})
+            del profile["exemplars"][:-feedback_profile_exemplars]
+        return
+    text = (entry.get("feedback") or "").strip()
+    if text:
+        instructions = profile["instructions"]
+        if text in instructions:
+            instructions.remove(text)
+        instructions.append(text)
+        del instructions[:-feedback_profile_instructions]
+
+
+def _catch_up(session_id: str, profile: Dict):
+    """从画像记录的位置继续读取日志, 只处理完整的行"""
+    path = _feedback_log_path(session_id)
+    if not os.path.exists(path) or os.path.getsize(path) <= profile["size"]:
+        return
+    with open(path, "rb") as f:
+        f.seek(profile["size"])
+        for line in f:
+            if not line.endswith(b"\n"):
+                break
+            for rec in _parse_lines([line.decode("utf-8", errors="ignore")]):
+                _apply_feedback(profile, rec)
+            profile["size"] += len(line)
+
+
+def _read_profile_file(session_id: str) -> Dict:
+    try:
+        with open(_feedback_profile_path(session_id), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return _empty_profile()
+
+
+def _write_profile_file(session_id: str, profile: Dict):
+    path = _feedback_profile_path(session_id)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(profile, f, ensure_ascii=False)
+    os.replace(tmp, path)
+
+
+def _sync_profile(session_id: str) -> Dict:
+    """画像补齐到日志末尾, 返回新对象(缓存中的画像可能正被读取, 不原地修改); 调用方持有锁"""
+    profile = _read_profile_file(session_id)
+    cached = _cache_get(_profiles, session_id)
+    if cached and cached["size"] > profile["size"]:
+        profile = copy.deepcopy(cached)
+    path = _feedback_log_path(session_id)
+    if profile["size"] > (os.path.getsize(path) if os.path.exists(path) else 0):
+        profile = _empty_profile()  # 日志被替换或截断, 重新统计
+    _catch_up(session_id, profile)
+    return profile
+
+
+def get_feedback_profile(session_id: str) -> Dict:
+    """
+    session 的反馈画像(只读): 最近不重复的不满意意见, 最近满意回答的示例
+    日志大小与缓存一致时直接返回; 其他 worker 追加过反馈时从画像文件和日志增量补齐
+    """
+    _init_feedback_log(session_id)
+    path = _feedback_log_path(session_id)
+    size = os.path.getsize(path) if os.path.exists(path) else 0
+    cached = _cache_get(_profiles, session_id)
+    if cached and cached["size"] == size:
+        return cached
+    with _lock(f"feedback:{session_id}"):
+        profile = _sync_profile(session_id)
+        _cache_put(_profiles, session_id, profile)
+        return profile
+
+
+def save_feedback_memory(entry: Dict):
+    """
+    追加一条反馈到日志, 并增量更新反馈画像, 与反馈总数无关
+    """
+    session_id = entry.get("session_id", "default_session")
+    _init_feedback_log(session_id)
     entry["ts"] = time.time()
-    data.append(entry)
-    with open(path, "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
+    line = (json.dumps(entry, ensure_ascii=False) + "\n").encode("utf-8")
+    with open(_feedback_log_path(session_id), "ab+") as f:
+        with _session_lock(f"feedback:{session_id}", f):
+            end = f.seek(0, os.SEEK_END)
+            if end:
+                f.seek(end - 1)
+                if f.read(1) != b"\n":
+                    f.write(b"\n")  # 崩溃留下的半行单独成行, 不影响新记录
+            f.write(line)
+            f.flush()
+            profile = _sync_profile(session_id)
+            _write_profile_file(session_id, profile)
+            _cache_put(_profiles, session_id, profile)
 
 
 def load_feedback_memory(session_id: str) -> List[Dict]:
     """加载全部记忆反馈"""
-    path = _get_memory_path(session_id)
+    _init_feedback_log(session_id)
+    path = _feedback_log_path(session_id)
     if not os.path.exists(path):
         return []
-    try:
-        with open(path, "r", encoding="utf-8") as f:
-            return json.load(f)
-    except json.JSONDecodeError:
-        return []
+    with open(path, "r", encoding="utf-8") as f:
+        return _parse_lines(f)
 
 
 def get_recent_feedbacks(session_id: str, limit: int = 3) -> List[Dict]:
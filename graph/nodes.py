@@ -1,119 +1,238 @@
 
-import os
 import time
-from typing import Dict
+import asyncio
+import hashlib
+from typing import Dict, List, Optional, Tuple
 
-from langchain_openai import ChatOpenAI
-from langchain_ollama import OllamaEmbeddings
-from langchain_community.vectorstores import FAISS
-from langchain_text_splitters import RecursiveCharacterTextSplitter
 from langchain_core.output_parsers import JsonOutputParser
 from langchain.messages import HumanMessage
 from langchain_core.prompts import PromptTemplate
 
 from .memory_manager import (
     init_session, append_session, query_session_keywords, save_feedback_memory, find_last_qa,
-    load_feedback_memory)
-from config import model, open_api_key, api_base_url, embedding_model
+    get_feedback_profile, get_session_summary)
+from .memory_compactor import memory_compactor
+from .node_helper import make_prompt_from_feedback_memory
+from .index_manager import get_session_index, corpus_key
+from .answer_cache import SemanticAnswerCache
+from .ingest_manager import ingest_manager
+from .intent_manager import intent_manager
+from .embedding_cache import CachedEmbeddings
+from .llm_scheduler import ScheduledChatModel
+from config import (
+    model, open_api_key, api_base_url, embedding_model, embedding_cache_path, embedding_cache_bytes,
+    embedding_query_cache_size, retrieve_k, retrieve_fetch_k, rrf_k, rrf_vector_weight, rrf_bm25_weight,
+    answer_cache_threshold, answer_cache_ttl, answer_cache_max_entries,
+    context_token_budget, context_budget_shares, context_mmr_lambda, intent_context_tokens, intent_answer_tokens,
+    llm_http_max_connections, llm_http_timeout, memory_compact_tokens, memory_summary_tokens)
 from utils.agent_utils import make_prompt, log_node_entry
+from utils.progress_bus import progress_bus
+from utils.startup import Lazy
+from utils.text_search import reciprocal_rank_fusion
+from utils.context_builder import build_context, truncate_to_tokens
+from utils.metrics import registry, stats_collector, span_set, cache_requests, retrieved_chunks, index_size
 from .state_schema import IntentResult
 
 
-llm = ChatOpenAI(model=model, temperature=0, api_key=open_api_key, openai_api_base=api_base_url)
-embeddings = OllamaEmbeddings(model=embedding_model)
+def _make_llm():
+    import httpx
+    from langchain_openai import ChatOpenAI
 
+    # 所有 LLM 请求共用一个 HTTP 连接池; 重试由调度器负责, 客户端自身不再重试
+    http_client = httpx.AsyncClient(limits=httpx.Limits(max_connections=llm_http_max_connections,
+                                                        max_keepalive_connections=llm_http_max_connections),
+                                    timeout=llm_http_timeout)
+    return ChatOpenAI(model=model, temperature=0, api_key=open_api_key, openai_api_base=api_base_url,
+                      max_retries=0, http_async_client=http_client)
 
-@log_node_entry("load_documents", "解析上传的文档")
-async def load_documents(state: Dict):
-    """加载 session 的上传文档"""
-    
-    session_id = state.get("session_id", "default")
-    data_dir = os.path.join("data/uploaded_files", session_id)
-    docs = []
-    if os.path.exists(data_dir):
-        for fn in os.listdir(data_dir):
-            if fn.lower().endswith((".txt", ".md")):
-                with open(os.path.join(data_dir, fn), "r", encoding="utf-8") as f:
-                    docs.append(f.read())
-    state["documents"] = docs
-    init_session(session_id)
-    return {"documents": docs}
 
+def _make_embeddings():
+    from langchain_ollama import OllamaEmbeddings
+    return OllamaEmbeddings(model=embedding_model)
 
-@log_node_entry("build_vector_index", "构建向量数据索引")
-async def build_vector_index(state: Dict):
-    """构建或加载 FAISS 索引"""
-    
-    session_id = state.get("session_id", "default")
-    vs_dir = os.path.join("data/vectorstore", f"{session_id}_faiss")
-    docs = state.get("documents", [])
-    if not docs:
-        return {}
 
-    splitter = RecursiveCharacterTextSplitter(chunk_size=600, chunk_overlap=100)
-    chunks = []
-    for d in docs:
-        chunks.extend(splitter.split_text(d))
+# 模型在首次调用(或启动预热)时才构造, 导入本模块不再加载 openai / ollama 客户端
+llm = ScheduledChatModel(factory=Lazy("llm", _make_llm))
+embeddings = CachedEmbeddings(Lazy("embeddings", _make_embeddings), embedding_model,
+                              embedding_cache_path, embedding_cache_bytes, embedding_query_cache_size)
+answer_cache = SemanticAnswerCache(answer_cache_max_entries, answer_cache_ttl, answer_cache_threshold)
+registry.register_collector(stats_collector("embedding_cache", embeddings.stats))
+registry.register_collector(stats_collector("answer_cache", answer_cache.stats))
+
+
+def collect_feedbacks(session_id: str) -> Tuple[List[str], str]:
+    """反馈画像中最近的不满意意见(从旧到新), 以及满意回答的风格提示"""
+    profile = get_feedback_profile(session_id)
+    return list(profile["instructions"]), make_prompt_from_feedback_memory(session_id)
+
+
+def answer_cache_key(session_id: str, feedbacks: List[str], feedback_style: str = "", private: bool = False) -> str:
+    """
+    回答缓存的分区: 文档集版本 + 反馈画像hash
+    private: 上下文中带有本 session 的记忆(摘要或命中记录), 回答和上下文只能在本 session 内复用
+    """
+    profile_text = "\n".join(sorted(feedbacks)) + "\n" + feedback_style
+    feedback_hash = hashlib.sha256(profile_text.encode("utf-8")).hexdigest()[:16]
+    key = f"{corpus_key(session_id)}:{feedback_hash}"
+    return f"{key}:{session_id}" if private else key
+
 
-    vectorstore = FAISS.from_texts(chunks, embedding=embeddings)
-    os.makedirs(vs_dir, exist_ok=True)
-    vectorstore.save_local(vs_dir)
+def lookup_cached_answer(shared_key: str, private_key: str, q: str, vector: List[float], memory_hits: List[Dict],
+                         memory_summary: str = "") -> Optional[Tuple[Dict, float]]:
+    """
+    按问题的记忆选择缓存分区查找: 没有用到记忆的查共享分区, 否则查本 session 的私有分区
+    私有分区未命中时, 若没有摘要且命中的记忆只是这个问题之前的问答本身(同样的问题及共享分区中的回答),
+    记忆没有给上下文带来别的信息, 共享分区的回答同样适用; 同一 session 重复提问即属于这种情况
+    """
+    if not memory_hits and not memory_summary:
+        return answer_cache.lookup(shared_key, vector)
+    hit = answer_cache.lookup(private_key, vector)
+    if hit is not None or memory_summary:
+        return hit
+    hit = answer_cache.lookup(shared_key, vector)
+    if hit is None:
+        return None
+    question, answer = q.strip(), hit[0]["answer"]
+    if all((h.get("role") == "user" and h.get("text", "").strip() == question)
+           or (h.get("role") == "assistant" and h.get("text") == answer) for h in memory_hits):
+        return hit
+    return None
+
+
+async def hybrid_candidates(session_index, bm25, q: str, vector: List[float]) -> List[Tuple[str, float]]:
+    """向量检索与 BM25 并行召回, 用倒数排名融合(RRF)合并, 返回 [(chunk 文本, 分数)]"""
+    vec_hits, lex_hits = await asyncio.gather(
+        asyncio.to_thread(session_index.search, vector, retrieve_fetch_k),
+        asyncio.to_thread(bm25.search, q, retrieve_fetch_k),
+    )
+    fused = reciprocal_rank_fusion(
+        [[pos for pos, _ in vec_hits], [pos for pos, _ in lex_hits]],
+        [rrf_vector_weight, rrf_bm25_weight], rrf_k)
+    index_size.observe(len(session_index))
+    return [(session_index.text(pos), score) for pos, score in fused[:retrieve_fetch_k]]
 
-    state["vector_index_path"] = vs_dir
-    return {"vector_index_path": vs_dir}
+
+def assemble_context(candidates: List[Tuple[str, float]], memory_hits: List[Dict], feedbacks: List[str],
+                     budget: int = None, memory_summary: str = "", feedback_style: str = "") -> Dict:
+    """
+    在 token 预算内组装上下文: 反馈(含风格提示)和记忆按份额截断, 文档用 MMR 去重挑选
+    记忆部分为 滚动摘要 + 热日志中的命中记录, 摘要优先
+    """
+    memory_texts = ([f"之前对话的摘要: {memory_summary}"] if memory_summary else []) + [h["text"] for h in memory_hits]
+    built = build_context(candidates, memory_texts, feedbacks,
+                          budget or context_token_budget, context_budget_shares, retrieve_k, context_mmr_lambda,
+                          feedback_style)
+    retrieved_chunks.observe(len(built["documents"]))
+    return built
+
+
+@log_node_entry("wait_ingest", "等待文档入库完成")
+async def wait_ingest(state: Dict):
+    """文档的解析与索引在 /upload 时已交给后台任务, 这里只等待其完成"""
+    
+    session_id = state.get("session_id", "default")
+    init_session(session_id)
+    await ingest_manager.ensure_indexed(session_id)
+    return {}
 
 
 @log_node_entry("memory_read", "匹配过往记忆")
 async def memory_read(state: Dict):
-    """简单关键词匹配记忆"""
+    """滚动摘要 + BM25 倒排索引检索热日志中的近期记忆, 已压缩的历史只通过摘要参与"""
     
     session_id = state.get("session_id", "default")
     q = state.get("question", "")
     if not q:
         return {}
-    hits = query_session_keywords(session_id, q, top_k=3)
+    hits = await asyncio.to_thread(query_session_keywords, session_id, q, 3)
+    summary = get_session_summary(session_id)["summary"]
+    span_set(memory_hits=len(hits))
     state["memory_hits"] = hits
-    return {"memory_hits": hits}
+    state["memory_summary"] = summary
+    return {"memory_hits": hits, "memory_summary": summary}
 
 
 @log_node_entry("feedback_read", "结合过往反馈")
 async def feedback_read(state: Dict):
-    """统计历史反馈"""
+    """读取反馈画像, 增量维护, 不扫描反馈历史"""
     
     session_id = state.get("session_id")
-    feedbacks = load_feedback_memory(session_id)
-    feedbacks = list({d.get("feedback") for d in feedbacks[::-1] if not d.get("satisfied") and d.get("feedback")})[-10:]
+    feedbacks, feedback_style = collect_feedbacks(session_id)
     state.update({
-        "feedbacks": feedbacks
+        "feedbacks": feedbacks,
+        "feedback_style": feedback_style
     })
     
-    return {"feedbacks": feedbacks}
+    return {"feedbacks": feedbacks, "feedback_style": feedback_style}
 
 
-@log_node_entry("retrieve_context", "提炼问题相关上下文")
-async def retrieve_context(state: Dict):
+@log_node_entry("answer_cache", "查找相似问题的历史回答")
+async def lookup_answer_cache(state: Dict):
     """
-    根据feedback或question的内容, 获取向量结果
+    语义回答缓存: 文档集版本 + 反馈画像hash 相同, 且问题向量足够相似时直接复用回答
+    用到会话记忆的回答只在本 session 内复用; 问题向量同时留给检索使用, 不重复向量化
     """
     session_id = state.get("session_id", "default")
     q = state.get("question", "")
-    vs_dir = state.get("vector_index_path", os.path.join("data/vectorstore", f"{session_id}_faiss"))
-    retrieved = []
-
-    if os.path.exists(vs_dir):
-        vectorstore = FAISS.load_local(vs_dir, embeddings, allow_dangerous_deserialization=True)
-        docs = await vectorstore.asimilarity_search(q, k=3)
-        retrieved = [d.page_content for d in docs]
+    memory_hits, memory_summary = state.get("memory_hits") or [], state.get("memory_summary", "")
+    feedbacks, feedback_style = state.get("feedbacks", []), state.get("feedback_style", "")
+    shared_key = await asyncio.to_thread(answer_cache_key, session_id, feedbacks, feedback_style)
+    private_key = await asyncio.to_thread(answer_cache_key, session_id, feedbacks, feedback_style, True)
+    cache_key = private_key if memory_hits or memory_summary else shared_key
+    vector = await embeddings.aembed_query(q)
+    update = {"question_vector": vector, "cache_key": cache_key, "cache_hit": False}
+
+    # 不满意重新生成时不能再返回同样的回答
+    if state.get("satisfied") is False:
+        cache_requests.inc(cache="answer", result="bypass")
+        return update
+    hit = lookup_cached_answer(shared_key, private_key, q, vector, memory_hits, memory_summary)
+    cache_requests.inc(cache="answer", result="miss" if hit is None else "hit")
+    span_set(cache_hit=hit is not None)
+    if hit is None:
+        return update
+
+    entry, score = hit
+    await progress_bus.publish(session_id, f"⚡命中缓存回答(相似度 {score:.3f}), 跳过检索与生成")
+    await asyncio.to_thread(append_session, session_id, "user", q)
+    new_memory_entry = {"question": q, "answer": entry["answer"], "context": entry["context"],
+                        "feedback": state.get("feedback", ""), "ts": time.time()}
+    update.update({"cache_hit": True, "answer": entry["answer"], "context": entry["context"],
+                   "new_memory_entry": new_memory_entry})
+    return update
+
+
+def route_after_cache(state: Dict) -> str:
+    return "dispatch_intent" if state.get("cache_hit") else "retrieve"
 
-    if not retrieved:
-        for d in state.get("documents", []):
-            if q.lower() in d.lower():
-                retrieved.append(d[:1000])
 
-    mem_texts = [h["text"] for h in state.get("memory_hits", [])]
-    state["retrieved_docs"] = retrieved
-    state["context"] = "\n\n".join(retrieved + mem_texts)
-    return {"retrieved_docs": retrieved, "context": state["context"]}
+@log_node_entry("retrieve_context", "提炼问题相关上下文")
+async def retrieve_context(state: Dict):
+    """
+    混合检索: 向量检索与 BM25 并行召回, 再用倒数排名融合(RRF)合并结果
+    上下文在 token 预算内组装: 反馈和记忆按份额截断, 文档用 MMR 去重挑选
+    """
+    session_id = state.get("session_id", "default")
+    q = state.get("question", "")
+    candidates = []
+
+    index = await asyncio.to_thread(get_session_index, session_id)
+    if index is not None and q:
+        session_index, bm25 = index
+        vector = state.get("question_vector") or await embeddings.aembed_query(q)
+        candidates = await hybrid_candidates(session_index, bm25, q, vector)
+        span_set(index_size=len(session_index))
+
+    built = assemble_context(candidates, state.get("memory_hits", []), state.get("feedbacks", []),
+                             state.get("context_budget"), state.get("memory_summary", ""),
+                             state.get("feedback_style", ""))
+    span_set(chunks_retrieved=len(built["documents"]), context_tokens=built["tokens"])
+    state["retrieved_docs"] = built["documents"]
+    state["context"] = built["context"]
+    state["feedbacks"] = built["feedbacks"]
+    state["feedback_style"] = built["feedback_style"]
+    return {"retrieved_docs": built["documents"], "context": built["context"], "feedbacks": built["feedbacks"],
+            "feedback_style": built["feedback_style"], "context_tokens": built["tokens"]}
 
 
 @log_node_entry("generate_answer", "生成回答中, 可能用时几十秒")
@@ -123,19 +242,24 @@ async def generate_answer(state: Dict):
     context = state.get("context", "")
     feedback = state.get("feedback", "")
     
-    append_session(state.get("session_id"), "user", q)
+    await asyncio.to_thread(append_session, state.get("session_id"), "user", q)
 
     prompt = make_prompt(state)
-    messages = [[HumanMessage(content=prompt)]]
-    resp = await llm.agenerate(messages)
-    answer = resp.generations[0][0].text
+    # 用 ainvoke 而不是 agenerate: 前者会继承图的回调上下文, /ask/stream 才能拿到逐 token 输出
+    priority = "feedback" if state.get("satisfied") is False else "interactive"
+    resp = await llm.ainvoke([HumanMessage(content=prompt)],
+                             config={"metadata": {"llm_priority": priority, "session_id": state.get("session_id")}})
+    answer = resp.content
+
+    if state.get("question_vector") and state.get("cache_key"):
+        answer_cache.store(state["cache_key"], state["question_vector"], answer, context)
 
     state["answer"] = answer
     state["new_memory_entry"] = {"question": q, "answer": answer, "context": context, "feedback": feedback, "ts": time.time()}
     return {"answer": answer, "new_memory_entry": state["new_memory_entry"]}
 
 
-@log_node_entry("infer_intent", "推断用户深层需求, 可能用时几十秒")
+@log_node_entry("infer_intent")
 async def infer_intent(state: Dict):
     """推断用户意图"""
     q = state.get("question", "")
@@ -154,11 +278,27 @@ async def infer_intent(state: Dict):
         partial_variables={"intent": parser.get_format_instructions()}
     )
     chain = prompt | llm | parser
-    resp = await chain.ainvoke({"q": q, "answer": answer, "context": context})
+    # 意图推断只需要大意, 上下文和回答按 token 上限截断
+    resp = await chain.ainvoke({"q": q, "answer": truncate_to_tokens(answer, intent_answer_tokens),
+                                "context": truncate_to_tokens(context, intent_context_tokens)},
+                               config={"metadata": {"llm_priority": "intent", "session_id": state.get("session_id")}})
     state["user_intent"] = resp.get("intents")
     return {"user_intent": resp.get("intents")}
 
 
+@log_node_entry("dispatch_intent")
+async def dispatch_intent(state: Dict):
+    """意图推断交给后台任务, 不阻塞回答返回; 请求可通过 skip_intent 跳过"""
+    session_id = state.get("session_id", "default")
+    q = state.get("question", "")
+    if state.get("skip_intent"):
+        intent_manager.skip(session_id, q)
+        return {}
+    snapshot = {k: state.get(k) for k in ("session_id", "question", "context", "answer")}
+    intent_manager.schedule(session_id, q, infer_intent(snapshot))
+    return {}
+
+
 # @log_node_entry("suggest_action")
 # def suggest_action(state: Dict):
 #     """生成行动建议"""
@@ -178,11 +318,25 @@ async def memory_write(state: Dict):
     session_id = state.get("session_id", "default")
     entry = state.get("new_memory_entry")
     if entry:
-        append_session(session_id, "assistant", entry.get("answer", ""))
-        append_session(session_id, "system", f"suggestion:{state.get('suggestion','')}")
+        await asyncio.to_thread(append_session, session_id, "assistant", entry.get("answer", ""))
+        if state.get("suggestion"):
+            await asyncio.to_thread(append_session, session_id, "system", f"suggestion:{state.get('suggestion')}")
+        memory_compactor.schedule(session_id, summarize_history)
     return {}
 
 
+async def summarize_history(previous: str, records: List[Dict]) -> str:
+    """把较早的对话记录合并进滚动摘要, 由 memory_compactor 在后台调用"""
+    names = {"user": "用户", "assistant": "助手"}
+    transcript = "\n".join(f"{names[r['role']]}: {r.get('text', '')}" for r in records if r.get("role") in names)
+    prompt = (f"以下是之前对话的摘要(可能为空):\n{previous}\n\n"
+              f"以下是之后的对话记录:\n{truncate_to_tokens(transcript, memory_compact_tokens)}\n\n"
+              "请把两者合并为一份新的对话摘要, 保留用户关注的问题、已经给出的结论和用户表达过的偏好, "
+              "省略寒暄和重复内容, 只输出摘要。")
+    resp = await llm.ainvoke([HumanMessage(content=prompt)], config={"metadata": {"llm_priority": "summary"}})
+    return truncate_to_tokens(resp.content, memory_summary_tokens)
+
+
 def record_feedback(state: Dict):
     session_id = state.get("session_id")
     last_q, last_a = find_last_qa(session_id)
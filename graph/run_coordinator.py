@@ -0,0 +1,73 @@
+import asyncio
+from contextlib import asynccontextmanager
+from typing import Any, Awaitable, Callable, Dict, Hashable, Tuple
+
+from utils.metrics import registry, stats_collector
+
+
+class RunCoordinator:
+    """
+    按 session 协调图的执行:
+    - 相同请求(同一 session、同样的参数)在执行中时, 后来的请求直接等待同一个结果(single-flight)
+    - 同一 session 的执行串行, 会话记忆与反馈的读写不会交错; 不同 session 之间互不影响
+    共享的执行放在独立的 task 中, 发起请求的连接断开不会取消其他等待者的结果
+    """
+
+    def __init__(self):
+        self._inflight: Dict[Hashable, asyncio.Task] = {}
+        self._locks: Dict[str, asyncio.Lock] = {}
+        self._users: Dict[str, int] = {}  # 持有或等待 session 锁的数量, 归零时释放锁对象
+        self.runs = 0
+        self.coalesced = 0
+
+    @asynccontextmanager
+    async def session(self, session_id: str):
+        """独占 session 执行图, 用于不适合合并的请求(如流式问答)"""
+        lock = self._locks.setdefault(session_id, asyncio.Lock())
+        self._users[session_id] = self._users.get(session_id, 0) + 1
+        try:
+            async with lock:
+                yield
+        finally:
+            self._users[session_id] -= 1
+            if not self._users[session_id]:
+                del self._users[session_id]
+                self._locks.pop(session_id, None)
+
+    async def _run(self, session_id: str, factory: Callable[[], Awaitable[Any]]):
+        async with self.session(session_id):
+            self.runs += 1
+            return await factory()
+
+    async def run(self, session_id: str, key: Hashable, factory: Callable[[], Awaitable[Any]]) -> Tuple[Any, bool]:
+        """返回 (结果, 是否合并到了已有的执行)"""
+        key = (session_id, key)
+        task = self._inflight.get(key)
+        if task is not None:
+            self.coalesced += 1
+            return await asyncio.shield(task), True
+
+        task = asyncio.create_task(self._run(session_id, factory))
+        self._inflight[key] = task
+
+        def done(t: asyncio.Task):
+            if self._inflight.get(key) is t:
+                del self._inflight[key]
+            if not t.cancelled():
+                t.exception()  # 所有等待者都已离开时避免 "exception was never retrieved"
+
+        task.add_done_callback(done)
+        return await asyncio.shield(task), False
+
+    def stats(self):
+        return {
+            "runs": self.runs,
+            "coalesced": self.coalesced,
+            "in_flight": len(self._inflight),
+            "active_sessions": len(self._users),
+            "waiting": sum(n - 1 for n in self._users.values() if n > 1),
+        }
+
+
+run_coordinator = RunCoordinator()
+registry.register_collector(stats_collector("run_coordinator", run_coordinator.stats))
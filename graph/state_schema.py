@@ -10,12 +10,20 @@ class InsightState(TypedDict, total=False):
     context: str
     answer: str
     user_intent: str
+    skip_intent: bool
     suggestion: str
     memory_hits: List[Dict]
+    memory_summary: str
     new_memory_entry: Dict
     feedback: Optional[str]
     satisfied: bool
     feedbacks: List[str]
+    feedback_style: str
+    question_vector: List[float]
+    cache_key: str
+    cache_hit: bool
+    context_budget: int
+    context_tokens: int
 
 
 class IntentResult(BaseModel):
@@ -1,44 +1,95 @@
 import os
-import pandas as pd
-import docx
-from PyPDF2 import PdfReader
-from typing import Dict
+import importlib
+from typing import Dict, List
 import functools
-import datetime
-import asyncio
-
-def parse_file(file_path: str) -> str:
-    """将不同格式文件解析为纯文本"""
+import json
+import time
+import queue
+import atexit
+import logging
+import threading
+from logging.handlers import QueueHandler, QueueListener
+
+from config import log_level
+from .metrics import current_span, node_duration, node_errors
+from .progress_bus import progress_bus
+from .startup import Lazy
+
+# 日志先写入内存队列, 由后台线程输出, 节点内不做同步 I/O
+logger = logging.getLogger("insightai")
+logger.setLevel(log_level)
+logger.propagate = False
+_log_queue = queue.SimpleQueue()
+logger.addHandler(QueueHandler(_log_queue))
+_log_listener = None
+_log_listener_lock = threading.Lock()
+
+
+def ensure_log_listener():
+    """首次记录日志时才启动输出线程(解析子进程也会导入本模块, 不需要该线程)"""
+    global _log_listener
+    if _log_listener is None:
+        with _log_listener_lock:
+            if _log_listener is None:
+                handler = logging.StreamHandler()
+                handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s %(message)s"))
+                listener = QueueListener(_log_queue, handler, respect_handler_level=True)
+                listener.start()
+                atexit.register(listener.stop)
+                _log_listener = listener
+
+# 解析库只在解析子进程中实际用到, 首次解析对应格式时才导入
+_pandas = Lazy("pandas", lambda: importlib.import_module("pandas"))
+_docx = Lazy("docx", lambda: importlib.import_module("docx"))
+_pypdf = Lazy("pypdf2", lambda: importlib.import_module("PyPDF2"))
+
+
+def parse_file_segments(file_path: str) -> List[Dict]:
+    """
+    将不同格式文件解析为文本片段列表 [{"text": ..., "page": ...}]
+    PDF 按页返回, 不再拼接为一个大字符串; 其他格式返回单个片段
+    该函数会在子进程中执行, 参数与返回值需可 pickle
+    """
     ext = os.path.splitext(file_path)[1].lower()
-    text = ""
 
-    if ext == ".txt":
+    if ext in (".txt", ".md"):
         with open(file_path, "r", encoding="utf-8", errors="ignore") as f:
-            text = f.read()
-
-    elif ext == ".pdf":
-        reader = PdfReader(file_path)
-        text = "\n".join([page.extract_text() or "" for page in reader.pages])
-
-    elif ext == ".docx":
-        doc = docx.Document(file_path)
+            return [{"text": f.read().strip()}]
+
+    if ext == ".pdf":
+        reader = _pypdf().PdfReader(file_path)
+        segments = []
+        for i, page in enumerate(reader.pages):
+            text = (page.extract_text() or "").strip()
+            if text:
+                segments.append({"text": text, "page": i + 1})
+        return segments
+
+    if ext == ".docx":
+        doc = _docx().Document(file_path)
         text = "\n".join([para.text for para in doc.paragraphs])
 
     elif ext in [".xlsx", ".xls"]:
-        df = pd.read_excel(file_path)
+        df = _pandas().read_excel(file_path)
         text = df.to_string(index=False)
 
     elif ext == ".csv":
-        df = pd.read_csv(file_path)
+        df = _pandas().read_csv(file_path)
         text = df.to_string(index=False)
 
     else:
         text = f"[Unsupported file format: {ext}]"
 
-    return text.strip()
+    return [{"text": text.strip()}]
+
+
+def parse_file(file_path: str) -> str:
+    """将不同格式文件解析为纯文本"""
+    return "\n".join(seg["text"] for seg in parse_file_segments(file_path)).strip()
 
 
 def make_prompt(state: Dict):
+    # feedbacks 与 feedback_style 均已由 build_context 在反馈份额内截断
     feedbacks = state.get("feedbacks", [])
 
     q = state.get("question", "")
@@ -47,51 +98,41 @@ def make_prompt(state: Dict):
     if feedbacks:
         feedback_desc = "\n".join(feedbacks)
         prompt += f"以下是之前的回答用户不满意的时候提出的意见或期望, 你需要按照用户的想法回答:\n {feedback_desc}"
+    prompt += state.get("feedback_style", "")
     prompt += "\n请先回答问题，如果是可执行类的, 可尝试为用户制定markdown格式的任务列表或提醒。"
     return prompt
 
 
 def log_node_entry(node_name: str = None, desc: str = ""):
-    """装饰器：在进入节点时打印日志"""
+    """
+    装饰器：进入节点时推送进度, 并记录节点的 span(耗时、session 及节点补充的属性)
+    span 汇总到 /metrics 的直方图中, 明细以 JSON 写入日志
+    """
     def decorator(func):
         name = node_name or func.__name__
 
         @functools.wraps(func)
         async def async_wrapper(state):
-            print(f"\n[{datetime.datetime.now().strftime('%H:%M:%S')}] → [{name}] enter")
-            print(f"State keys: {list(state.keys()) if state else []}")
+            ensure_log_listener()
             session_id = state.get("session_id")
+            logger.debug("→ [%s] enter, state keys: %s", name, list(state.keys()) if state else [])
             if desc:
-                await log_queue_manager.put_log(session_id, f"🟢正在 {desc}")
+                await progress_bus.publish(session_id, f"🟢正在 {desc}")
                 if node_name == "summary_answer":
-                    await log_queue_manager.put_log(session_id, None)
-            result = await func(state)
-            print(f"[{datetime.datetime.now().strftime('%H:%M:%S')}] → [{name}] completed\n")
-            return result
+                    await progress_bus.publish(session_id, None)
+            span = {"node": name, "session_id": session_id}
+            token = current_span.set(span)
+            start = time.perf_counter()
+            try:
+                return await func(state)
+            except Exception:
+                span["error"] = True
+                node_errors.inc(node=name)
+                raise
+            finally:
+                span["duration"] = round(time.perf_counter() - start, 4)
+                current_span.reset(token)
+                node_duration.observe(span["duration"], node=name)
+                logger.info("span %s", json.dumps(span, ensure_ascii=False, default=str))
         return async_wrapper
     return decorator
-
-
-class LogQueueManager:
-    def __init__(self):
-        self.queues = {}  # {session_id: asyncio.Queue()}
-
-    def get_queue(self, session_id: str):
-        if session_id not in self.queues:
-            self.queues[session_id] = asyncio.Queue()
-        return self.queues[session_id]
-
-    async def put_log(self, session_id: str, message: str):
-        queue = self.get_queue(session_id)
-        await queue.put(message)
-
-    async def get_log(self, session_id: str):
-        queue = self.get_queue(session_id)
-        return await queue.get()
-
-    def remove_queue(self, session_id: str):
-        if session_id in self.queues:
-            del self.queues[session_id]
-
-
-log_queue_manager = LogQueueManager()
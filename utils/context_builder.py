@@ -0,0 +1,150 @@
+import re
+import threading
+from typing import Dict, List, Optional, Set, Tuple
+
+_encoding = None
+_encoding_failed = False
+_encoding_lock = threading.Lock()
+_CJK_RE = re.compile(r"[぀-ヿ㐀-䶿一-鿿가-힯]")
+
+
+def _get_encoding():
+    """tiktoken 首次使用需要下载编码表, 离线环境下失败则退回到估算"""
+    global _encoding, _encoding_failed
+    if _encoding is None and not _encoding_failed:
+        with _encoding_lock:
+            if _encoding is None and not _encoding_failed:
+                try:
+                    import tiktoken
+                    _encoding = tiktoken.get_encoding("cl100k_base")
+                except Exception:
+                    _encoding_failed = True
+    return _encoding
+
+
+def count_tokens(text: str) -> int:
+    enc = _get_encoding()
+    if enc is not None:
+        return len(enc.encode(text, disallowed_special=()))
+    # 估算: 中日韩文字约 1 字 1 token, 其余约 4 字符 1 token
+    cjk = len(_CJK_RE.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    if max_tokens <= 0:
+        return ""
+    enc = _get_encoding()
+    if enc is not None:
+        tokens = enc.encode(text, disallowed_special=())
+        return text if len(tokens) <= max_tokens else enc.decode(tokens[:max_tokens])
+    if count_tokens(text) <= max_tokens:
+        return text
+    lo, hi = 0, len(text)
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if count_tokens(text[:mid]) <= max_tokens:
+            lo = mid
+        else:
+            hi = mid - 1
+    return text[:lo]
+
+
+def _shingles(text: str, n: int = 5) -> Set[str]:
+    text = re.sub(r"\s+", " ", text)
+    if len(text) <= n:
+        return {text}
+    return {text[i:i + n] for i in range(len(text) - n + 1)}
+
+
+def _similarity(a: Set[str], b: Set[str]) -> float:
+    """以较短文本为基准的重合度, 一段被另一段包含时接近 1"""
+    if not a or not b:
+        return 0.0
+    return len(a & b) / min(len(a), len(b))
+
+
+def _strip_overlap(prev: str, text: str, min_overlap: int = 20, max_overlap: int = 200) -> str:
+    """相邻 chunk 之间有重叠(切分时 chunk_overlap=100), 去掉 text 开头与 prev 结尾重复的部分"""
+    for size in range(min(max_overlap, len(prev), len(text)), min_overlap - 1, -1):
+        if prev.endswith(text[:size]):
+            return text[size:].lstrip()
+    return text
+
+
+def mmr_select(candidates: List[Tuple[str, float]], max_tokens: int, max_items: Optional[int] = None,
+               lambda_mult: float = 0.7, dup_threshold: float = 0.8) -> List[str]:
+    """
+    按 MMR 从候选中挑选 chunk: score = λ·相关度 - (1-λ)·与已选内容的最大相似度
+    - 与已选内容高度重合的候选直接丢弃
+    - 与已选 chunk 首尾重叠的部分被裁掉
+    - 累计 token 不超过 max_tokens
+    candidates: [(文本, 相关度)], 相关度越大越相关
+    """
+    if not candidates or max_tokens <= 0:
+        return []
+    top = max(score for _, score in candidates) or 1.0
+    pool = [(text, score / top, _shingles(text)) for text, score in candidates if text.strip()]
+    selected: List[Tuple[str, Set[str]]] = []
+    used = 0
+    while pool and (max_items is None or len(selected) < max_items):
+        best_i, best_score = None, None
+        for i, (text, rel, sh) in enumerate(pool):
+            redundancy = max((_similarity(sh, s) for _, s in selected), default=0.0)
+            if redundancy >= dup_threshold:
+                continue
+            score = lambda_mult * rel - (1 - lambda_mult) * redundancy
+            if best_score is None or score > best_score:
+                best_i, best_score = i, score
+        if best_i is None:
+            break
+        text, _, sh = pool.pop(best_i)
+        for prev, _ in selected:
+            text = _strip_overlap(prev, text)
+        cost = count_tokens(text)
+        if used + cost > max_tokens:
+            continue  # 放不下就试下一个更短的候选
+        selected.append((text, sh))
+        used += cost
+    return [text for text, _ in selected]
+
+
+def fit_texts(texts: List[str], max_tokens: int) -> List[str]:
+    """按顺序放入文本, 超出预算时截断最后一条并停止"""
+    fitted, used = [], 0
+    for text in texts:
+        cost = count_tokens(text)
+        if used + cost > max_tokens:
+            rest = truncate_to_tokens(text, max_tokens - used)
+            if rest:
+                fitted.append(rest)
+            break
+        fitted.append(text)
+        used += cost
+    return fitted
+
+
+def build_context(doc_candidates: List[Tuple[str, float]], memory_texts: List[str], feedbacks: List[str],
+                  budget: int, shares: Dict[str, float], max_docs: Optional[int] = None,
+                  lambda_mult: float = 0.7, feedback_style: str = "") -> Dict:
+    """
+    在总 token 预算内组装上下文, 反馈与记忆各自不超过自己的份额, 剩余预算全部留给文档
+    风格提示(feedback_style)与反馈意见共用反馈份额, 意见优先
+    返回 {"documents": [...], "memory": [...], "feedbacks": [...], "feedback_style": str, "context": str, "tokens": int}
+    """
+    fb_budget = int(budget * shares.get("feedback", 0.1))
+    fb = fit_texts(feedbacks, fb_budget)
+    used = sum(count_tokens(t) for t in fb)
+    style = truncate_to_tokens(feedback_style, fb_budget - used) if feedback_style else ""
+    used += count_tokens(style)
+    mem = fit_texts(memory_texts, min(int(budget * shares.get("memory", 0.2)), budget - used))
+    used += sum(count_tokens(t) for t in mem)
+    docs = mmr_select(doc_candidates, budget - used, max_docs, lambda_mult)
+
+    # 记忆中与文档重复的内容不再放入
+    doc_shingles = [_shingles(d) for d in docs]
+    mem = [m for m in mem if all(_similarity(_shingles(m), s) < 0.8 for s in doc_shingles)]
+
+    context = "\n\n".join(docs + mem)
+    return {"documents": docs, "memory": mem, "feedbacks": fb, "feedback_style": style, "context": context,
+            "tokens": count_tokens(context) + sum(count_tokens(t) for t in fb) + count_tokens(style)}
@@ -0,0 +1,199 @@
+import math, threading
+from contextvars import ContextVar
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.tracers.context import register_configure_hook
+
+from .context_builder import count_tokens
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _fmt_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    parts = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _fmt_value(v: float) -> str:
+    if v == math.inf:
+        return "+Inf"
+    return repr(float(v)) if not float(v).is_integer() else str(int(v))
+
+
+class Counter:
+    def __init__(self, name: str, doc: str, labelnames: Sequence[str] = ()):
+        self.name, self.doc, self.labelnames = name, doc, tuple(labelnames)
+        self.values: Dict[Tuple, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(str(labels.get(n, "")) for n in self.labelnames)
+        with self._lock:
+            self.values[key] = self.values.get(key, 0.0) + amount
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.doc}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, v in sorted(self.values.items()):
+                lines.append(f"{self.name}{_fmt_labels(self.labelnames, key)} {_fmt_value(v)}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, doc: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS):
+        self.name, self.doc, self.labelnames = name, doc, tuple(labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        self.values: Dict[Tuple, List] = {}  # {labels: [各桶计数, sum, count]}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        key = tuple(str(labels.get(n, "")) for n in self.labelnames)
+        with self._lock:
+            entry = self.values.get(key)
+            if entry is None:
+                entry = self.values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[0][i] += 1
+                    break
+            entry[1] += value
+            entry[2] += 1
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.doc}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, (counts, total, count) in sorted(self.values.items()):
+                cumulative = 0
+                for bound, c in zip(self.buckets, counts):
+                    cumulative += c
+                    le = 'le="{}"'.format(_fmt_value(bound))
+                    lines.append(f"{self.name}_bucket{_fmt_labels(self.labelnames, key, le)} {cumulative}")
+                lines.append(f"{self.name}_sum{_fmt_labels(self.labelnames, key)} {_fmt_value(total)}")
+                lines.append(f"{self.name}_count{_fmt_labels(self.labelnames, key)} {count}")
+        return lines
+
+
+class MetricsRegistry:
+    """
+    轻量的指标注册表, 输出 Prometheus 文本格式
+    collector 在抓取时调用, 返回 [(指标名, 说明, {((标签名, 标签值), ...): 值})], 用于导出各组件已有的统计
+    同名指标可以来自多个 collector, 输出时合并
+    """
+
+    def __init__(self):
+        self.metrics = []
+        self.collectors: List[Callable[[], Iterable[Tuple[str, str, Dict[Tuple, float]]]]] = []
+
+    def counter(self, name: str, doc: str, labelnames: Sequence[str] = ()) -> Counter:
+        metric = Counter(name, doc, labelnames)
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(self, name: str, doc: str, labelnames: Sequence[str] = (),
+                  buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        metric = Histogram(name, doc, labelnames, buckets)
+        self.metrics.append(metric)
+        return metric
+
+    def register_collector(self, fn: Callable[[], Iterable[Tuple[str, str, Dict[Tuple, float]]]]):
+        self.collectors.append(fn)
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        gauges: Dict[str, Tuple[str, Dict]] = {}
+        for fn in self.collectors:
+            for name, doc, samples in fn():
+                gauges.setdefault(name, (doc, {}))[1].update(samples)
+        for name, (doc, samples) in gauges.items():
+            lines += [f"# HELP {name} {doc}", f"# TYPE {name} gauge"]
+            for labels, value in samples.items():
+                lines.append(f"{name}{_fmt_labels([k for k, _ in labels], [v for _, v in labels])} "
+                             f"{_fmt_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+def stats_collector(component: str, stats: Callable[[], Dict]):
+    """把组件 stats() 中的数值项导出为 insight_component_stat{component, stat}"""
+    def collect():
+        samples = {(("component", component), ("stat", k)): v for k, v in stats().items()
+                   if isinstance(v, (int, float)) and not isinstance(v, bool)}
+        return [("insight_component_stat", "各缓存/组件的内部统计", samples)]
+    return collect
+
+
+registry = MetricsRegistry()
+
+node_duration = registry.histogram("insight_node_duration_seconds", "LangGraph 节点耗时", ["node"])
+node_errors = registry.counter("insight_node_errors_total", "LangGraph 节点异常次数", ["node"])
+llm_tokens = registry.counter("insight_llm_tokens_total", "LLM token 数, kind 为 prompt/completion", ["node", "kind"])
+retrieved_chunks = registry.histogram("insight_retrieved_chunks", "每次检索放入上下文的 chunk 数", [],
+                                      (0, 1, 2, 3, 5, 8, 13, 20))
+index_size = registry.histogram("insight_index_size_chunks", "检索时 session 索引的 chunk 数", [],
+                                (100, 1000, 10000, 50000, 100000, 500000))
+cache_requests = registry.counter("insight_cache_requests_total", "缓存查询次数", ["cache", "result"])
+ingest_duration = registry.histogram("insight_ingest_duration_seconds", "文档入库任务耗时", ["state"],
+                                     (0.1, 0.5, 1, 5, 10, 30, 60, 300, 900))
+
+
+# 当前节点的 span, 由 log_node_entry 设置, 节点内通过 span_set 补充属性
+current_span: ContextVar[Optional[Dict]] = ContextVar("insight_current_span", default=None)
+
+
+def span_set(**attrs):
+    span = current_span.get()
+    if span is not None:
+        span.update(attrs)
+
+
+class TokenUsageHandler(BaseCallbackHandler):
+    """统计每次 LLM 调用的 token 数并记到当前节点的 span 上; 模型未返回用量时按文本估算"""
+
+    run_inline = True
+
+    def __init__(self):
+        self._prompts: Dict = {}
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, **kwargs):
+        self._prompts[run_id] = "\n".join(str(m.content) for batch in messages for m in batch)
+
+    def on_llm_start(self, serialized, prompts, *, run_id, **kwargs):
+        self._prompts[run_id] = "\n".join(prompts)
+
+    def on_llm_end(self, response, *, run_id, **kwargs):
+        prompt = self._prompts.pop(run_id, "")
+        prompt_tokens = completion_tokens = None
+        for gens in response.generations:
+            for g in gens:
+                usage = getattr(getattr(g, "message", None), "usage_metadata", None)
+                if usage:
+                    prompt_tokens = (prompt_tokens or 0) + usage.get("input_tokens", 0)
+                    completion_tokens = (completion_tokens or 0) + usage.get("output_tokens", 0)
+        if prompt_tokens is None:
+            prompt_tokens = count_tokens(prompt)
+            completion_tokens = sum(count_tokens(g.text) for gens in response.generations for g in gens)
+
+        span = current_span.get()
+        node = span["node"] if span else ""
+        llm_tokens.inc(prompt_tokens, node=node, kind="prompt")
+        llm_tokens.inc(completion_tokens, node=node, kind="completion")
+        if span is not None:
+            span["prompt_tokens"] = span.get("prompt_tokens", 0) + prompt_tokens
+            span["completion_tokens"] = span.get("completion_tokens", 0) + completion_tokens
+
+    def on_llm_error(self, error, *, run_id, **kwargs):
+        self._prompts.pop(run_id, None)
+
+
+# 默认值即生效的 handler, 所有回调管理器都会带上它, 后台任务(空 context)同样适用
+_token_usage: ContextVar[Optional[TokenUsageHandler]] = ContextVar("insight_token_usage",
+                                                                   default=TokenUsageHandler())
+register_configure_hook(_token_usage, inheritable=True)
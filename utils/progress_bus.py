@@ -0,0 +1,204 @@
+import os, json, time, sqlite3, asyncio, itertools, threading
+from collections import deque
+from typing import AsyncIterator, Dict, List, Optional
+
+from config import (
+    progress_backend, progress_db_path, progress_max_events, progress_ttl, progress_poll_interval,
+    progress_idle_timeout)
+from .metrics import registry, stats_collector
+
+# 每条事件: {"seq": 递增序号, "ts": 时间戳, "message": 文本, None 表示本轮结束}
+Event = Dict
+
+
+class _Channel:
+    def __init__(self, max_events: int):
+        self.events = deque(maxlen=max_events)
+        self.changed = asyncio.Event()
+        self.last_ts = time.time()
+        self.waiters = 0
+
+
+class MemoryProgressBackend:
+    """单进程内的进度事件: 每个 session 一个定长环形缓冲, 空闲超过 TTL 的 session 被清理"""
+
+    def __init__(self, max_events: int, ttl: float):
+        self.max_events = max_events
+        self.ttl = ttl
+        self.channels: Dict[str, _Channel] = {}
+        self._seq = itertools.count(1)
+        self._last_sweep = time.time()
+
+    def _channel(self, session_id: str) -> _Channel:
+        ch = self.channels.get(session_id)
+        if ch is None:
+            ch = self.channels[session_id] = _Channel(self.max_events)
+        return ch
+
+    def _sweep(self, now: float):
+        if now - self._last_sweep < min(self.ttl, 30):
+            return
+        self._last_sweep = now
+        for sid in [sid for sid, ch in self.channels.items() if now - ch.last_ts > self.ttl and not ch.waiters]:
+            del self.channels[sid]
+
+    async def publish(self, session_id: str, message: Optional[str]) -> int:
+        now = time.time()
+        ch = self._channel(session_id)
+        seq = next(self._seq)
+        ch.events.append({"seq": seq, "ts": now, "message": message})
+        ch.last_ts = now
+        # 唤醒当前所有订阅者, 之后的等待使用新的 Event
+        ch.changed.set()
+        ch.changed = asyncio.Event()
+        self._sweep(now)
+        return seq
+
+    async def read(self, session_id: str, after: int) -> List[Event]:
+        ch = self.channels.get(session_id)
+        return [e for e in ch.events if e["seq"] > after] if ch else []
+
+    async def wait(self, session_id: str, after: int, timeout: float) -> List[Event]:
+        deadline = time.monotonic() + timeout
+        ch = self._channel(session_id)
+        ch.waiters += 1
+        try:
+            while True:
+                events = [e for e in ch.events if e["seq"] > after]
+                remaining = deadline - time.monotonic()
+                if events or remaining <= 0:
+                    return events
+                try:
+                    await asyncio.wait_for(ch.changed.wait(), remaining)
+                except asyncio.TimeoutError:
+                    return []
+        finally:
+            ch.waiters -= 1
+
+    def stats(self) -> Dict:
+        return {"sessions": len(self.channels), "events": sum(len(ch.events) for ch in self.channels.values())}
+
+
+class SqliteProgressBackend:
+    """
+    基于 SQLite(WAL) 的进度事件, 同一主机上的多个 uvicorn worker 共享
+    订阅方按序号轮询; 每个 session 只保留最近 max_events 条, 超过 TTL 的事件被删除
+    """
+
+    def __init__(self, db_path: str, max_events: int, ttl: float, poll_interval: float):
+        self.db_path = db_path
+        self.max_events = max_events
+        self.ttl = ttl
+        self.poll_interval = poll_interval
+        self._lock = threading.Lock()
+        self._conn: Optional[sqlite3.Connection] = None
+        self._last_sweep = 0.0
+
+    def _db(self) -> sqlite3.Connection:
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.db_path) or ".", exist_ok=True)
+            conn = sqlite3.connect(self.db_path, check_same_thread=False, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS progress (
+                    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                    session_id TEXT NOT NULL,
+                    ts REAL NOT NULL,
+                    message TEXT
+                )""")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_progress_session ON progress(session_id, seq)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_progress_ts ON progress(ts)")
+            self._conn = conn
+        return self._conn
+
+    def _publish(self, session_id: str, message: Optional[str]) -> int:
+        now = time.time()
+        with self._lock:
+            db = self._db()
+            seq = db.execute("INSERT INTO progress(session_id, ts, message) VALUES (?, ?, ?)",
+                             (session_id, now, json.dumps(message, ensure_ascii=False))).lastrowid
+            db.execute("""
+                DELETE FROM progress WHERE session_id=? AND seq <= (
+                    SELECT seq FROM progress WHERE session_id=? ORDER BY seq DESC LIMIT 1 OFFSET ?)""",
+                       (session_id, session_id, self.max_events))
+            if now - self._last_sweep >= min(self.ttl, 30):
+                self._last_sweep = now
+                db.execute("DELETE FROM progress WHERE ts < ?", (now - self.ttl,))
+            db.commit()
+        return seq
+
+    def _read(self, session_id: str, after: int) -> List[Event]:
+        with self._lock:
+            rows = self._db().execute(
+                "SELECT seq, ts, message FROM progress WHERE session_id=? AND seq>? ORDER BY seq",
+                (session_id, after)).fetchall()
+        return [{"seq": seq, "ts": ts, "message": json.loads(msg)} for seq, ts, msg in rows]
+
+    async def publish(self, session_id: str, message: Optional[str]) -> int:
+        return await asyncio.to_thread(self._publish, session_id, message)
+
+    async def read(self, session_id: str, after: int) -> List[Event]:
+        return await asyncio.to_thread(self._read, session_id, after)
+
+    async def wait(self, session_id: str, after: int, timeout: float) -> List[Event]:
+        deadline = time.monotonic() + timeout
+        while True:
+            events = await self.read(session_id, after)
+            if events or time.monotonic() >= deadline:
+                return events
+            await asyncio.sleep(min(self.poll_interval, max(0.0, deadline - time.monotonic())))
+
+    def stats(self) -> Dict:
+        with self._lock:
+            sessions, events = self._db().execute(
+                "SELECT COUNT(DISTINCT session_id), COUNT(*) FROM progress").fetchone()
+        return {"sessions": sessions, "events": events}
+
+
+class ProgressBus:
+    """
+    节点进度的发布/订阅: 发布不依赖是否有人订阅, 事件有界且按 TTL 过期
+    多个订阅者各自按序号读取(扇出), 新订阅者会回放本轮已发生的事件
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+
+    async def publish(self, session_id: str, message: Optional[str]) -> int:
+        return await self.backend.publish(session_id, message)
+
+    async def subscribe(self, session_id: str, since: Optional[int] = None,
+                        idle_timeout: float = progress_idle_timeout) -> AsyncIterator[Event]:
+        """
+        产出事件直到本轮结束或空闲超时
+        since 为空时从本轮开始回放: 缓冲中最后一个结束标记之后的事件
+        """
+        if since is None:
+            since = 0
+            for e in await self.backend.read(session_id, 0):
+                if e["message"] is None:
+                    since = e["seq"]
+        while True:
+            events = await self.backend.wait(session_id, since, idle_timeout)
+            if not events:
+                return
+            for e in events:
+                since = e["seq"]
+                if e["message"] is None:
+                    return
+                yield e
+
+    def stats(self) -> Dict:
+        return self.backend.stats()
+
+
+def make_progress_bus() -> ProgressBus:
+    if progress_backend == "sqlite":
+        return ProgressBus(SqliteProgressBackend(progress_db_path, progress_max_events, progress_ttl,
+                                                 progress_poll_interval))
+    return ProgressBus(MemoryProgressBackend(progress_max_events, progress_ttl))
+
+
+progress_bus = make_progress_bus()
+registry.register_collector(stats_collector("progress_bus", progress_bus.stats))
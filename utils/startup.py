@@ -0,0 +1,89 @@
+"""
+启动耗时: 模型、解析器、图等重量级对象延迟到首次使用时初始化(Lazy), 并记录各自的初始化耗时
+API 启动时可按配置提前预热; 各阶段耗时通过 /metrics 导出
+
+python -m utils.startup                # 导入 api.main_api 的耗时按顶层包汇总, 以及各组件的初始化耗时
+python -m utils.startup graph.nodes 20
+"""
+import re, sys, time, asyncio, threading, subprocess
+from collections import defaultdict
+from typing import Callable, Dict, Generic, Iterable, List, Tuple, TypeVar
+
+from .metrics import registry, stats_collector
+
+T = TypeVar("T")
+
+timings: Dict[str, float] = {}  # {阶段/组件: 耗时(秒)}
+_lazies: Dict[str, "Lazy"] = {}
+
+
+class Lazy(Generic[T]):
+    """线程安全的延迟初始化: 首次调用时执行 factory 并记录耗时, 之后返回同一个对象"""
+
+    def __init__(self, name: str, factory: Callable[[], T]):
+        self.name = name
+        self._factory = factory
+        self._value = None
+        self._ready = False
+        self._lock = threading.Lock()
+        _lazies[name] = self
+
+    def __call__(self) -> T:
+        if not self._ready:
+            with self._lock:
+                if not self._ready:
+                    start = time.perf_counter()
+                    self._value = self._factory()
+                    timings[f"init_{self.name}"] = round(time.perf_counter() - start, 4)
+                    self._ready = True
+        return self._value
+
+    @property
+    def ready(self) -> bool:
+        return self._ready
+
+
+async def warmup(names: Iterable[str]) -> Dict[str, float]:
+    """在线程中并行初始化指定组件, 返回各组件耗时; 未注册的名称忽略"""
+    start = time.perf_counter()
+    targets = [_lazies[n] for n in names if n in _lazies]
+    await asyncio.gather(*(asyncio.to_thread(lazy) for lazy in targets))
+    timings["warmup"] = round(time.perf_counter() - start, 4)
+    return {lazy.name: timings.get(f"init_{lazy.name}", 0.0) for lazy in targets}
+
+
+def import_times(module: str) -> Tuple[float, List[Tuple[str, float]]]:
+    """在子进程中用 -X importtime 导入模块, 返回 (总耗时, [(顶层包, 自身耗时之和)]), 单位秒"""
+    proc = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                          capture_output=True, text=True)
+    per_package, total = defaultdict(int), 0
+    for line in proc.stderr.splitlines():
+        m = re.match(r"import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)", line)
+        if not m:
+            continue
+        self_us, cumulative_us, indent, name = int(m[1]), int(m[2]), len(m[3]), m[4]
+        per_package[name.split(".")[0]] += self_us
+        if indent == 1 and name == module:
+            total = cumulative_us
+    ranked = sorted(per_package.items(), key=lambda x: -x[1])
+    return total / 1e6, [(name, us / 1e6) for name, us in ranked]
+
+
+registry.register_collector(stats_collector("startup", lambda: timings))
+
+
+if __name__ == "__main__":
+    module = sys.argv[1] if len(sys.argv) > 1 else "api.main_api"
+    top = int(sys.argv[2]) if len(sys.argv) > 2 else 15
+    total, ranked = import_times(module)
+    print(f"import {module}: {total:.3f}s")
+    for name, seconds in ranked[:top]:
+        print(f"  {name:<32} {seconds * 1000:>9.1f} ms")
+
+    # 以 -m 运行时本文件是 __main__, 组件注册在被导入的 utils.startup 中
+    __import__(module)
+    from utils import startup
+    results = asyncio.run(startup.warmup(list(startup._lazies)))
+    print("lazy init:")
+    for name, seconds in sorted(results.items(), key=lambda x: -x[1]):
+        print(f"  {name:<32} {seconds * 1000:>9.1f} ms")
@@ -0,0 +1,95 @@
+import re
+import math
+from collections import Counter
+from typing import Dict, Hashable, List, Tuple
+
+# 英文/数字按词切分, 中日韩文字连续片段按字切分
+_TOKEN_RE = re.compile(r"[a-z0-9_]+|[぀-ヿ㐀-䶿一-鿿가-힯]+")
+
+
+def tokenize(text: str) -> List[str]:
+    """
+    面向中英混合文本的分词:
+    - 英文/数字: 按词, 忽略单字符
+    - 中日韩文字: 字 bigram, 单字片段保留单字
+    """
+    tokens = []
+    for m in _TOKEN_RE.finditer(text.lower()):
+        piece = m.group()
+        if piece.isascii():
+            if len(piece) > 1:
+                tokens.append(piece)
+        elif len(piece) == 1:
+            tokens.append(piece)
+        else:
+            tokens.extend(piece[i:i + 2] for i in range(len(piece) - 1))
+    return tokens
+
+
+class BM25Index:
+    """
+    可增量维护的 BM25 倒排索引
+    检索只遍历查询词的倒排表, 与文档总数无关
+    """
+
+    def __init__(self, k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self.postings: Dict[str, Dict[Hashable, int]] = {}  # {词: {doc_id: 词频}}
+        self.doc_len: Dict[Hashable, int] = {}
+        self.doc_terms: Dict[Hashable, List[str]] = {}
+        self.total_len = 0
+
+    def __len__(self):
+        return len(self.doc_len)
+
+    def add(self, doc_id: Hashable, text: str):
+        if doc_id in self.doc_len:
+            self.remove(doc_id)
+        counts = Counter(tokenize(text))
+        for term, tf in counts.items():
+            self.postings.setdefault(term, {})[doc_id] = tf
+        length = sum(counts.values())
+        self.doc_len[doc_id] = length
+        self.doc_terms[doc_id] = list(counts)
+        self.total_len += length
+
+    def remove(self, doc_id: Hashable):
+        if doc_id not in self.doc_len:
+            return
+        for term in self.doc_terms.pop(doc_id):
+            posting = self.postings.get(term)
+            if posting is not None:
+                posting.pop(doc_id, None)
+                if not posting:
+                    del self.postings[term]
+        self.total_len -= self.doc_len.pop(doc_id)
+
+    def search(self, query: str, top_k: int = 3) -> List[Tuple[Hashable, float]]:
+        n = len(self.doc_len)
+        if not n:
+            return []
+        avg_len = self.total_len / n or 1
+        scores: Dict[Hashable, float] = {}
+        for term in set(tokenize(query)):
+            posting = self.postings.get(term)
+            if not posting:
+                continue
+            idf = math.log(1 + (n - len(posting) + 0.5) / (len(posting) + 0.5))
+            for doc_id, tf in posting.items():
+                norm = tf + self.k1 * (1 - self.b + self.b * self.doc_len[doc_id] / avg_len)
+                scores[doc_id] = scores.get(doc_id, 0.0) + idf * tf * (self.k1 + 1) / norm
+        return sorted(scores.items(), key=lambda x: x[1], reverse=True)[:top_k]
+
+
+def reciprocal_rank_fusion(rankings: List[List[Hashable]], weights: List[float],
+                           k: int = 60) -> List[Tuple[Hashable, float]]:
+    """
+    加权倒数排名融合: score(d) = Σ w_i / (k + rank_i(d)), rank 从 1 开始
+    只依赖排名, 不需要对向量距离和 BM25 分数做归一化
+    """
+    scores: Dict[Hashable, float] = {}
+    for ranking, weight in zip(rankings, weights):
+        for rank, doc_id in enumerate(ranking, start=1):
+            scores[doc_id] = scores.get(doc_id, 0.0) + weight / (k + rank)
+    return sorted(scores.items(), key=lambda x: x[1], reverse=True)